@@ -6,7 +6,8 @@ from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.utils.decorators import method_decorator
-from .models import UserProfile, Room, Message, Gift, GiftTransaction
+from .evercoin import ledger, InsufficientEvercoin, GRANTS
+from .models import UserProfile, Room, Message, Gift, GiftTransaction, EvercoinLedgerEntry
 
 # Register your models here.
 
@@ -101,14 +102,12 @@ class UserProfileAdmin(admin.ModelAdmin):
                 elif amount > 1000000:
                     messages.error(request, 'Amount too large. Maximum is 1,000,000.')
                 else:
-                    old_balance = profile.evercoin
-                    profile.evercoin += amount
-                    profile.save()
+                    entry = ledger.credit(profile.user, amount, 'admin_grant', GRANTS, memo=reason[:200])
                     
                     messages.success(
                         request, 
                         f'Successfully added {amount:,} Evercoin to {profile.user.username}. '
-                        f'Balance: {old_balance:,} → {profile.evercoin:,}. Reason: {reason or "N/A"}'
+                        f'Balance: {entry.balance_after - amount:,} → {entry.balance_after:,}. Reason: {reason or "N/A"}'
                     )
                     return redirect('admin:chat_userprofile_changelist')
             except ValueError:
@@ -138,19 +137,18 @@ class UserProfileAdmin(admin.ModelAdmin):
                 
                 if amount <= 0:
                     messages.error(request, 'Amount must be positive.')
-                elif amount > profile.evercoin:
-                    messages.error(request, f'Cannot deduct {amount:,}. User only has {profile.evercoin:,} Evercoin.')
                 else:
-                    old_balance = profile.evercoin
-                    profile.evercoin -= amount
-                    profile.save()
+                    entry = ledger.debit(profile.user, amount, 'admin_deduct', GRANTS, memo=reason[:200])
                     
                     messages.success(
                         request, 
                         f'Successfully deducted {amount:,} Evercoin from {profile.user.username}. '
-                        f'Balance: {old_balance:,} → {profile.evercoin:,}. Reason: {reason or "N/A"}'
+                        f'Balance: {entry.balance_after + amount:,} → {entry.balance_after:,}. Reason: {reason or "N/A"}'
                     )
                     return redirect('admin:chat_userprofile_changelist')
+            except InsufficientEvercoin:
+                profile.refresh_from_db(fields=['evercoin'])
+                messages.error(request, f'Cannot deduct {amount:,}. User only has {profile.evercoin:,} Evercoin.')
             except ValueError:
                 messages.error(request, 'Invalid amount.')
         
@@ -164,11 +162,8 @@ class UserProfileAdmin(admin.ModelAdmin):
         return render(request, 'admin/chat/evercoin_form.html', context)
     
     def get_readonly_fields(self, request, obj=None):
-        """Make evercoin read-only for non-superusers"""
-        readonly = list(super().get_readonly_fields(request, obj))
-        if not request.user.is_superuser:
-            readonly.append('evercoin')
-        return readonly
+        """Evercoin only changes through the ledger (the Add/Deduct actions)"""
+        return list(super().get_readonly_fields(request, obj)) + ['evercoin']
     
     def has_delete_permission(self, request, obj=None):
         """Prevent deletion of user profiles"""
@@ -240,6 +235,27 @@ class GiftTransactionAdmin(admin.ModelAdmin):
         return False  # Transactions should not be modified
 
 
+@admin.register(EvercoinLedgerEntry)
+class EvercoinLedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ['created_at', 'owner', 'amount', 'balance_after', 'kind', 'reference', 'memo']
+    list_filter = ['kind', 'account', 'created_at']
+    search_fields = ['user__username', 'reference', 'memo', 'transaction_id']
+    list_select_related = ['user']
+    
+    def owner(self, obj):
+        return obj.user.username if obj.user_id else f'[{obj.account}]'
+    owner.short_description = "Account"
+    
+    def has_add_permission(self, request):
+        return False  # Entries are only written by the ledger
+    
+    def has_change_permission(self, request, obj=None):
+        return False  # The ledger is append-only
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 # Admin action to grant evercoin to multiple users
 @admin.action(description='Grant Evercoin to selected users')
 def grant_evercoin_bulk(modeladmin, request, queryset):
@@ -250,12 +266,9 @@ def grant_evercoin_bulk(modeladmin, request, queryset):
     
     # This would typically open a form, but for simplicity we'll grant a fixed amount
     amount = 1000  # Default amount
-    count = 0
     
-    for profile in queryset:
-        profile.evercoin += amount
-        profile.save()
-        count += 1
+    # One UPDATE for every selected balance, journalled as a single transaction
+    count = len(ledger.credit_many(queryset.values_list('user_id', flat=True), amount, 'admin_grant', GRANTS))
     
     modeladmin.message_user(
         request,
@@ -0,0 +1,209 @@
+"""
+Catalog snapshots for the gift and GIF pickers.
+
+get_gifts, get_gif_packs (one COUNT per pack) and get_gifs_by_pack rebuilt
+and re-serialized the same, rarely changing data for every request of every
+client. Each catalog is now serialized once into a snapshot:
+
+    gifts        - gifts grouped by rarity
+    gif_packs    - active packs with their GIF counts (one query)
+    gif_pack:<id> - every page of one pack's GIFs
+
+A snapshot is the response body as bytes plus an ETag derived from a hash of
+those bytes. Snapshots are cached under a catalog generation that the signal
+handlers in chat.models bump whenever a Gift, GifPack or GifFile is saved or
+deleted (view count updates don't touch it), so an edit is visible on the
+next request and an unchanged catalog is never rebuilt.
+
+respond() sends the snapshot with its ETag and Cache-Control, or a bodiless
+304 when the client's If-None-Match still matches: repeat requests cost one
+cache read.
+
+Configure via the CATALOG setting:
+
+    CATALOG = {
+        'TIMEOUT': 86400,
+        'MAX_AGE': 60,
+    }
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Count, Q
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import metrics
+
+
+DEFAULT_CATALOG = {
+    'TIMEOUT': 86400,  # Seconds a snapshot is kept (edits invalidate it sooner)
+    'MAX_AGE': 60,  # Seconds clients may reuse a response before revalidating with If-None-Match
+}
+
+GIFS_PER_PAGE = 12
+
+RARITIES = ('common', 'rare', 'epic', 'legendary')
+
+
+class Snapshot:
+    """A serialized catalog response"""
+
+    def __init__(self, payload, status=200):
+        self.body = json.dumps(payload, ensure_ascii=False).encode()
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.status = status
+
+    def extend(self, **fields):
+        """A copy with per-request fields added to the top-level object (and to the ETag)"""
+        extra = json.dumps(fields, ensure_ascii=False).encode()
+        snapshot = Snapshot.__new__(Snapshot)
+        snapshot.body = self.body[:-1] + b', ' + extra[1:]
+        snapshot.etag = f'"{hashlib.sha256(self.etag.encode() + extra).hexdigest()[:32]}"'
+        snapshot.status = self.status
+        return snapshot
+
+
+class CatalogSnapshots:
+    """Builds, caches and serves catalog snapshots"""
+
+    def __init__(self, timeout=86400, max_age=60, key_prefix='catalog'):
+        self.timeout = timeout
+        self.max_age = max_age
+        self.key_prefix = key_prefix
+
+    def _generation_key(self):
+        return f'{self.key_prefix}:generation'
+
+    def _generation(self):
+        key = self._generation_key()
+        generation = cache.get(key)
+        if generation is None:
+            cache.add(key, 1, None)
+            generation = cache.get(key, 1)
+        return generation
+
+    def invalidate(self):
+        """Retire every snapshot (now, and again when the current transaction commits)"""
+        self._bump()
+        transaction.on_commit(self._bump)
+
+    def _bump(self):
+        try:
+            cache.incr(self._generation_key())
+        except ValueError:
+            cache.add(self._generation_key(), 1, None)
+        metrics.incr('catalog.invalidations')
+
+    def get(self, name, build):
+        """The cached snapshot called name, built with build() on a miss"""
+        key = f'{self.key_prefix}:{self._generation()}:{name}'
+        snapshot = cache.get(key)
+        if snapshot is None:
+            metrics.incr('catalog.builds')
+            snapshot = build()
+            cache.set(key, snapshot, self.timeout)
+        return snapshot
+
+    def respond(self, request, snapshot):
+        """The snapshot as a response, or 304 Not Modified when the client already has it"""
+        response = None
+        if snapshot.status == 200:
+            response = get_conditional_response(request, etag=snapshot.etag)
+        if response is None:
+            response = HttpResponse(snapshot.body, status=snapshot.status, content_type='application/json')
+        else:
+            metrics.incr('catalog.not_modified')
+        response.headers['ETag'] = snapshot.etag
+        # Per-user endpoints (behind login): browsers may keep them, shared caches may not
+        patch_cache_control(response, private=True, max_age=self.max_age)
+        return response
+
+    # ---- catalogs ------------------------------------------------------------
+
+    def gifts(self):
+        return self.get('gifts', self._build_gifts)
+
+    def gif_packs(self):
+        return self.get('gif_packs', self._build_gif_packs)
+
+    def gif_pack_page(self, pack_id, page):
+        """The snapshot for a page of a pack (clamped like Paginator.get_page), or a 404 snapshot"""
+        pages = self.get(f'gif_pack:{pack_id}', lambda: self._build_gif_pack(pack_id))
+        if isinstance(pages, Snapshot):
+            return pages
+        try:
+            number = int(page)
+        except (TypeError, ValueError):
+            number = 1
+        if not 1 <= number <= len(pages):
+            number = len(pages)
+        return pages[number - 1]
+
+    def _build_gifts(self):
+        from .models import Gift
+
+        grouped = {rarity: [] for rarity in RARITIES}
+        for gift in Gift.objects.all().values('id', 'name', 'emoji', 'icon_url', 'rarity', 'description', 'cost', 'animation'):
+            if gift['rarity'] in grouped:
+                grouped[gift['rarity']].append(gift)
+        return Snapshot({'success': True, 'gifts': grouped})
+
+    def _build_gif_packs(self):
+        from .models import GifPack
+
+        packs = (GifPack.objects
+                 .filter(is_active=True)
+                 .annotate(gif_count=Count('gifs', filter=Q(gifs__is_active=True)))
+                 .values('id', 'name', 'icon', 'gif_count'))
+        return Snapshot({'success': True, 'packs': list(packs)})
+
+    def _build_gif_pack(self, pack_id):
+        """[Snapshot per page], or a 404 Snapshot"""
+        from .models import GifFile, GifPack
+
+        pack = GifPack.objects.filter(id=pack_id, is_active=True).first()
+        if pack is None:
+            return Snapshot({'success': False, 'error': 'Pack not found'}, status=404)
+
+        # One query for the whole pack; the pages are slices of it
+        gifs = list(GifFile.objects.filter(pack=pack, is_active=True).order_by('order'))
+        paginator = Paginator(gifs, GIFS_PER_PAGE)
+        pages = []
+        for number in paginator.page_range:
+            pages.append(Snapshot({
+                'success': True,
+                'pack': {
+                    'id': pack.id,
+                    'name': pack.name,
+                    'icon': pack.icon
+                },
+                'gifs': [
+                    {
+                        'id': gif.id,
+                        'title': gif.title,
+                        'url': gif.get_url(),
+                        'thumbnail': gif.thumbnail.url if gif.thumbnail else gif.get_url(),
+                        'tags': gif.tags
+                    }
+                    for gif in paginator.page(number)
+                ],
+                'total_pages': paginator.num_pages,
+                'current_page': number
+            }))
+        return pages
+
+
+def create_catalog(config=None):
+    config = dict(DEFAULT_CATALOG, **(config or getattr(settings, 'CATALOG', {})))
+    return CatalogSnapshots(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared snapshot cache, created on first use
+catalog = SimpleLazyObject(create_catalog)
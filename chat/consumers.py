@@ -1,9 +1,16 @@
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from .models import Room, Message, RoomMember
-from django.core.cache import cache
+from .models import Room, Message, RoomMember, RoomBan
+from .message_pipeline import message_pipeline
+from .history import fetch_room_history, serialize_message, clamp_page_size, InvalidCursor
+from .recent_messages import recent_messages
+from .room_events import room_events
+from .fanout import encoded_event
+from channels.consumer import get_handler_name
+from .presence import presence, presence_reaper
 import asyncio
 from django.utils import timezone
 import time
@@ -11,7 +18,9 @@ import time
 class ChatConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.heartbeat_task = None
+        self.presence_registered = False
+        # Cached {'room_id', 'allowed'} for this socket; see room_access_changed
+        self.room_access = None
 
     async def connect(self):
         # Check if user is authenticated
@@ -23,9 +32,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_group_name = f'chat_{self.room_name}'
         self.user = self.scope["user"]
 
-        # Check if room still exists
-        room_exists = await self.check_room_exists()
-        if not room_exists:
+        # Check if room still exists and cache membership/ban state for this socket
+        self.room_access = await self.load_room_access()
+        if self.room_access is None:
             await self.close()
             return
 
@@ -37,54 +46,43 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
         
-        # Simple anti-spam approach using timestamps
+        # Register presence atomically; returns when the user was last seen (None if absent).
+        # Presence backends may block on Redis, so every call runs off the event loop.
         display_name = f"{self.user.first_name} {self.user.last_name}".strip() or self.user.username
         current_time = time.time()
-        
-        # Check when user was last seen in this room
-        last_seen_key = f"last_seen_{self.room_name}_{self.user.username}"
-        last_seen = cache.get(last_seen_key, 0)
-        
-        # Add user to active users list
-        cache_key = f"active_users_{self.room_name}"
-        active_users = cache.get(cache_key, {})
-        was_already_active = self.user.username in active_users
-        
-        active_users[self.user.username] = {
-            'username': self.user.username,
-            'display_name': display_name,
-        }
+        last_seen = await sync_to_async(presence.join)(self.room_name, self.user.username, display_name, now=current_time)
+        was_already_active = last_seen is not None
+
+        # The worker's presence reaper keeps this socket's entry fresh from now on
+        presence_reaper.register(self.room_name, self.user.username)
+        presence_reaper.ensure_running()
+        self.presence_registered = True
+
         # Mark user online in DB RoomMember (sync presence)
         await self._mark_online()
-        cache.set(cache_key, active_users, 3600)
-        
-        # Update user's last seen time
-        cache.set(last_seen_key, current_time, 3600)
         
         # Send current active users list to the newly connected user
         await self.send(text_data=json.dumps({
             'type': 'active_users',
-            'users': list(active_users.values())
+            'users': await sync_to_async(presence.members)(self.room_name, now=current_time)
         }))
         
         # Only send join notification if user wasn't recently active (more than 10 seconds ago)
         if not was_already_active or (current_time - last_seen) > 10:
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
+                encoded_event({
                     'type': 'user_join',
                     'username': self.user.username,
                     'display_name': display_name,
-                }
+                })
             )
-            
-        # Start heartbeat to keep user active
-        self.heartbeat_task = asyncio.create_task(self._heartbeat())
 
     async def disconnect(self, close_code):
-        # Cancel heartbeat task
-        if self.heartbeat_task:
-            self.heartbeat_task.cancel()
+        # Stop refreshing this socket's presence entry
+        if self.presence_registered:
+            presence_reaper.unregister(self.room_name, self.user.username)
+            self.presence_registered = False
             
         # Leave room group first
         if hasattr(self, 'room_group_name'):
@@ -98,92 +96,30 @@ class ChatConsumer(AsyncWebsocketConsumer):
             # Create a background task to handle the delayed removal
             asyncio.create_task(self._handle_delayed_disconnect())
 
-    async def _heartbeat(self):
-        """Send periodic heartbeat to keep user active and sync user lists"""
-        try:
-            while True:
-                await asyncio.sleep(30)  # Heartbeat every 30 seconds
-                
-                # Update last seen time
-                if hasattr(self, 'room_name') and hasattr(self, 'user'):
-                    last_seen_key = f"last_seen_{self.room_name}_{self.user.username}"
-                    cache.set(last_seen_key, time.time(), 3600)
-                    
-                    # Send updated active users list to keep everyone in sync
-                    cache_key = f"active_users_{self.room_name}"
-                    active_users = cache.get(cache_key, {})
-                    
-                    # Clean up users who haven't been seen recently (more than 2 minutes)
-                    current_time = time.time()
-                    users_to_remove = []
-                    
-                    for username in active_users.keys():
-                        user_last_seen_key = f"last_seen_{self.room_name}_{username}"
-                        user_last_seen = cache.get(user_last_seen_key, 0)
-                        if (current_time - user_last_seen) > 120:  # 2 minutes
-                            users_to_remove.append(username)
-                    
-                    # Remove inactive users
-                    for username in users_to_remove:
-                        user_data = active_users.get(username, {})
-                        del active_users[username]
-                        
-                        # Send leave notification
-                        await self.channel_layer.group_send(
-                            self.room_group_name,
-                            {
-                                'type': 'user_leave',
-                                'username': username,
-                                'display_name': user_data.get('display_name', username),
-                            }
-                        )
-                        # Mark user offline in DB
-                        await self._mark_offline_username(username)
-                    
-                    # Update cache if users were removed
-                    if users_to_remove:
-                        cache.set(cache_key, active_users, 3600)
-                        
-                        # Send updated active users list
-                        await self.channel_layer.group_send(
-                            self.room_group_name,
-                            {
-                                'type': 'active_users_update',
-                                'users': list(active_users.values())
-                            }
-                        )
-                else:
-                    break  # Exit if connection is gone
-        except asyncio.CancelledError:
-            pass  # Task was cancelled, which is normal during disconnect
-
     async def _handle_delayed_disconnect(self):
         """Handle user disconnection with delay to catch page refreshes"""
         # Wait to see if user reconnects (page refresh scenario)
         await asyncio.sleep(3)
         
+        # Another tab on this worker still holds the room open
+        if presence_reaper.is_connected_locally(self.room_name, self.user.username):
+            return
+        
         # Check if user has reconnected recently
-        last_seen_key = f"last_seen_{self.room_name}_{self.user.username}"
-        last_seen = cache.get(last_seen_key, 0)
+        last_seen = await sync_to_async(presence.last_seen)(self.room_name, self.user.username)
         current_time = time.time()
         
         # If user hasn't been seen recently (no recent activity), remove them
-        if (current_time - last_seen) >= 3:  # No activity for 3+ seconds
-            cache_key = f"active_users_{self.room_name}"
-            active_users = cache.get(cache_key, {})
-            
-            if self.user.username in active_users:
-                del active_users[self.user.username]
-                cache.set(cache_key, active_users, 3600)
-                
+        if last_seen is not None and (current_time - last_seen) >= 3:  # No activity for 3+ seconds
+            if await sync_to_async(presence.leave)(self.room_name, self.user.username) is not None:
                 # Send leave notification
                 await self.channel_layer.group_send(
                     self.room_group_name,
-                    {
+                    encoded_event({
                         'type': 'user_leave',
                         'username': self.user.username,
                         'display_name': f"{self.user.first_name} {self.user.last_name}".strip() or self.user.username,
-                    }
+                    })
                 )
                 # Mark user offline in DB
                 await self._mark_offline_username(self.user.username)
@@ -206,17 +142,27 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 # Broadcast sound to room group
                 await self.channel_layer.group_send(
                     self.room_group_name,
-                    {
-                        'type': 'sound_message',
+                    encoded_event({
+                        'type': 'sound',
                         'sound_name': text_data_json.get('sound_name', 'Sound'),
                         'sound_emoji': text_data_json.get('sound_emoji', '🔊'),
                         'sound_url': text_data_json.get('sound_url', ''),
                         'username': username,
                         'display_name': display_name,
                         'timestamp': self.get_timestamp(),
-                    }
+                    })
                 )
                 return
+
+            # Handle reconnects that want the events missed since last_seq
+            if message_type == 'resume':
+                await self.resume(text_data_json.get('last_seq'))
+                return
+
+            # Handle scroll-back requests for older messages
+            if message_type == 'history':
+                await self.send_history(text_data_json.get('before'), text_data_json.get('limit'))
+                return
             
             # Handle regular chat messages
             message = text_data_json.get('message', '').strip()
@@ -242,21 +188,78 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 return
 
             # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'username': username,
-                    'display_name': display_name,
-                    'timestamp': self.get_timestamp(),
-                    'message_id': message_id
-                }
-            )
+            await self.broadcast_room_event({
+                'type': 'chat_message',
+                'message': message,
+                'username': username,
+                'display_name': display_name,
+                'timestamp': self.get_timestamp(),
+                'message_id': message_id
+            })
         except json.JSONDecodeError:
             # Invalid JSON, ignore
             pass
 
+    async def broadcast_room_event(self, payload):
+        """Sequence and log a replayable client payload, then send it to the room group"""
+        event = await sync_to_async(room_events.record)(self.room_name, payload)
+        await self.channel_layer.group_send(self.room_group_name, event)
+
+    async def resume(self, last_seq):
+        """Replay events missed while disconnected, or send a snapshot if the gap is too old"""
+        if not await self.check_room_access('resume'):
+            return
+        try:
+            last_seq = int(last_seq)
+        except (TypeError, ValueError):
+            last_seq = None
+        events, seq = await sync_to_async(room_events.since)(self.room_name, last_seq)
+        if events is None:
+            # Read the position before the snapshot so nothing newer is skipped
+            seq = await sync_to_async(room_events.current)(self.room_name)
+            page, next_cursor = await database_sync_to_async(recent_messages.page)(self.room_access['room_id'])
+            await self.send(text_data=json.dumps({
+                'type': 'resume_snapshot',
+                'seq': seq,
+                'messages': page,
+                'next_cursor': next_cursor,
+            }))
+            return
+        # Replay through the normal handlers so clients see identical payloads
+        for event in events:
+            await getattr(self, get_handler_name(event))(event)
+        await self.send(text_data=json.dumps({
+            'type': 'resume_complete',
+            'seq': seq,
+        }))
+
+    async def send_history(self, before, limit):
+        """Reply with one page of messages older than the given cursor"""
+        if not await self.check_room_access('history'):
+            return
+        try:
+            page, next_cursor = await self.load_history(before or None, clamp_page_size(limit))
+        except InvalidCursor:
+            await self.send(text_data=json.dumps({'type': 'error', 'request': 'history', 'message': 'Invalid history cursor'}))
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'history',
+            'messages': page,
+            'next_cursor': next_cursor,
+        }))
+
+    @database_sync_to_async
+    def load_history(self, before, limit):
+        if before is None:
+            # Newest page comes straight from the recent-message buffer
+            return recent_messages.page(self.room_access['room_id'])
+        page, next_cursor = fetch_room_history(self.room_access['room_id'], before=before, limit=limit)
+        return [serialize_message(message) for message in page], next_cursor
+
+    async def send_encoded(self, event):
+        """Forward a group event that was serialized once by the sender (see chat.fanout)"""
+        await self.send(text_data=event['text'])
+
     # Receive message from room group
     async def chat_message(self, event):
         message = event['message']
@@ -272,7 +275,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'username': username,
             'display_name': display_name,
             'timestamp': timestamp,
-            'message_id': message_id
+            'message_id': message_id,
+            'seq': event.get('seq'),
         }))
 
     # Handle user join event
@@ -342,6 +346,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         }))
         
         # Close the connection
+        self.room_access = None
         await self.close()
 
     # Handle message deletion event
@@ -353,7 +358,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         await self.send(text_data=json.dumps({
             'type': 'delete_message',
             'message_id': message_id,
-            'username': username
+            'username': username,
+            'seq': event.get('seq'),
         }))
 
     # Handle gift animation event
@@ -369,7 +375,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'gift_emoji': event['gift_emoji'],
             'animation': event['animation'],
             'intimacy_gained': event['intimacy_gained'],
-            'intimacy_total': event['intimacy_total']
+            'intimacy_total': event['intimacy_total'],
+            'seq': event.get('seq'),
         }))
 
     # Handle user kicked event
@@ -379,6 +386,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         
         # Check if this is the kicked user
         if self.user.username == username:
+            self._revoke_room_access()
             # Send kick notification and disconnect
             await self.send(text_data=json.dumps({
                 'type': 'user_kicked',
@@ -400,6 +408,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         
         # Check if this is the banned user
         if self.user.username == username:
+            self._revoke_room_access()
             # Send ban notification and disconnect
             await self.send(text_data=json.dumps({
                 'type': 'user_banned',
@@ -423,29 +432,59 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'message': event['message']
         }))
 
-    @database_sync_to_async
-    def check_room_exists(self):
-        try:
-            Room.objects.get(name=self.room_name)
-            return True
-        except Room.DoesNotExist:
+    async def room_access_changed(self, event):
+        """Drop cached authorization after a host kicks, bans, unbans or transfers ownership"""
+        username = event.get('username')
+        if username is None or username == self.user.username:
+            self.room_access = None
+
+    def _revoke_room_access(self):
+        if self.room_access is not None:
+            self.room_access = dict(self.room_access, allowed=False)
+
+    def _fetch_room_access(self):
+        """Load room ID plus membership and ban state for the connected user"""
+        room_id = Room.objects.filter(name=self.room_name).values_list('id', flat=True).first()
+        if room_id is None:
+            return None
+        is_banned = RoomBan.objects.filter(room_id=room_id, user=self.user, is_active=True).exists()
+        is_member = RoomMember.objects.filter(room_id=room_id, user=self.user).exists()
+        return {'room_id': room_id, 'allowed': is_member and not is_banned}
+
+    load_room_access = database_sync_to_async(_fetch_room_access)
+
+    async def check_room_access(self, request):
+        """
+        Reload a missing or negative cached authorization, as save_message does.
+        If access is denied, replies with an error naming the request and returns
+        False, so clients waiting on a reply are never left hanging.
+        """
+        if self.room_access is None or not self.room_access['allowed']:
+            self.room_access = await self.load_room_access()
+        if self.room_access is None or not self.room_access['allowed']:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'request': request,
+                'message': 'This room has been deleted or you no longer have access to it.',
+            }))
             return False
+        return True
 
     @database_sync_to_async
     def save_message(self, user, room_name, message):
-        try:
-            room = Room.objects.get(name=room_name)
-            # Check if user is banned from this room
-            if room.is_user_banned(user):
-                return None
-            # Check if user is still a member of the room (not kicked)
-            if not room.members.filter(user=user).exists():
+        # Steady state uses the cached authorization; only a missing or negative
+        # entry (e.g. just invalidated) goes back to the database.
+        if self.room_access is None or not self.room_access['allowed']:
+            self.room_access = self._fetch_room_access()
+            if self.room_access is None or not self.room_access['allowed']:
+                # Room no longer exists, user is banned or no longer a member
                 return None
-            msg = Message.objects.create(user=user, room=room, content=message)
-            return msg.id
-        except Room.DoesNotExist:
-            # Room no longer exists
-            return None
+        # Queue for batched write-behind; the ID is final and safe to broadcast now
+        timestamp = timezone.now()
+        room_id = self.room_access['room_id']
+        message_id = message_pipeline.submit(room_id=room_id, user_id=user.id, content=message, timestamp=timestamp)
+        recent_messages.append(room_id, Message(id=message_id, room_id=room_id, user=user, content=message, timestamp=timestamp))
+        return message_id
 
     def get_timestamp(self):
         from django.utils import timezone
@@ -970,7 +1009,8 @@ class Game2048Consumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def calculate_rewards(self, game_state):
         """Calculate Evercoin rewards for winner"""
-        from .models import UserProfile, GameSession
+        from .evercoin import ledger, REWARDS
+        from .models import GameSession
         
         # Base reward from score
         winner_score = game_state['player1_score'] if game_state['player1'] == self.user.username else game_state['player2_score']
@@ -985,20 +1025,22 @@ class Game2048Consumer(AsyncWebsocketConsumer):
         
         total_reward = base_reward + win_bonus + health_bonus
         
-        # Credit to winner
+        # Credit to winner (once per game, however many times the game-over message arrives)
         try:
-            profile, _ = UserProfile.objects.get_or_create(user=self.user)
-            profile.evercoin += total_reward
-            profile.save()
+            entry = ledger.credit(
+                self.user, total_reward, 'game_reward', REWARDS,
+                reference=f'game2048:{self.game_id}', idempotency_key=f'game2048:{self.game_id}',
+            )
             
             # Save game session for stats tracking
-            GameSession.objects.create(
-                user=self.user,
-                game_type='2048',
-                score=winner_score,
-                evercoin_earned=total_reward,
-                completed=True
-            )
+            if not entry.replayed:
+                GameSession.objects.create(
+                    user=self.user,
+                    game_type='2048',
+                    score=winner_score,
+                    evercoin_earned=total_reward,
+                    completed=True
+                )
         except Exception as e:
             print(f"Error saving game session: {e}")
             pass
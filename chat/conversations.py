@@ -0,0 +1,97 @@
+"""
+Private message conversations: the inbox and keyset chat history.
+
+Each pair of users has one Conversation row (see chat.models.Conversation)
+that is updated in the same transaction as every PrivateMessage it receives,
+so listing a user's conversations by recency never touches PrivateMessage.
+A user appears on either side of the canonical pair; the inbox reads the
+newest limit + 1 conversations from each side's (user, last_message_at, id)
+index and merges them, so a page costs O(page) at any inbox size.
+
+Chat history walks a conversation backwards on (timestamp, id) using the
+PrivateMessage (conversation, timestamp, id) index, with the same opaque
+cursors as room history (chat.history).
+"""
+
+from .history import HISTORY_PAGE_SIZE, encode_cursor, encode_position, older_than
+
+
+INBOX_PAGE_SIZE = 20
+MAX_INBOX_PAGE_SIZE = 50
+
+
+def clamp_inbox_page_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return INBOX_PAGE_SIZE
+    return max(1, min(limit, MAX_INBOX_PAGE_SIZE))
+
+
+def fetch_inbox(user, before=None, limit=INBOX_PAGE_SIZE):
+    """Return (conversations newest first, cursor for the next page or None)"""
+    from .models import Conversation
+
+    position = None
+    if before is not None:
+        position = older_than(before, 'last_message_at')
+
+    page = []
+    for side in ('user_low', 'user_high'):
+        queryset = (Conversation.objects
+                    .filter(**{side: user, 'last_message_at__isnull': False})
+                    .select_related('user_low', 'user_high', 'last_message')
+                    .order_by('-last_message_at', '-id'))
+        if position is not None:
+            queryset = queryset.filter(position)
+        page.extend(queryset[:limit + 1])
+
+    page.sort(key=lambda conversation: (conversation.last_message_at, conversation.id), reverse=True)
+    has_more = len(page) > limit
+    page = page[:limit]
+    next_cursor = encode_position(page[-1].last_message_at, page[-1].id) if has_more else None
+    return page, next_cursor
+
+
+def serialize_conversation(conversation, user):
+    other = conversation.user_high if user.id == conversation.user_low_id else conversation.user_low
+    last_message = conversation.last_message
+    return {
+        'conversation_id': conversation.id,
+        'username': other.username,
+        'display_name': f"{other.first_name} {other.last_name}".strip() or other.username,
+        'last_message': last_message.content[:100] if last_message else '',
+        'last_message_from_me': bool(last_message) and last_message.sender_id == user.id,
+        'last_message_at': conversation.last_message_at.isoformat(),
+        'unread_count': conversation.unread_for(user.id),
+    }
+
+
+def fetch_private_history(conversation_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """Return (messages oldest first, cursor for the next older page or None)"""
+    from .models import PrivateMessage
+
+    queryset = (PrivateMessage.objects
+                .filter(conversation_id=conversation_id)
+                .select_related('sender')
+                .order_by('-timestamp', '-id'))
+    if before is not None:
+        queryset = queryset.filter(older_than(before))
+
+    # Fetch one extra row to learn whether an older page exists
+    page = list(queryset[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    next_cursor = encode_cursor(page[-1]) if has_more else None
+    page.reverse()
+    return page, next_cursor
+
+
+def serialize_private_message(message):
+    """Same shape as the private chat_message WebSocket event"""
+    return {
+        'message_id': message.id,
+        'message': message.content,
+        'sender': message.sender.username,
+        'timestamp': message.timestamp.isoformat(),
+    }
@@ -0,0 +1,236 @@
+"""
+Evercoin ledger.
+
+Balances used to be changed by reading UserProfile.evercoin, adjusting it in
+Python and calling save(), so two concurrent gifts could both pass the balance
+check and the second save overwrote the first (and every save re-ran the
+avatar resize). All balance changes now go through this module:
+
+* A balance moves with one conditional UPDATE (evercoin = evercoin + delta,
+  and evercoin >= amount for debits), so concurrent changes can neither be
+  lost nor overdraw. On PostgreSQL and SQLite 3.35+ (UPDATE ... RETURNING)
+  the new balance comes back from the same statement.
+* Every change is journalled in EvercoinLedgerEntry, double-entry style: one
+  transaction's entries (the users' wallets plus a system account such as
+  "gifts" or "rewards") always sum to zero. Rows are only ever appended.
+* Callers may pass an idempotency key. A retried request with the same key
+  returns the original wallet entry (with entry.replayed set) instead of
+  moving coins twice, even when both attempts race: the key is unique in the
+  journal, so the second attempt's transaction rolls back.
+
+The `reconcile_evercoin` command checks balances against the journal.
+"""
+
+import uuid
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Sum
+
+from .metrics import metrics
+
+
+# System accounts on the other side of wallet entries
+GIFTS = 'gifts'
+REWARDS = 'rewards'
+GRANTS = 'grants'
+ADJUSTMENTS = 'adjustments'
+
+
+def update_returning_supported():
+    """Whether UPDATE ... RETURNING works: PostgreSQL and SQLite 3.35+, not MySQL or MariaDB
+
+    (can_return_columns_from_insert only covers INSERT, and MariaDB reports it.)
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+
+
+class EvercoinError(Exception):
+    pass
+
+
+class InsufficientEvercoin(EvercoinError):
+    def __init__(self, user_id, amount):
+        self.user_id = user_id
+        self.amount = amount
+        super().__init__(f'Not enough Evercoin for {amount:,}')
+
+
+class EvercoinLedger:
+    """Moves Evercoin between wallets and system accounts"""
+
+    def balance(self, user_id):
+        from .models import UserProfile
+
+        return UserProfile.objects.filter(user_id=user_id).values_list('evercoin', flat=True).first() or 0
+
+    def credit(self, user, amount, kind, account, **options):
+        """Add amount to the user's wallet from a system account; returns the wallet entry"""
+        return self.post({user.id: amount}, kind, account, **options)
+
+    def debit(self, user, amount, kind, account, **options):
+        """Move amount from the user's wallet to a system account; raises InsufficientEvercoin"""
+        return self.post({user.id: -amount}, kind, account, **options)
+
+    def transfer(self, sender, receiver, amount, kind='transfer', **options):
+        """Move amount between two wallets; returns the sender's entry"""
+        return self.post({sender.id: -amount, receiver.id: amount}, kind, None, **options)
+
+    def credit_many(self, user_ids, amount, kind, account, memo=''):
+        """Add the same amount to many wallets in one statement; returns the wallet entries"""
+        if amount <= 0:
+            raise EvercoinError('Amounts must be positive')
+        user_ids = sorted(set(user_ids))
+        if not user_ids:
+            return []
+        with transaction.atomic():
+            balances = self._apply(user_ids, amount)
+            entries = self._journal({user_id: amount for user_id in balances}, balances, kind, account, '', memo, None)
+        return entries[:len(balances)]
+
+    def post(self, changes, kind, account, reference='', memo='', idempotency_key=None):
+        """Apply {user_id: signed amount} wallet changes as one transaction, balanced by account
+
+        Returns the wallet entry of the first user in changes.
+        """
+        if any(amount == 0 for amount in changes.values()):
+            raise EvercoinError('Amounts must be non-zero')
+        if idempotency_key is not None:
+            idempotency_key = f'{kind}:{next(iter(changes))}:{idempotency_key}'
+
+        try:
+            with transaction.atomic():
+                balances = {}
+                # Lock rows in id order so opposite transfers cannot deadlock
+                for user_id in sorted(changes):
+                    balances.update(self._apply([user_id], changes[user_id]))
+                entries = self._journal(changes, balances, kind, account, reference, memo, idempotency_key)
+        except (IntegrityError, InsufficientEvercoin):
+            # The key is only looked up on failure: a request that already went through
+            # violates the key's unique constraint (or, for a debit, may now lack funds)
+            existing = self._replay(idempotency_key) if idempotency_key else None
+            if existing is None:
+                raise
+            return existing
+
+        metrics.incr('evercoin.transactions')
+        entry = entries[0]
+        entry.replayed = False
+        return entry
+
+    def _replay(self, idempotency_key):
+        from .models import EvercoinLedgerEntry
+
+        entry = EvercoinLedgerEntry.objects.filter(idempotency_key=idempotency_key).first()
+        if entry is not None:
+            entry.replayed = True
+            metrics.incr('evercoin.replayed')
+        return entry
+
+    def _apply(self, user_ids, delta):
+        """Add delta to the users' balances in one statement; returns {user_id: new balance}"""
+        from .models import UserProfile
+
+        balances = self._update(user_ids, delta)
+        missing = [user_id for user_id in user_ids if user_id not in balances]
+        if missing and delta > 0:
+            # Credits to users without a profile yet: create it and retry once
+            UserProfile.objects.bulk_create([UserProfile(user_id=user_id) for user_id in missing], ignore_conflicts=True)
+            balances.update(self._update(missing, delta))
+            missing = [user_id for user_id in user_ids if user_id not in balances]
+        if missing:
+            metrics.incr('evercoin.insufficient')
+            raise InsufficientEvercoin(missing[0], -delta)
+        return balances
+
+    def _update(self, user_ids, delta):
+        from .models import UserProfile
+
+        # Debits only match rows that can cover them, which makes the check and the write one step
+        guard = {'evercoin__gte': -delta} if delta < 0 else {}
+        if not update_returning_supported():
+            updated = UserProfile.objects.filter(user_id__in=user_ids, **guard).update(evercoin=F('evercoin') + delta)
+            if not updated:
+                return {}
+            return dict(UserProfile.objects.filter(user_id__in=user_ids).values_list('user_id', 'evercoin'))
+
+        quote = connection.ops.quote_name
+        sql = (
+            f'UPDATE {quote(UserProfile._meta.db_table)} SET {quote("evercoin")} = {quote("evercoin")} + %s '
+            f'WHERE {quote("user_id")} IN ({", ".join(["%s"] * len(user_ids))})'
+        )
+        params = [delta, *user_ids]
+        if guard:
+            sql += f' AND {quote("evercoin")} >= %s'
+            params.append(-delta)
+        sql += f' RETURNING {quote("user_id")}, {quote("evercoin")}'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return dict(cursor.fetchall())
+
+    def _journal(self, changes, balances, kind, account, reference, memo, idempotency_key):
+        from .models import EvercoinLedgerEntry
+
+        transaction_id = uuid.uuid4()
+        entries = [
+            EvercoinLedgerEntry(
+                transaction_id=transaction_id, user_id=user_id, amount=amount,
+                balance_after=balances[user_id], kind=kind, reference=reference, memo=memo,
+            )
+            for user_id, amount in changes.items()
+        ]
+        entries[0].idempotency_key = idempotency_key
+        total = sum(changes.values())
+        if total:
+            entries.append(EvercoinLedgerEntry(
+                transaction_id=transaction_id, account=account, amount=-total,
+                kind=kind, reference=reference, memo=memo,
+            ))
+        EvercoinLedgerEntry.objects.bulk_create(entries)
+        return entries
+
+    # ---- reconciliation --------------------------------------------------
+
+    def reconcile(self, fix=False):
+        """Compare balances with the journal; returns (mismatched {user_id: (balance, journal)}, unbalanced transaction ids)
+
+        With fix, each mismatch gets an adjustment entry against the
+        "adjustments" account so the journal explains the current balance
+        (balances are never changed here).
+        """
+        from .models import EvercoinLedgerEntry, UserProfile
+
+        wallets = EvercoinLedgerEntry.objects.filter(account='wallet', user__isnull=False)
+        journal = dict(wallets.values_list('user_id').annotate(total=Sum('amount')).order_by())
+        mismatched = {}
+        for user_id, balance in UserProfile.objects.values_list('user_id', 'evercoin').iterator():
+            total = journal.get(user_id, 0)
+            if balance != total:
+                mismatched[user_id] = (balance, total)
+
+        unbalanced = list(
+            EvercoinLedgerEntry.objects.values_list('transaction_id', flat=True)
+            .annotate(total=Sum('amount')).exclude(total=0).order_by()
+        )
+
+        if fix and mismatched:
+            transaction_id = uuid.uuid4()
+            entries = [
+                EvercoinLedgerEntry(
+                    transaction_id=transaction_id, user_id=user_id, amount=balance - total,
+                    balance_after=balance, kind='adjustment',
+                )
+                for user_id, (balance, total) in mismatched.items()
+            ]
+            entries.append(EvercoinLedgerEntry(
+                transaction_id=transaction_id, account=ADJUSTMENTS,
+                amount=-sum(entry.amount for entry in entries), kind='adjustment',
+            ))
+            EvercoinLedgerEntry.objects.bulk_create(entries, batch_size=1000)
+        metrics.incr('evercoin.reconcile_mismatches', len(mismatched))
+        return mismatched, unbalanced
+
+
+# Shared ledger
+ledger = EvercoinLedger()
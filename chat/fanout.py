@@ -0,0 +1,53 @@
+"""
+Encode-once fan-out for chat room group events.
+
+A group_send is delivered to every consumer in the group, and each consumer
+used to rebuild the client payload and json.dumps it, so a room with N open
+sockets encoded every event N times. Events built with encoded_event() carry
+the client payload already serialized, and ChatConsumer.send_encoded forwards
+the text untouched.
+
+The JSON codec is picked by the CHAT_JSON_CODEC setting: 'json' (standard
+library), 'orjson' (requires `pip install orjson`) or 'auto' (orjson when it
+is installed, otherwise json).
+"""
+
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+ENCODED_EVENT_TYPE = 'send.encoded'
+
+
+def _json_dumps(payload):
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def _orjson_dumps(payload):
+    return orjson.dumps(payload).decode()
+
+
+def get_codec(name=None):
+    """Return the dumps function for a codec name ('auto', 'json' or 'orjson')"""
+    name = name or getattr(settings, 'CHAT_JSON_CODEC', 'auto')
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ImportError("CHAT_JSON_CODEC is 'orjson' but orjson is not installed")
+        return _orjson_dumps
+    return _json_dumps
+
+
+def dumps(payload):
+    """Serialize a client payload with the configured codec"""
+    return get_codec()(payload)
+
+
+def encoded_event(payload):
+    """Group event that carries the client payload pre-serialized"""
+    return {'type': ENCODED_EVENT_TYPE, 'text': dumps(payload)}
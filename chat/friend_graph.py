@@ -0,0 +1,183 @@
+"""
+Cached friendship graph.
+
+Friendship.are_friends used to run an OR query over both directions of the
+Friendship table on every private chat connect, message and page view, and
+the index, friends list and profile pages repeated similar scans. Each user's
+relationships are now cached as one entry holding four maps of
+{other user id: Friendship id}:
+
+    accepted  - friends
+    incoming  - pending requests the user received
+    outgoing  - pending requests the user sent
+    blocked   - blocked relationships in either direction
+
+An entry is built lazily from one Friendship query the first time it is read
+and dropped for both users whenever a Friendship row is saved or deleted (see
+the signal handlers in chat.models), so the hot-path checks are dict lookups.
+Declined requests appear in no map. Maps keep the Friendship default ordering
+(newest first).
+
+FriendsOverview turns a user's entry into the users and requests the index,
+friends list and profile pages render, in a fixed number of queries however
+many friends there are.
+
+Configure via the FRIEND_GRAPH setting:
+
+    FRIEND_GRAPH = {
+        'TIMEOUT': 3600,
+    }
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils.functional import SimpleLazyObject, cached_property
+
+from .metrics import metrics
+
+
+DEFAULT_FRIEND_GRAPH = {
+    'TIMEOUT': 3600,  # Seconds before an entry is rebuilt from the database
+}
+
+RELATIONS = ('accepted', 'incoming', 'outgoing', 'blocked')
+
+
+class FriendGraph:
+    """Per-user friend sets cached from the Friendship table"""
+
+    def __init__(self, timeout=3600, key_prefix='friends'):
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _key(self, user_id):
+        return f'{self.key_prefix}:{user_id}'
+
+    def relations(self, user_id):
+        """Return {relation: {other user id: Friendship id}} for every relation in RELATIONS"""
+        key = self._key(user_id)
+        relations = cache.get(key)
+        if relations is not None:
+            metrics.incr('friend_graph.hits')
+            return relations
+        from .models import Friendship
+
+        metrics.incr('friend_graph.misses')
+        relations = {relation: {} for relation in RELATIONS}
+        rows = Friendship.objects.filter(
+            Q(sender_id=user_id) | Q(receiver_id=user_id)
+        ).values_list('id', 'sender_id', 'receiver_id', 'status')
+        for friendship_id, sender_id, receiver_id, status in rows:
+            other_id = receiver_id if sender_id == user_id else sender_id
+            if status == 'pending':
+                relation = 'outgoing' if sender_id == user_id else 'incoming'
+            elif status in ('accepted', 'blocked'):
+                relation = status
+            else:
+                continue
+            relations[relation][other_id] = friendship_id
+        cache.add(key, relations, self.timeout)
+        return relations
+
+    def friend_ids(self, user_id):
+        return self.relations(user_id)['accepted']
+
+    def are_friends(self, user_id, other_id):
+        return other_id in self.relations(user_id)['accepted']
+
+    def relation(self, user_id, other_id):
+        """The relation other_id has in user_id's graph ('accepted', 'incoming', ...) or None"""
+        relations = self.relations(user_id)
+        for relation in RELATIONS:
+            if other_id in relations[relation]:
+                return relation
+        return None
+
+    def invalidate(self, *user_ids):
+        """Drop the users' entries now and again once the current transaction commits"""
+        keys = [self._key(user_id) for user_id in user_ids]
+        cache.delete_many(keys)
+        # A read inside the writing transaction's lifetime could re-cache the old rows
+        transaction.on_commit(lambda: cache.delete_many(keys))
+        metrics.incr('friend_graph.invalidations', len(keys))
+
+
+class FriendsOverview:
+    """A user's friends, pending requests and blocked users, loaded on first access
+
+    Friends and blocked users come from one User query and the pending
+    requests from one Friendship query, with profiles attached (missing
+    profiles are created in bulk); counts need no query beyond the graph.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def relations(self):
+        return friend_graph.relations(self.user.id)
+
+    @property
+    def friend_count(self):
+        return len(self.relations['accepted'])
+
+    @cached_property
+    def _users(self):
+        from django.contrib.auth.models import User
+        from .models import UserProfile
+
+        user_ids = list(self.relations['accepted']) + list(self.relations['blocked'])
+        if not user_ids:
+            return {}
+        users = User.objects.filter(id__in=user_ids).select_related('profile').in_bulk()
+        UserProfile.ensure_for(users.values())
+        return users
+
+    @cached_property
+    def _requests(self):
+        from .models import Friendship, UserProfile
+
+        request_ids = list(self.relations['incoming'].values()) + list(self.relations['outgoing'].values())
+        if not request_ids:
+            return {}
+        requests = Friendship.objects.filter(id__in=request_ids).select_related(
+            'sender__profile', 'receiver__profile'
+        ).in_bulk()
+        UserProfile.ensure_for(
+            [request.sender for request in requests.values()] + [request.receiver for request in requests.values()]
+        )
+        return requests
+
+    def _users_in(self, relation):
+        return [self._users[user_id] for user_id in self.relations[relation] if user_id in self._users]
+
+    def _requests_in(self, relation):
+        return [self._requests[friendship_id] for friendship_id in self.relations[relation].values()
+                if friendship_id in self._requests]
+
+    @property
+    def friends(self):
+        return self._users_in('accepted')
+
+    @property
+    def blocked_users(self):
+        return self._users_in('blocked')
+
+    @property
+    def incoming_requests(self):
+        return self._requests_in('incoming')
+
+    @property
+    def outgoing_requests(self):
+        return self._requests_in('outgoing')
+
+
+def create_friend_graph(config=None):
+    config = dict(DEFAULT_FRIEND_GRAPH, **(config or getattr(settings, 'FRIEND_GRAPH', {})))
+    return FriendGraph(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared graph instance, created on first use
+friend_graph = SimpleLazyObject(create_friend_graph)
@@ -0,0 +1,254 @@
+"""
+Buffered GIF activity: view counters, usage logs and trending scores.
+
+send_gif used to insert a GifUsageLog row and then save() GifFile.views on
+every send, so a popular GIF's row took a write per send and trending was
+"most views ever". Sends and views are now buffered per process:
+
+* record_send() / record_view() only touch in-memory counters and return.
+* A background thread flushes every FLUSH_INTERVAL_MS (or once MAX_BATCH
+  usage logs are waiting) in one transaction: a bulk_create of the usage
+  logs, one UPDATE ... SET views = views + n per distinct n, and the
+  GifTrending roll-up for every GIF touched.
+* GifTrending holds a time-decayed score per GIF, kept with forward decay:
+  an event at time t adds 2 ** ((t - TRENDING_EPOCH) / HALF_LIFE), so older
+  activity is worth half as much per half-life, and scores recorded at
+  different times can be compared without rewriting them. Scores are stored
+  as log2 of that sum, so they never overflow, and trending is an index scan
+  on -score.
+
+A hard crash loses at most one flush interval of counts; stop() (registered
+with atexit) flushes on shutdown.
+
+Configure via the GIF_ACTIVITY setting:
+
+    GIF_ACTIVITY = {
+        'ENABLED': True,  # False writes each send/view immediately
+        'FLUSH_INTERVAL_MS': 2000,
+        'MAX_BATCH': 500,
+        'HALF_LIFE_HOURS': 24,
+    }
+"""
+
+import atexit
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import metrics
+
+
+DEFAULT_GIF_ACTIVITY = {
+    'ENABLED': True,  # False writes each send/view immediately
+    'FLUSH_INTERVAL_MS': 2000,  # Longest a count waits before it is written
+    'MAX_BATCH': 500,  # Flush early once this many usage logs are queued
+    'HALF_LIFE_HOURS': 24,  # Trending activity loses half its weight per half-life
+}
+
+# Forward decay reference point; scores are log2 weights relative to it
+TRENDING_EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def log2_add(a, b):
+    """log2(2**a + 2**b) without overflow; None is an empty sum"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+class GifActivity:
+    """Aggregates GIF sends and views in memory and writes them in batches"""
+
+    def __init__(self, enabled=True, flush_interval_ms=2000, max_batch=500, half_life_hours=24):
+        self.enabled = enabled
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch = max_batch
+        self.half_life = half_life_hours * 3600.0
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._views = Counter()
+        self._weights = {}
+        self._usage = []
+        self._thread = None
+        self._stopping = False
+
+    # ---- scores ----------------------------------------------------------
+
+    def weight(self, at):
+        """log2 weight of one event at time at"""
+        return (at - TRENDING_EPOCH).total_seconds() / self.half_life
+
+    def current(self, score, now=None):
+        """A stored score as decayed activity at now (events' weight after decay)"""
+        return 2 ** (score - self.weight(now or timezone.now()))
+
+    # ---- producer side -----------------------------------------------------
+
+    def record_send(self, gif, user, room, message_text=''):
+        """Count a GIF sent to a room (a usage log plus a view)"""
+        from .models import GifUsageLog
+
+        usage = GifUsageLog(gif_id=gif.id, user_id=user.id, room_id=room.id, message_text=message_text)
+        self._record(gif.id, usage)
+
+    def record_view(self, gif_id):
+        self._record(gif_id, None)
+
+    def _record(self, gif_id, usage):
+        weight = self.weight(timezone.now())
+        if not self.enabled:
+            self._write(Counter({gif_id: 1}), {gif_id: weight}, [usage] if usage else [])
+            return
+
+        self._ensure_started()
+        with self._lock:
+            self._views[gif_id] += 1
+            self._weights[gif_id] = log2_add(self._weights.get(gif_id), weight)
+            if usage is not None:
+                self._usage.append(usage)
+                if len(self._usage) >= self.max_batch:
+                    self._wakeup.notify()
+        metrics.incr('gifs.activity.recorded')
+
+    def flush(self):
+        """Synchronously write everything buffered so far (call from sync code only)"""
+        self._write_and_settle(self._take())
+
+    # ---- background writer -----------------------------------------------
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='gif-activity', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _take(self):
+        with self._lock:
+            batch = (self._views, self._weights, self._usage)
+            self._views, self._weights, self._usage = Counter(), {}, []
+        return batch
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._usage) < self.max_batch and not self._stopping:
+                    self._wakeup.wait(self.flush_interval)
+                stopping = self._stopping
+            self._write_and_settle(self._take())
+            if stopping:
+                return
+
+    def _write_and_settle(self, batch):
+        views, weights, usage = batch
+        if not views:
+            return
+        try:
+            close_old_connections()
+            self._write(views, weights, usage)
+        except Exception as e:
+            # Merge the batch back so the next flush retries it
+            print(f'[GIFS] Flush of {len(views)} GIF(s) failed: {e}')
+            metrics.incr('gifs.activity.flush_errors')
+            with self._lock:
+                self._views.update(views)
+                for gif_id, weight in weights.items():
+                    self._weights[gif_id] = log2_add(self._weights.get(gif_id), weight)
+                self._usage = usage + self._usage
+            time.sleep(self.flush_interval)
+
+    def _write(self, views, weights, usage):
+        from .models import GifFile, Room
+        from django.contrib.auth.models import User
+
+        started = time.perf_counter()
+        try:
+            self._apply(views, weights, usage)
+        except IntegrityError:
+            # A GIF, room or user was deleted while its activity was buffered: drop that activity
+            gif_ids = set(GifFile.objects.filter(id__in=list(views)).values_list('id', flat=True))
+            room_ids = set(Room.objects.filter(id__in={u.room_id for u in usage}).values_list('id', flat=True))
+            user_ids = set(User.objects.filter(id__in={u.user_id for u in usage}).values_list('id', flat=True))
+            views = Counter({gif_id: n for gif_id, n in views.items() if gif_id in gif_ids})
+            weights = {gif_id: weight for gif_id, weight in weights.items() if gif_id in gif_ids}
+            usage = [u for u in usage if u.gif_id in gif_ids and u.room_id in room_ids and u.user_id in user_ids]
+            # Retrying also settles a GifTrending row another process created meanwhile
+            self._apply(views, weights, usage)
+        metrics.observe('gifs.activity.flush_seconds', time.perf_counter() - started)
+        metrics.incr('gifs.activity.written', sum(views.values()))
+
+    def _apply(self, views, weights, usage):
+        from .models import GifFile, GifTrending, GifUsageLog
+
+        now = timezone.now()
+        by_count = defaultdict(list)
+        for gif_id, count in views.items():
+            by_count[count].append(gif_id)
+
+        with transaction.atomic():
+            GifUsageLog.objects.bulk_create(usage, batch_size=self.max_batch)
+            for count, gif_ids in by_count.items():
+                GifFile.objects.filter(id__in=gif_ids).update(views=F('views') + count)
+
+            rows = GifTrending.objects.select_for_update().in_bulk(list(weights))
+            created = []
+            for gif_id, weight in weights.items():
+                row = rows.get(gif_id)
+                if row is None:
+                    created.append(GifTrending(gif_id=gif_id, score=weight, views=views[gif_id], updated_at=now))
+                else:
+                    row.score = log2_add(row.score, weight)
+                    row.views += views[gif_id]
+                    row.updated_at = now
+            GifTrending.objects.bulk_update(rows.values(), ['score', 'views', 'updated_at'], batch_size=self.max_batch)
+            GifTrending.objects.bulk_create(created, batch_size=self.max_batch)
+
+    def stop(self):
+        """Flush remaining activity and stop the writer thread"""
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    # ---- reading -----------------------------------------------------------
+
+    def trending(self, limit=10):
+        """Active GIFs with the highest decayed activity, with their packs; each has .trending_score"""
+        from .models import GifTrending
+
+        now = timezone.now()
+        rows = (GifTrending.objects
+                .filter(gif__is_active=True)
+                .select_related('gif__pack')
+                .order_by('-score')[:limit])
+        gifs = []
+        for row in rows:
+            row.gif.trending_score = self.current(row.score, now)
+            gifs.append(row.gif)
+        return gifs
+
+
+def create_gif_activity(config=None):
+    config = dict(DEFAULT_GIF_ACTIVITY, **(config or getattr(settings, 'GIF_ACTIVITY', {})))
+    return GifActivity(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared buffer, created on first use
+gif_activity = SimpleLazyObject(create_gif_activity)
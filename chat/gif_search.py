@@ -0,0 +1,360 @@
+"""
+GIF search index.
+
+search_gifs used to run title__icontains OR tags__icontains over every GIF and
+sort the matches by views: a full scan with LIKE '%q%' on each keystroke that
+no index can serve, followed by a pack query per result.
+
+GIFs are now indexed into two tables that work the same on SQLite and
+PostgreSQL:
+
+* GifSearchTerm, the vocabulary: each distinct token of a GIF's title, tags
+  and category, with the number of GIFs containing it.
+* GifSearchPosting, one row per (term, GIF) carrying the term's BM25 weight in
+  that GIF ("impact": field-weighted frequency, saturated by K1 and
+  normalized by GIF length with B). Postings are indexed on
+  (term, -impact), so a term's best GIFs are read with LIMIT.
+
+A query is tokenized the same way. The last word is a prefix while the user
+is still typing it, expanded to the vocabulary's most common completions
+with one index range scan. Each term contributes IDF x impact from its top
+POSTINGS_PER_TERM postings; GIFs matching more of the query's words rank
+first, then by relevance plus POPULARITY_WEIGHT x log(1 + views). A query
+therefore costs a fixed number of short index seeks whatever the catalog
+size.
+
+GIFs are re-indexed after the transaction that saves them commits (view count
+updates are skipped), and removed when deleted. `rebuild_gif_search`
+rebuilds the whole index; `bench_gif_search` times typeahead at scale.
+
+Configure via the GIF_SEARCH setting:
+
+    GIF_SEARCH = {
+        'FIELD_WEIGHTS': {'title': 2.0, 'tags': 3.0, 'category': 1.0},
+        'POPULARITY_WEIGHT': 0.3,
+        'PREFIX_EXPANSIONS': 8,
+        'POSTINGS_PER_TERM': 200,
+    }
+"""
+
+import math
+import re
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import metrics
+
+
+DEFAULT_GIF_SEARCH = {
+    'FIELD_WEIGHTS': {'title': 2.0, 'tags': 3.0, 'category': 1.0},  # Term frequency weight per field
+    'K1': 1.2,  # BM25 term frequency saturation
+    'B': 0.75,  # BM25 length normalization
+    'POPULARITY_WEIGHT': 0.3,  # Added per unit of log(1 + views)
+    'PREFIX_EXPANSIONS': 8,  # Most common completions tried for a word being typed
+    'POSTINGS_PER_TERM': 200,  # Highest-impact GIFs read per term
+    'MAX_WORDS': 6,  # Query words considered
+    'STATS_TIMEOUT': 3600,  # Seconds the catalog size and average length are cached
+}
+
+SEARCH_FIELDS = ('title', 'tags', 'category')
+
+# Saving any of these re-indexes the GIF
+INDEXED_FIELDS = frozenset(SEARCH_FIELDS + ('is_active',))
+
+TOKEN_RE = re.compile(r'\w+')
+MAX_TERM_LENGTH = 64
+
+
+def tokenize(text):
+    """Lowercased word tokens; tags are comma-separated, so commas split like spaces"""
+    return [token for token in TOKEN_RE.findall(text.casefold()) if len(token) <= MAX_TERM_LENGTH]
+
+
+class GifSearch:
+    """Ranked, prefix-aware GIF search over an inverted index"""
+
+    def __init__(self, field_weights=None, k1=1.2, b=0.75, popularity_weight=0.3,
+                 prefix_expansions=8, postings_per_term=200, max_words=6, stats_timeout=3600):
+        self.field_weights = dict(DEFAULT_GIF_SEARCH['FIELD_WEIGHTS'], **(field_weights or {}))
+        self.k1 = k1
+        self.b = b
+        self.popularity_weight = popularity_weight
+        self.prefix_expansions = prefix_expansions
+        self.postings_per_term = postings_per_term
+        self.max_words = max_words
+        self.stats_timeout = stats_timeout
+
+    # ---- querying ----------------------------------------------------------
+
+    def search(self, query, limit=20):
+        """Active GIFs matching query, best first, with the pack selected; each has .search_score"""
+        from .models import GifFile
+
+        words = tokenize(query)[:self.max_words]
+        if not words:
+            return []
+        # The last word is still being typed unless the query ends in a separator
+        typing = query[-1:].isalnum()
+        slots = self._expand(words, typing)
+
+        # Each word reads POSTINGS_PER_TERM postings, shared among a prefix's completions
+        slot_of = {}
+        depth = {}
+        for slot, terms in enumerate(slots):
+            for term_id in terms:
+                slot_of[term_id] = slot
+                depth[term_id] = max(self.postings_per_term // len(terms), limit)
+
+        # Best contribution per (word, GIF): a prefix's completions don't add up
+        best = [defaultdict(float) for _ in slots]
+        for term_id, gif_id, impact in self._postings(depth):
+            slot = slot_of[term_id]
+            score = slots[slot][term_id] * impact
+            if score > best[slot][gif_id]:
+                best[slot][gif_id] = score
+
+        matched = Counter()
+        relevance = defaultdict(float)
+        for scores in best:
+            for gif_id, score in scores.items():
+                matched[gif_id] += 1
+                relevance[gif_id] += score
+        if not relevance:
+            metrics.incr('gif_search.empty')
+            return []
+
+        # Popularity only reorders the most relevant candidates
+        candidates = sorted(relevance, key=lambda gif_id: (matched[gif_id], relevance[gif_id]), reverse=True)
+        scores = {
+            gif_id: relevance[gif_id] + self.popularity_weight * math.log1p(max(views, 0))
+            for gif_id, views in self._views(candidates[:limit * 5])
+        }
+        ranked = sorted(scores, key=lambda gif_id: (matched[gif_id], scores[gif_id]), reverse=True)[:limit]
+        gifs = GifFile.objects.select_related('pack').order_by().in_bulk(ranked)
+        results = []
+        for gif_id in ranked:
+            if gif_id in gifs:
+                gifs[gif_id].search_score = scores[gif_id]
+                results.append(gifs[gif_id])
+        metrics.incr('gif_search.queries')
+        return results
+
+    def _expand(self, words, typing):
+        """[{term_id: idf}] per query word"""
+        from .models import GifSearchTerm
+
+        documents = self.document_count()
+        exact = words[:-1] if typing else words
+        # The word being typed is looked up too: it may already be complete
+        found = {
+            term: (term_id, doc_count) for term, term_id, doc_count in
+            GifSearchTerm.objects.filter(term__in=set(words), doc_count__gt=0).values_list('term', 'id', 'doc_count')
+        }
+        slots = []
+        for word in exact:
+            slots.append(dict([self._weigh(*found[word], documents)]) if word in found else {})
+        if typing:
+            prefix = words[-1]
+            # The exact term always takes part; more common completions fill the remaining expansions
+            expansions = dict([self._weigh(*found[prefix], documents)]) if prefix in found else {}
+            remaining = self.prefix_expansions - len(expansions)
+            if remaining > 0:
+                completions = (GifSearchTerm.objects
+                               .filter(self._prefix_filter(prefix), doc_count__gt=0)
+                               .exclude(term=prefix)
+                               .order_by('-doc_count')
+                               .values_list('id', 'doc_count')[:remaining])
+                expansions.update(self._weigh(term_id, doc_count, documents) for term_id, doc_count in completions)
+            slots.append(expansions)
+        return slots
+
+    def _prefix_filter(self, prefix):
+        if connection.vendor == 'postgresql':
+            # LIKE 'prefix%' uses the varchar_pattern_ops index Django adds for the unique term
+            return Q(term__startswith=prefix)
+        # A range is an index seek (SQLite's LIKE is case-insensitive and can't use the index)
+        return Q(term__gte=prefix, term__lt=prefix + '\U0010ffff')
+
+    def _weigh(self, term_id, doc_count, documents):
+        idf = math.log(1 + (documents - doc_count + 0.5) / (doc_count + 0.5))
+        return term_id, idf
+
+    def _postings(self, depth):
+        """(term_id, gif_id, impact) for the top depth[term_id] postings of each term, in one statement"""
+        from .models import GifSearchPosting
+
+        if not depth:
+            return []
+        quote = connection.ops.quote_name
+        table = quote(GifSearchPosting._meta.db_table)
+        # Each branch is a LIMITed index range scan on (term, -impact)
+        branch = (
+            f'SELECT * FROM (SELECT {quote("term_id")}, {quote("gif_id")}, {quote("impact")} FROM {table} '
+            f'WHERE {quote("term_id")} = %s ORDER BY {quote("impact")} DESC LIMIT %s) AS t{{}}'
+        )
+        sql = ' UNION ALL '.join(branch.format(n) for n in range(len(depth)))
+        params = [value for term_id, count in depth.items() for value in (term_id, count)]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def _views(self, gif_ids):
+        """(gif_id, views) of the active GIFs among gif_ids"""
+        from .models import GifFile
+
+        quote = connection.ops.quote_name
+        sql = (
+            f'SELECT {quote("id")}, {quote("views")} FROM {quote(GifFile._meta.db_table)} '
+            f'WHERE {quote("id")} IN ({", ".join(["%s"] * len(gif_ids))}) AND {quote("is_active")}'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, gif_ids)
+            return cursor.fetchall()
+
+    # ---- catalog statistics --------------------------------------------------
+
+    def document_count(self):
+        from .models import GifFile
+
+        return cache.get_or_set(
+            'gif_search:documents', lambda: GifFile.objects.filter(is_active=True).count(), self.stats_timeout
+        )
+
+    def average_length(self):
+        from .models import GifSearchPosting
+
+        def compute():
+            total = GifSearchPosting.objects.aggregate(total=Sum('frequency'))['total'] or 0
+            return total / max(self.document_count(), 1) or 1.0
+        return cache.get_or_set('gif_search:average_length', compute, self.stats_timeout)
+
+    # ---- indexing ------------------------------------------------------------
+
+    def frequencies(self, fields):
+        """{term: field-weighted frequency} for a GIF's {field: text}"""
+        frequencies = Counter()
+        for field in SEARCH_FIELDS:
+            weight = self.field_weights.get(field, 0)
+            if weight:
+                for token in tokenize(fields.get(field) or ''):
+                    frequencies[token] += weight
+        return frequencies
+
+    def impact(self, frequency, length, average_length):
+        norm = self.k1 * (1 - self.b + self.b * length / average_length)
+        return frequency * (self.k1 + 1) / (frequency + norm)
+
+    def submit(self, gif_id):
+        """Re-index a GIF once the current transaction commits"""
+        transaction.on_commit(lambda: self.index(gif_id))
+
+    def index(self, gif_id):
+        """Replace a GIF's postings (none when it is inactive or gone)"""
+        from .models import GifFile, GifSearchPosting
+
+        fields = GifFile.objects.filter(pk=gif_id, is_active=True).values(*SEARCH_FIELDS).first()
+        frequencies = self.frequencies(fields) if fields else {}
+        average_length = self.average_length()
+        with transaction.atomic():
+            self.remove(gif_id)
+            if not frequencies:
+                return
+            term_ids = self._term_ids(frequencies)
+            self._count(term_ids.values(), 1)
+            length = sum(frequencies.values())
+            GifSearchPosting.objects.bulk_create([
+                GifSearchPosting(
+                    term_id=term_ids[term], gif_id=gif_id, frequency=frequency,
+                    impact=self.impact(frequency, length, average_length),
+                )
+                for term, frequency in frequencies.items()
+            ])
+        metrics.incr('gif_search.indexed')
+
+    def remove(self, gif_id):
+        """Drop a GIF's postings and release its terms' document counts"""
+        from .models import GifSearchPosting
+
+        postings = GifSearchPosting.objects.filter(gif_id=gif_id)
+        term_ids = list(postings.values_list('term_id', flat=True))
+        if term_ids:
+            postings.delete()
+            self._count(term_ids, -1)
+
+    def _term_ids(self, terms):
+        from .models import GifSearchTerm
+
+        GifSearchTerm.objects.bulk_create([GifSearchTerm(term=term) for term in terms], ignore_conflicts=True)
+        return dict(GifSearchTerm.objects.filter(term__in=list(terms)).values_list('term', 'id'))
+
+    def _count(self, term_ids, delta):
+        from .models import GifSearchTerm
+
+        GifSearchTerm.objects.filter(id__in=list(term_ids)).update(doc_count=F('doc_count') + delta)
+
+    def rebuild(self, batch_size=5000, progress=None):
+        """Re-index every active GIF from scratch; returns (GIFs, terms)"""
+        from .models import GifFile, GifSearchPosting, GifSearchTerm
+
+        rows = GifFile.objects.filter(is_active=True).values('id', *SEARCH_FIELDS).order_by()
+        quote = connection.ops.quote_name
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {quote(GifSearchPosting._meta.db_table)}')
+                cursor.execute(f'DELETE FROM {quote(GifSearchTerm._meta.db_table)}')
+
+            # Pass 1: document frequencies and the average length the impacts are normalized by
+            documents = 0
+            total_length = 0
+            doc_counts = Counter()
+            for row in rows.iterator(chunk_size=batch_size):
+                frequencies = self.frequencies(row)
+                documents += 1
+                total_length += sum(frequencies.values())
+                doc_counts.update(frequencies.keys())
+            average_length = total_length / max(documents, 1) or 1.0
+
+            GifSearchTerm.objects.bulk_create(
+                [GifSearchTerm(term=term, doc_count=count) for term, count in doc_counts.items()],
+                batch_size=batch_size,
+            )
+            term_ids = dict(GifSearchTerm.objects.values_list('term', 'id'))
+
+            # Pass 2: postings
+            postings = []
+            indexed = 0
+            for row in rows.iterator(chunk_size=batch_size):
+                frequencies = self.frequencies(row)
+                length = sum(frequencies.values())
+                postings.extend(
+                    GifSearchPosting(
+                        term_id=term_ids[term], gif_id=row['id'], frequency=frequency,
+                        impact=self.impact(frequency, length, average_length),
+                    )
+                    for term, frequency in frequencies.items()
+                )
+                indexed += 1
+                if len(postings) >= batch_size:
+                    GifSearchPosting.objects.bulk_create(postings, batch_size=batch_size)
+                    postings = []
+                    if progress:
+                        progress(indexed, documents)
+            GifSearchPosting.objects.bulk_create(postings, batch_size=batch_size)
+
+        cache.set('gif_search:documents', documents, self.stats_timeout)
+        cache.set('gif_search:average_length', average_length, self.stats_timeout)
+        return documents, len(term_ids)
+
+
+def create_gif_search(config=None):
+    config = dict(DEFAULT_GIF_SEARCH, **(config or getattr(settings, 'GIF_SEARCH', {})))
+    return GifSearch(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared search index, created on first use
+gif_search = SimpleLazyObject(create_gif_search)
@@ -0,0 +1,100 @@
+"""
+Keyset pagination over room message history.
+
+Pages walk backwards through a room on (timestamp, id), which the composite
+Message index on (room, timestamp, id) serves directly, so fetching a page
+costs the same at any depth. Cursors are opaque strings that encode the
+(timestamp, id) of the oldest message on the previous page.
+"""
+
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+from .message_pipeline import message_pipeline
+
+
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_position(timestamp, row_id):
+    raw = f'{timestamp.isoformat()}|{row_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def encode_cursor(message):
+    return encode_position(message.timestamp, message.id)
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, message_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor('Invalid history cursor')
+
+
+def older_than(cursor, field='timestamp'):
+    """Filter for rows before a cursor's position in (field, id) descending order
+
+    The redundant field bound turns the OR into an index range seek instead of
+    a walk down from the newest row (which would make deep pages O(depth)).
+    """
+    timestamp, row_id = decode_cursor(cursor)
+    return Q(
+        Q(**{f'{field}__lt': timestamp}) | Q(**{field: timestamp, 'id__lt': row_id}),
+        **{f'{field}__lte': timestamp},
+    )
+
+
+def clamp_page_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return HISTORY_PAGE_SIZE
+    return max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+
+
+def fetch_room_history(room_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """Return (messages oldest first, cursor for the next older page or None)"""
+    from .models import Message
+
+    if before is None:
+        # The newest page may include messages the pipeline has not written yet
+        message_pipeline.flush()
+
+    queryset = (Message.objects
+                .filter(room_id=room_id)
+                .select_related('user')
+                .order_by('-timestamp', '-id'))
+    if before is not None:
+        queryset = queryset.filter(older_than(before))
+
+    # Fetch one extra row to learn whether an older page exists
+    page = list(queryset[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    next_cursor = encode_cursor(page[-1]) if has_more else None
+    page.reverse()
+    # Deleted messages still count towards the page so cursors stay stable
+    return [message for message in page if not message.is_deleted], next_cursor
+
+
+def serialize_message(message):
+    """Same shape as the chat_message WebSocket event"""
+    user = message.user
+    return {
+        'message_id': message.id,
+        'message': message.content,
+        'username': user.username,
+        'display_name': f"{user.first_name} {user.last_name}".strip() or user.username,
+        'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'unix_timestamp': int(message.timestamp.timestamp()),
+    }
@@ -0,0 +1,185 @@
+"""
+Profile image pipeline.
+
+UserProfile.save() used to reopen the profile picture and cover image with
+Pillow, re-encode them and write them back over the originals on every save
+(a balance change, a username change counter, a bio edit), costing tens of
+milliseconds and another generation of JPEG loss each time. Images are now
+processed once, when the stored file changes:
+
+* UserProfile.save() submits a field to the pipeline after the transaction
+  commits, and only when the field's file name differs from the one loaded.
+* A worker pool (off the request thread) hashes the upload and renders the
+  fixed-size variants in VARIANTS, each as JPEG and WebP. The originals are
+  never rewritten.
+* Variant files are content-addressed by the source's SHA-256, so identical
+  uploads share files and a variant that already exists is not rendered
+  again. The paths land in UserProfile.image_variants:
+
+    {"profile_picture": {"source": "profile_pictures/u1.png", "sha256": "...",
+                         "avatar": {"jpeg": "variants/ab/ab12...-avatar.jpg",
+                                    "webp": "variants/ab/ab12...-avatar.webp"}, ...}}
+
+Until a variant is ready the profile serves the original upload. The
+`process_profile_images` command (re)processes existing profiles.
+
+Configure via the IMAGE_PIPELINE setting:
+
+    IMAGE_PIPELINE = {
+        'MODE': 'thread',  # or 'inline' to process during save (tests, scripts)
+        'WORKERS': 2,
+        'QUALITY': 85,
+    }
+"""
+
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import metrics
+
+
+DEFAULT_IMAGE_PIPELINE = {
+    'MODE': 'thread',  # 'thread': worker pool; 'inline': process in the caller
+    'WORKERS': 2,  # Worker threads rendering variants
+    'QUALITY': 85,  # JPEG and WebP encoder quality
+}
+
+# Field -> {variant name: (width, height)}; variants are cropped to exactly this size
+VARIANTS = {
+    'profile_picture': {
+        'thumb': (64, 64),
+        'avatar': (300, 300),
+    },
+    'cover_image': {
+        'cover': (1200, 400),
+    },
+}
+
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp'),
+}
+
+
+class ImagePipeline:
+    """Renders profile image variants once per uploaded file"""
+
+    def __init__(self, mode='thread', workers=2, quality=85, storage=None):
+        self.mode = mode
+        self.workers = workers
+        self.quality = quality
+        self.storage = storage or default_storage
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, profile_id, field):
+        """Process a profile's image field once the current transaction commits"""
+        transaction.on_commit(lambda: self._dispatch(profile_id, field))
+
+    def _dispatch(self, profile_id, field):
+        metrics.incr('images.submitted')
+        if self.mode == 'inline':
+            self.process(profile_id, field)
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image-pipeline')
+        self._executor.submit(self._run, profile_id, field)
+
+    def _run(self, profile_id, field):
+        try:
+            self.process(profile_id, field)
+        except Exception as e:
+            metrics.incr('images.failed')
+            print(f'[IMAGES] Failed to process {field} of profile {profile_id}: {e}')
+        finally:
+            # Worker threads keep their own connections
+            connections.close_all()
+
+    def process(self, profile_id, field):
+        """Render the field's variants and record them; returns the variant map or None"""
+        from .models import UserProfile
+
+        name = UserProfile.objects.filter(pk=profile_id).values_list(field, flat=True).first()
+        if not name:
+            self._record(profile_id, field, name, None)
+            return None
+
+        with self.storage.open(name, 'rb') as source:
+            data = source.read()
+        digest = hashlib.sha256(data).hexdigest()
+        variants = {'source': name, 'sha256': digest}
+        image = None
+        for variant, size in VARIANTS[field].items():
+            variants[variant] = {}
+            for fmt, (pil_format, extension) in FORMATS.items():
+                path = f'variants/{digest[:2]}/{digest[:32]}-{variant}.{extension}'
+                if not self.storage.exists(path):
+                    if image is None:
+                        image = self._open(data)
+                    self.storage.save(path, ContentFile(self._render(image, size, pil_format)))
+                    metrics.incr('images.rendered')
+                variants[variant][fmt] = path
+
+        self._record(profile_id, field, name, variants)
+        return variants
+
+    def _open(self, data):
+        from PIL import Image, ImageOps
+
+        image = Image.open(BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # Flatten transparency onto white for formats and viewers without alpha
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            return background
+        return image.convert('RGB')
+
+    def _render(self, image, size, pil_format):
+        from PIL import Image, ImageOps
+
+        resized = ImageOps.fit(image, size, Image.Resampling.LANCZOS)
+        output = BytesIO()
+        resized.save(output, format=pil_format, quality=self.quality, optimize=pil_format == 'JPEG')
+        return output.getvalue()
+
+    def _record(self, profile_id, field, name, variants):
+        """Store the variants unless the field changed again while they were rendered"""
+        from .models import UserProfile
+
+        with transaction.atomic():
+            profile = UserProfile.objects.select_for_update().filter(pk=profile_id).only(field, 'image_variants').first()
+            if profile is None or (getattr(profile, field).name or None) != (name or None):
+                return
+            image_variants = dict(profile.image_variants)
+            if variants is None:
+                image_variants.pop(field, None)
+            else:
+                image_variants[field] = variants
+            # update() rather than save(): only this column, no image change detection
+            UserProfile.objects.filter(pk=profile_id).update(image_variants=image_variants)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def create_image_pipeline(config=None):
+    config = dict(DEFAULT_IMAGE_PIPELINE, **(config or getattr(settings, 'IMAGE_PIPELINE', {})))
+    return ImagePipeline(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared pipeline instance, created on first use
+image_pipeline = SimpleLazyObject(create_image_pipeline)
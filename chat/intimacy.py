@@ -0,0 +1,126 @@
+"""
+Intimacy engine.
+
+Intimacy.add_intimacy used to get_or_create the pair row, add in Python and
+save(), so concurrent gifts between the same two users lost points, and
+send_gift_new then ran a second get_or_create just to read the total back.
+The leaderboard ran an OR over both sides of the pair sorted on points.
+
+* add() is one INSERT ... ON CONFLICT DO UPDATE SET points = points + n
+  RETURNING points: creating the pair, incrementing it and reading the new
+  total is a single atomic statement (PostgreSQL and SQLite 3.35+; MySQL
+  and MariaDB fall back to an F() update plus a read).
+* Each pair is also materialized per direction in IntimacyLeaderboardEntry
+  (user, other user, points), incremented in the same transaction, so a
+  user's top-N is one index range scan on (user, -points) instead of an OR
+  query.
+"""
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .metrics import metrics
+
+
+LEADERBOARD_SIZE = 20
+
+
+def upsert_returning_supported():
+    """Whether INSERT ... ON CONFLICT ... RETURNING works: PostgreSQL and SQLite 3.35+
+
+    (MariaDB reports can_return_columns_from_insert but has no ON CONFLICT.)
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+
+
+class IntimacyEngine:
+    """Atomic intimacy updates and per-user leaderboards"""
+
+    def points(self, user_a, user_b):
+        """Intimacy between two users (0 when they have none; no row is created)"""
+        from .models import Intimacy
+
+        low, high = sorted((user_a.id, user_b.id))
+        return Intimacy.objects.filter(user1_id=low, user2_id=high).values_list('points', flat=True).first() or 0
+
+    def add(self, user_a, user_b, points):
+        """Add points between two users; returns the new total"""
+        low, high = sorted((user_a.id, user_b.id))
+        with transaction.atomic():
+            if upsert_returning_supported():
+                total = self._upsert_returning(low, high, points)
+            else:
+                total = self._update_or_create(low, high, points)
+            self._update_leaderboard(low, high, points)
+        metrics.incr('intimacy.updates')
+        return total
+
+    def leaderboard(self, user, limit=LEADERBOARD_SIZE):
+        """[(other user, points)] highest first"""
+        from .models import IntimacyLeaderboardEntry
+
+        entries = (IntimacyLeaderboardEntry.objects
+                   .filter(user=user)
+                   .select_related('other')
+                   .order_by('-points', 'other_id')[:limit])
+        return [(entry.other, entry.points) for entry in entries]
+
+    def _upsert(self, model, rows, conflict, returning=None):
+        """INSERT rows of (first, second, points), adding points on a conflict"""
+        quote = connection.ops.quote_name
+        table = quote(model._meta.db_table)
+        first, second = (quote(model._meta.get_field(name).column) for name in conflict)
+        now = timezone.now()
+        sql = (
+            f'INSERT INTO {table} ({first}, {second}, {quote("points")}, {quote("updated_at")}) '
+            f'VALUES {", ".join(["(%s, %s, %s, %s)"] * len(rows))} '
+            f'ON CONFLICT ({first}, {second}) DO UPDATE SET '
+            f'{quote("points")} = {table}.{quote("points")} + EXCLUDED.{quote("points")}, '
+            f'{quote("updated_at")} = EXCLUDED.{quote("updated_at")}'
+        )
+        params = [value for row in rows for value in (*row, now)]
+        if returning:
+            sql += f' RETURNING {quote(returning)}'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0] if returning else None
+
+    def _upsert_returning(self, low, high, points):
+        from .models import Intimacy
+
+        return self._upsert(Intimacy, [(low, high, points)], ('user1', 'user2'), returning='points')
+
+    def _update_or_create(self, low, high, points):
+        from .models import Intimacy
+
+        pair = Intimacy.objects.filter(user1_id=low, user2_id=high)
+        self._add_or_create(pair, points, user1_id=low, user2_id=high)
+        return pair.values_list('points', flat=True).get()
+
+    def _add_or_create(self, rows, points, **fields):
+        """F() increment of the row, or create it (for backends without ON CONFLICT)"""
+        if rows.update(points=F('points') + points, updated_at=timezone.now()):
+            return
+        try:
+            with transaction.atomic():
+                rows.model.objects.create(points=points, **fields)
+        except IntegrityError:
+            # Created concurrently; the row exists now
+            rows.update(points=F('points') + points, updated_at=timezone.now())
+
+    def _update_leaderboard(self, low, high, points):
+        from .models import IntimacyLeaderboardEntry
+
+        if upsert_returning_supported():
+            self._upsert(IntimacyLeaderboardEntry, [(low, high, points), (high, low, points)], ('user', 'other'))
+            return
+        for user_id, other_id in ((low, high), (high, low)):
+            entry = IntimacyLeaderboardEntry.objects.filter(user_id=user_id, other_id=other_id)
+            self._add_or_create(entry, points, user_id=user_id, other_id=other_id)
+
+
+# Shared engine
+intimacy = IntimacyEngine()
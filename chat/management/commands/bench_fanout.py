@@ -0,0 +1,81 @@
+"""
+Management command to measure CPU spent fanning one room event out to N sockets
+"""
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.consumers import ChatConsumer
+from chat.fanout import ENCODED_EVENT_TYPE, get_codec, orjson
+
+
+class Command(BaseCommand):
+    help = 'Compare per-recipient encoding with encode-once fan-out for several room sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,500,1000', help='Comma-separated room sizes')
+        parser.add_argument('--messages', type=int, default=200, help='Messages delivered per room size')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        codecs = ['json'] + (['orjson'] if orjson is not None else [])
+        if orjson is None:
+            self.stdout.write('orjson is not installed; only the json codec is measured')
+
+        self.stdout.write(f"{'room size':>10} {'per-recipient':>15} " + ' '.join(f'{"once/" + name:>13}' for name in codecs))
+        for size in sizes:
+            legacy = asyncio.run(self.measure_legacy(size, options['messages']))
+            encoded = [asyncio.run(self.measure_encoded(size, options['messages'], name)) for name in codecs]
+            self.stdout.write(
+                f'{size:>10} {self.format_us(legacy):>15} ' + ' '.join(f'{self.format_us(value):>13}' for value in encoded)
+            )
+        self.stdout.write(self.style.SUCCESS('CPU microseconds per message for the whole room (process time)'))
+
+    @staticmethod
+    def format_us(seconds):
+        return f'{seconds * 1e6:,.0f}us'
+
+    @staticmethod
+    def make_consumers(size):
+        async def discard(message):
+            pass
+        consumers = []
+        for _ in range(size):
+            consumer = ChatConsumer()
+            consumer.base_send = discard
+            consumers.append(consumer)
+        return consumers
+
+    @staticmethod
+    def sample_payload(n):
+        return {
+            'type': 'chat_message',
+            'message': f'Benchmark message number {n} with a little text 🎉',
+            'username': 'bench_user',
+            'display_name': 'Bench User',
+            'timestamp': '2025-01-01 12:00:00',
+            'message_id': 1234567890 + n,
+            'seq': n,
+        }
+
+    async def measure_legacy(self, size, messages):
+        """Every consumer rebuilds and json.dumps the payload itself"""
+        consumers = self.make_consumers(size)
+        started = time.process_time()
+        for n in range(messages):
+            event = self.sample_payload(n)
+            for consumer in consumers:
+                await consumer.chat_message(event)
+        return (time.process_time() - started) / messages
+
+    async def measure_encoded(self, size, messages, codec_name):
+        """The sender encodes once, consumers forward the text"""
+        consumers = self.make_consumers(size)
+        dumps = get_codec(codec_name)
+        started = time.process_time()
+        for n in range(messages):
+            event = {'type': ENCODED_EVENT_TYPE, 'text': dumps(self.sample_payload(n))}
+            for consumer in consumers:
+                await consumer.send_encoded(event)
+        return (time.process_time() - started) / messages
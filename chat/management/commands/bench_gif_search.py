@@ -0,0 +1,142 @@
+"""
+Management command to benchmark GIF search typeahead at scale
+
+Fills a throwaway test database (created on the configured backend) with a
+synthetic catalog of GIFS GIFs whose titles and tags are drawn from a
+Zipf-distributed vocabulary, builds the search index and times searches as a
+user types: two-letter prefixes, longer prefixes, complete words and
+multi-word queries.
+
+    python manage.py bench_gif_search --gifs 1000000
+"""
+import random
+import tempfile
+import time
+from itertools import accumulate
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from chat.gif_search import gif_search
+from chat.management.commands.loadtest import percentiles
+from chat.models import GifFile, GifPack
+
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+class Command(BaseCommand):
+    help = 'Time ranked GIF search (typeahead) against a large synthetic catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gifs', type=int, default=1_000_000, help='GIFs to insert')
+        parser.add_argument('--vocabulary', type=int, default=50_000, help='Distinct words titles and tags use')
+        parser.add_argument('--queries', type=int, default=2_000, help='Timed queries per scenario')
+        parser.add_argument('--batch', type=int, default=50_000, help='Rows per insert batch')
+        parser.add_argument('--target-ms', type=float, default=10.0, help='p99 latency budget per search')
+
+    def handle(self, *args, **options):
+        # DEBUG query logging would be timed along with the searches
+        settings.DEBUG = False
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # An in-memory database would hide I/O costs
+            test_settings['NAME'] = str(Path(tempfile.gettempdir()) / 'bench_gif_search.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            words = self.populate(options)
+            results = self.measure(words, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        failed = False
+        self.stdout.write(f"{connection.vendor}, {options['gifs']:,} GIFs, {options['vocabulary']:,} words")
+        for name, timings in results.items():
+            failed |= timings['p99'] > options['target_ms']
+            self.stdout.write(
+                f"{name:>14}: p50 {timings['p50']:.3f}ms  p90 {timings['p90']:.3f}ms  "
+                f"p99 {timings['p99']:.3f}ms  max {timings['max']:.3f}ms"
+            )
+        if failed:
+            self.stdout.write(self.style.ERROR(f"p99 above the {options['target_ms']}ms budget"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"All p99 latencies within {options['target_ms']}ms"))
+
+    def populate(self, options):
+        """Insert the catalog and index it; returns the vocabulary, most common first"""
+        rng = random.Random(0)
+        words = sorted({
+            ''.join(rng.choice(LETTERS) for _ in range(rng.randint(3, 9))) for _ in range(options['vocabulary'])
+        })
+        rng.shuffle(words)
+        weights = list(accumulate(1 / (rank + 1) for rank in range(len(words))))
+
+        pack = GifPack.objects.create(name='Bench')
+        table = GifFile._meta.db_table
+        sql = (
+            f'INSERT INTO {table} (pack_id, title, description, gif_file, tags, category, source, file_size, '
+            'width, height, duration, is_animated, "order", views, is_active, created_at, updated_at) '
+            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'
+        )
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        started = time.perf_counter()
+        for offset in range(0, options['gifs'], options['batch']):
+            rows = []
+            for n in range(offset, min(offset + options['batch'], options['gifs'])):
+                title = ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(2, 4)))
+                tags = ','.join(rng.choices(words, cum_weights=weights, k=rng.randint(1, 5)))
+                views = int(rng.paretovariate(1.2)) - 1
+                rows.append((pack.id, title, '', f'gifs/{n}.gif', tags, '', '', 0, 0, 0, 0, True, n, views, True, now, now))
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, rows)
+            self.stdout.write(f'\rInserted {offset + len(rows):,} GIFs', ending='')
+            self.stdout.flush()
+        self.stdout.write(f' in {time.perf_counter() - started:.0f}s')
+
+        started = time.perf_counter()
+        documents, terms = gif_search.rebuild(batch_size=options['batch'])
+        self.stdout.write(f'Indexed {documents:,} GIFs ({terms:,} terms) in {time.perf_counter() - started:.0f}s')
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        return words
+
+    def measure(self, words, options):
+        rng = random.Random(1)
+        queries = options['queries']
+        # Queries follow the same skew as the catalog
+        weights = list(accumulate(1 / (rank + 1) for rank in range(len(words))))
+
+        def word():
+            return rng.choices(words, cum_weights=weights)[0]
+
+        self.stdout.write('Query plans (two-letter prefix):')
+        with CaptureQueriesContext(connection) as queries_run:
+            gif_search.search(word()[:2])
+        with connection.cursor() as cursor:
+            prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN ANALYZE '
+            for query in queries_run[:3]:
+                cursor.execute(prefix + query['sql'])
+                for row in cursor.fetchall():
+                    self.stdout.write('  ' + ' '.join(str(column) for column in row))
+
+        scenarios = {
+            'prefix 2': lambda: gif_search.search(word()[:2]),
+            'prefix 3+': lambda: gif_search.search(word()[:rng.randint(3, 5)]),
+            'word': lambda: gif_search.search(word() + ' '),
+            'words + prefix': lambda: gif_search.search(f'{word()} {word()[:3]}'),
+        }
+        results = {}
+        for name, run in scenarios.items():
+            for _ in range(min(50, queries)):
+                run()  # Warm the page cache
+            samples = []
+            for _ in range(queries):
+                started = time.perf_counter()
+                run()
+                samples.append(time.perf_counter() - started)
+            results[name] = percentiles(samples)
+        return results
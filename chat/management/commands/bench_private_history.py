@@ -0,0 +1,139 @@
+"""
+Management command to benchmark keyset private chat history at scale
+
+Fills a throwaway test database (created on the configured backend, so run it
+once with SQLite and once with PostgreSQL settings) with ROWS private messages
+and times fetch_private_history for the newest page of random conversations
+and for deep pages of one large conversation:
+
+    python manage.py bench_private_history --rows 10000000
+"""
+import random
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from chat.conversations import fetch_private_history
+from chat.history import encode_cursor
+from chat.management.commands.loadtest import percentiles
+from chat.models import Conversation, PrivateMessage
+
+
+class Command(BaseCommand):
+    help = 'Time newest-first private chat history pages against a large PrivateMessage table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10_000_000, help='Private messages to insert')
+        parser.add_argument('--conversations', type=int, default=10_000, help='Conversations the rows are spread over')
+        parser.add_argument('--hot-share', type=float, default=0.1, help='Fraction of rows in one large conversation')
+        parser.add_argument('--queries', type=int, default=2_000, help='Timed queries per scenario')
+        parser.add_argument('--batch', type=int, default=50_000, help='Rows per insert batch')
+        parser.add_argument('--target-ms', type=float, default=5.0, help='p99 latency budget per page')
+
+    def handle(self, *args, **options):
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # An in-memory database would hide I/O costs (and may not fit 10M rows)
+            test_settings['NAME'] = str(Path(tempfile.gettempdir()) / 'bench_private_history.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            hot_id, conversation_ids = self.populate(options)
+            results = self.measure(hot_id, conversation_ids, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        failed = False
+        self.stdout.write(f"{connection.vendor}, {options['rows']:,} rows, {options['conversations']:,} conversations")
+        for name, timings in results.items():
+            failed |= timings['p99'] > options['target_ms']
+            self.stdout.write(
+                f"{name:>14}: p50 {timings['p50']:.3f}ms  p90 {timings['p90']:.3f}ms  "
+                f"p99 {timings['p99']:.3f}ms  max {timings['max']:.3f}ms"
+            )
+        if failed:
+            self.stdout.write(self.style.ERROR(f"p99 above the {options['target_ms']}ms budget"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"All p99 latencies within {options['target_ms']}ms"))
+
+    def populate(self, options):
+        """Insert users, conversations and messages; returns (hot conversation id, all conversation ids)"""
+        count = options['conversations']
+        users = User.objects.bulk_create([User(username=f'bench{n}') for n in range(count + 1)])
+        # Conversation n is between bench0 and bench(n + 1); conversation 0 is the hot one
+        conversations = Conversation.objects.bulk_create([
+            Conversation(user_low_id=users[0].id, user_high_id=users[n + 1].id) for n in range(count)
+        ])
+        conversation_ids = [conversation.id for conversation in conversations]
+        pairs = {conversation.id: (conversation.user_low_id, conversation.user_high_id) for conversation in conversations}
+        hot_id = conversation_ids[0]
+
+        table = PrivateMessage._meta.db_table
+        sql = (
+            f'INSERT INTO {table} (conversation_id, sender_id, receiver_id, content, timestamp, is_read) '
+            'VALUES (%s, %s, %s, %s, %s, %s)'
+        )
+        rng = random.Random(0)
+        start = timezone.now() - timedelta(seconds=options['rows'])
+        adapt = connection.ops.adapt_datetimefield_value
+        started = time.perf_counter()
+        for offset in range(0, options['rows'], options['batch']):
+            rows = []
+            for n in range(offset, min(offset + options['batch'], options['rows'])):
+                conversation_id = hot_id if rng.random() < options['hot_share'] else rng.choice(conversation_ids)
+                low, high = pairs[conversation_id]
+                sender, receiver = (low, high) if n % 2 else (high, low)
+                rows.append((conversation_id, sender, receiver, f'message {n}', adapt(start + timedelta(seconds=n)), True))
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, rows)
+            self.stdout.write(f'\rInserted {offset + len(rows):,} rows', ending='')
+            self.stdout.flush()
+        self.stdout.write(f' in {time.perf_counter() - started:.0f}s')
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE' if connection.vendor == 'sqlite' else f'ANALYZE {table}')
+        return hot_id, conversation_ids
+
+    def measure(self, hot_id, conversation_ids, options):
+        rng = random.Random(1)
+        queries = options['queries']
+
+        # Cursors at random depths of the hot conversation
+        hot = PrivateMessage.objects.filter(conversation_id=hot_id).order_by('-timestamp', '-id')
+        depth = hot.count()
+        cursors = []
+        for _ in range(min(queries, 200)):
+            message = hot.only('id', 'timestamp')[rng.randrange(depth)]
+            cursors.append(encode_cursor(message))
+
+        self.stdout.write('Query plan (deep page):')
+        with CaptureQueriesContext(connection) as queries_run:
+            fetch_private_history(hot_id, before=cursors[0])
+        with connection.cursor() as cursor:
+            prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN ANALYZE '
+            cursor.execute(prefix + queries_run[0]['sql'])
+            for row in cursor.fetchall():
+                self.stdout.write('  ' + ' '.join(str(column) for column in row))
+
+        scenarios = {
+            'newest page': lambda: fetch_private_history(rng.choice(conversation_ids)),
+            'hot newest': lambda: fetch_private_history(hot_id),
+            'hot deep page': lambda: fetch_private_history(hot_id, before=rng.choice(cursors)),
+        }
+        results = {}
+        for name, run in scenarios.items():
+            for _ in range(min(50, queries)):
+                run()  # Warm the page cache
+            samples = []
+            for _ in range(queries):
+                started = time.perf_counter()
+                run()
+                samples.append(time.perf_counter() - started)
+            results[name] = percentiles(samples)
+        return results
@@ -0,0 +1,32 @@
+"""
+Management command to run the notification outbox dispatcher as a worker process
+"""
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from chat.metrics import metrics
+from chat.notification_outbox import notification_outbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued notifications (use with NOTIFICATION_OUTBOX MODE "worker")'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the entries that are due now and exit')
+
+    def handle(self, *args, **options):
+        if notification_outbox.mode == 'thread':
+            self.stdout.write(self.style.WARNING(
+                'NOTIFICATION_OUTBOX MODE is "thread": web processes also dispatch, entries are shared between them'
+            ))
+        self.stdout.write('Dispatching notifications... (Ctrl+C to stop)')
+        try:
+            asyncio.run(notification_outbox.run(once=options['once']))
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(
+            f"Sent {metrics.counter('notifications.outbox.sent')} events, "
+            f"wrote {metrics.counter('notifications.outbox.written')} notifications, "
+            f"dropped {metrics.counter('notifications.outbox.dropped')} entries"
+        ))
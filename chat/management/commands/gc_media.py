@@ -0,0 +1,21 @@
+"""
+Management command to delete media files no profile or GIF references any more
+"""
+from django.core.management.base import BaseCommand
+
+from chat.media_store import media_store
+
+
+class Command(BaseCommand):
+    help = 'Delete unreferenced content-addressed media files older than MEDIA_STORE GRACE_HOURS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='List the files that would be deleted')
+        parser.add_argument('--legacy', action='store_true', help='Also delete unreferenced files stored under pre-hash names')
+
+    def handle(self, *args, **options):
+        removed = media_store.collect_garbage(dry_run=options['dry_run'], legacy=options['legacy'])
+        for name in removed:
+            self.stdout.write(f'  {name}')
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(removed)} unreferenced files'))
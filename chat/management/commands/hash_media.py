@@ -0,0 +1,60 @@
+"""
+Management command to move existing uploads to content-addressed names
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.catalog import catalog
+from chat.image_pipeline import VARIANTS
+from chat.media_store import is_content_addressed, media_store
+from chat.models import GifFile, UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Copy profile images and GIFs stored under old names to content-addressed names (run gc_media --legacy afterwards)'
+
+    def handle(self, *args, **options):
+        self.moved = self.failed = 0
+
+        for field in VARIANTS:
+            directory = UserProfile._meta.get_field(field).upload_to.strip('/')
+            for profile in UserProfile.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}).only('id', field).iterator():
+                name = self._rehash(getattr(profile, field).name, directory, f'Profile {profile.id} {field}')
+                if name:
+                    self._update_profile(profile.id, field, name)
+
+        for field in ('gif_file', 'thumbnail'):
+            directory = GifFile._meta.get_field(field).upload_to.strip('/')
+            for gif in GifFile.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}).only('id', field).iterator():
+                name = self._rehash(getattr(gif, field).name, directory, f'GIF {gif.id} {field}')
+                if name:
+                    # update(): the file is the same, so no search re-index or catalog rebuild per row
+                    GifFile.objects.filter(id=gif.id).update(**{field: name})
+
+        if self.moved:
+            catalog.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Moved {self.moved} files ({self.failed} failed)'))
+
+    def _rehash(self, name, directory, label):
+        """The content-addressed name for a stored file, or None when it needs no (or cannot be) moving"""
+        if name.startswith(('http://', 'https://')) or is_content_addressed(name):
+            return None
+        try:
+            new_name = media_store.rehash(name, directory)
+        except OSError as e:
+            self.failed += 1
+            self.stdout.write(self.style.WARNING(f'{label}: {e}'))
+            return None
+        self.moved += 1
+        return new_name
+
+    def _update_profile(self, profile_id, field, name):
+        """Point the profile at the new name, keeping its rendered variants (same bytes)"""
+        with transaction.atomic():
+            profile = UserProfile.objects.select_for_update().only(field, 'image_variants').get(id=profile_id)
+            image_variants = dict(profile.image_variants)
+            variants = image_variants.get(field)
+            if variants and variants.get('source') == getattr(profile, field).name:
+                image_variants[field] = dict(variants, source=name)
+            # update() rather than save(): the image is unchanged, so it needs no reprocessing
+            UserProfile.objects.filter(id=profile_id).update(**{field: name, 'image_variants': image_variants})
@@ -0,0 +1,428 @@
+"""
+Management command to load test the WebSocket consumers in-process
+
+Drives ws/chat/, ws/private-chat/, ws/notifications/ and ws/game2048/ through
+the real ASGI application (session auth, origin validation, routing) with
+Channels' WebsocketCommunicator against a throwaway test database, and prints
+a JSON report that CI can diff between commits:
+
+    python manage.py loadtest --clients 500 --output loadtest.json
+"""
+import asyncio
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+
+
+SCENARIOS = ['chat', 'private', 'notifications', 'game']
+
+
+class QueryCounter:
+    """Counts SQL statements on every database connection, in any thread"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        for conn in connections.all():
+            conn.execute_wrappers.append(self)
+        connection_created.connect(self._on_connection_created)
+
+    def uninstall(self):
+        connection_created.disconnect(self._on_connection_created)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class LoadClient:
+    """One simulated browser tab: an authenticated WebSocket plus a reader task"""
+
+    def __init__(self, application, path, cookie):
+        from channels.testing import WebsocketCommunicator
+
+        origin = f'http://{settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else "localhost"}'
+        self.communicator = WebsocketCommunicator(application, path, headers=[
+            (b'origin', origin.encode()),
+            (b'cookie', cookie.encode()),
+        ])
+        self.reader = None
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        return connected
+
+    def start_reader(self, on_message):
+        async def read():
+            # Read the queue directly: receive_from() cancels the app on timeout
+            while True:
+                output = await self.communicator.output_queue.get()
+                if output.get('type') == 'websocket.send' and output.get('text'):
+                    on_message(json.loads(output['text']), time.perf_counter())
+        self.reader = asyncio.ensure_future(read())
+
+    async def send(self, payload):
+        await self.communicator.send_to(text_data=json.dumps(payload))
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        try:
+            await self.communicator.disconnect(timeout=5)
+        except Exception:
+            pass
+
+
+def percentiles(samples):
+    if not samples:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {'p50': pick(0.50), 'p90': pick(0.90), 'p99': pick(0.99), 'max': round(ordered[-1] * 1000, 3)}
+
+
+class Command(BaseCommand):
+    help = 'Simulate many WebSocket clients against the in-process ASGI app and report latency/throughput as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated subset of: ' + ', '.join(SCENARIOS))
+        parser.add_argument('--clients', type=int, default=200, help='Chat sockets per room / notification sockets')
+        parser.add_argument('--rooms', type=int, default=1, help='Chat rooms (clients are split across them)')
+        parser.add_argument('--senders', type=int, default=5, help='Chat clients per room that send messages')
+        parser.add_argument('--messages', type=int, default=20, help='Messages per sender')
+        parser.add_argument('--pairs', type=int, default=50, help='Private chat friend pairs / 2048 games')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for deliveries to drain')
+        parser.add_argument('--output', default='-', help="Report path ('-' for stdout)")
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            self.stderr.write(self.style.ERROR(f'Unknown scenarios: {", ".join(sorted(unknown))}'))
+            return
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        counter = QueryCounter()
+        counter.install()
+        try:
+            from discord_chat.asgi import application
+            results = asyncio.run(self.run_scenarios(application, scenarios, options, counter))
+        finally:
+            counter.uninstall()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'meta': {
+                'commit': self.git_commit(),
+                'python': sys.version.split()[0],
+                'channel_layer': settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND', 'channels.layers.InMemoryChannelLayer'),
+                'database': connection.vendor,
+                'options': {key: options[key] for key in ('clients', 'rooms', 'senders', 'messages', 'pairs')},
+            },
+            'scenarios': results,
+        }
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if options['output'] == '-':
+            self.stdout.write(text)
+        else:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Wrote load test report to {options["output"]}'))
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, timeout=5,
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    # ---- fixtures -----------------------------------------------------------
+
+    def create_users(self, prefix, count):
+        from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+        from django.contrib.auth.models import User
+        from django.contrib.sessions.backends.db import SessionStore
+
+        User.objects.bulk_create([User(username=f'{prefix}{i}') for i in range(count)])
+        users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+        cookies = {}
+        for user in users:
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            cookies[user.username] = f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+        return users, cookies
+
+    async def connect_all(self, application, targets, timeout):
+        """Connect (path, cookie) targets, tracing memory allocated per connection"""
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        clients = [LoadClient(application, path, cookie) for path, cookie in targets]
+        results = await asyncio.gather(*(client.connect(timeout) for client in clients))
+        connect_seconds = time.perf_counter() - started
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        failed = results.count(False)
+        if failed:
+            self.stderr.write(self.style.WARNING(f'{failed} of {len(clients)} connections were refused'))
+        connected = [client for client, ok in zip(clients, results) if ok]
+        return connected, {
+            'connections': len(connected),
+            'connect_seconds': round(connect_seconds, 3),
+            'memory_per_connection_bytes': int((after - before) / max(len(connected), 1)),
+        }
+
+    async def settle(self, counter, quiet=0.2, timeout=10.0):
+        """Wait for connect-time work (presence, member status) to stop hitting the DB"""
+        deadline = time.perf_counter() + timeout
+        last = -1
+        while counter.count != last and time.perf_counter() < deadline:
+            last = counter.count
+            await asyncio.sleep(quiet)
+
+    async def wait_for(self, condition, timeout):
+        deadline = time.perf_counter() + timeout
+        while not condition() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+
+    def summarize(self, stats, sent, delivered, expected, latencies, duration, queries):
+        stats.update({
+            'messages_sent': sent,
+            'deliveries': delivered,
+            'expected_deliveries': expected,
+            'duration_seconds': round(duration, 3),
+            'messages_per_second': round(sent / duration, 1) if duration else None,
+            'deliveries_per_second': round(delivered / duration, 1) if duration else None,
+            'latency_ms': percentiles(latencies),
+            'db_queries': queries,
+            'db_queries_per_message': round(queries / sent, 2) if sent else None,
+        })
+        return stats
+
+    # ---- scenarios ----------------------------------------------------------
+
+    async def run_scenarios(self, application, scenarios, options, counter):
+        results = {}
+        for name in scenarios:
+            self.stderr.write(f'Running {name} scenario...')
+            results[name] = await getattr(self, f'scenario_{name}')(application, options, counter)
+        return results
+
+    async def scenario_chat(self, application, options, counter):
+        from channels.db import database_sync_to_async
+        from chat.message_pipeline import message_pipeline
+        from chat.models import Room
+
+        rooms, per_room = options['rooms'], max(options['clients'] // options['rooms'], 1)
+
+        def setup():
+            users, cookies = self.create_users('lt_chat_', rooms * per_room)
+            room_names = []
+            for r in range(rooms):
+                room = Room.objects.create(name=f'{9000000 + r}', creator=users[r * per_room], is_finalized=True)
+                for user in users[r * per_room:(r + 1) * per_room]:
+                    room.add_member(user, 'member')
+                room_names.append(room.name)
+            return users, cookies, room_names
+
+        users, cookies, room_names = await database_sync_to_async(setup)()
+        targets = [
+            (f'/ws/chat/{room_names[i // per_room]}/', cookies[user.username])
+            for i, user in enumerate(users)
+        ]
+        clients, stats = await self.connect_all(application, targets, options['timeout'])
+
+        sent_at, latencies = {}, []
+
+        def on_message(data, now):
+            if data.get('type') == 'chat_message' and data.get('message', '').startswith('lt:'):
+                latencies.append(now - sent_at[data['message']])
+
+        for client in clients:
+            client.start_reader(on_message)
+        await self.settle(counter)
+
+        senders = [client for r in range(rooms) for client in clients[r * per_room:r * per_room + options['senders']]]
+        queries_before = counter.count
+        started = time.perf_counter()
+        for n in range(options['messages']):
+            for s, client in enumerate(senders):
+                token = f'lt:{s}:{n}'
+                sent_at[token] = time.perf_counter()
+                await client.send({'message': token})
+        expected = len(sent_at) * per_room
+        await self.wait_for(lambda: len(latencies) >= expected, options['timeout'])
+        duration = time.perf_counter() - started
+        await database_sync_to_async(message_pipeline.flush)()
+        queries = counter.count - queries_before
+
+        await asyncio.gather(*(client.close() for client in clients))
+        return self.summarize(stats, len(sent_at), len(latencies), expected, latencies, duration, queries)
+
+    async def scenario_private(self, application, options, counter):
+        from channels.db import database_sync_to_async
+        from chat.models import Friendship
+
+        pairs = options['pairs']
+
+        def setup():
+            users, cookies = self.create_users('lt_dm_', pairs * 2)
+            Friendship.objects.bulk_create([
+                Friendship(sender=users[2 * p], receiver=users[2 * p + 1], status='accepted') for p in range(pairs)
+            ])
+            return users, cookies
+
+        users, cookies = await database_sync_to_async(setup)()
+        targets = []
+        for p in range(pairs):
+            a, b = users[2 * p], users[2 * p + 1]
+            targets.append((f'/ws/private-chat/{b.username}/', cookies[a.username]))
+            targets.append((f'/ws/private-chat/{a.username}/', cookies[b.username]))
+            # Receivers also get a new_message_notification on their notification socket
+            targets.append(('/ws/notifications/', cookies[a.username]))
+            targets.append(('/ws/notifications/', cookies[b.username]))
+        clients, stats = await self.connect_all(application, targets, options['timeout'])
+
+        sent_at, latencies, notified = {}, [], []
+
+        def on_message(data, now):
+            if data.get('type') == 'chat_message' and data.get('message', '').startswith('lt:'):
+                latencies.append(now - sent_at[data['message']])
+            elif data.get('type') == 'new_message':
+                notified.append(now)
+
+        for client in clients:
+            client.start_reader(on_message)
+        await self.settle(counter)
+
+        chat_clients = [client for i, client in enumerate(clients) if i % 4 in (0, 1)]
+        queries_before = counter.count
+        started = time.perf_counter()
+        for n in range(options['messages']):
+            for s, client in enumerate(chat_clients):
+                token = f'lt:{s}:{n}'
+                sent_at[token] = time.perf_counter()
+                await client.send({'type': 'chat_message', 'message': token})
+        # Each message reaches both sockets of the pair
+        expected = len(sent_at) * 2
+        await self.wait_for(lambda: len(latencies) >= expected, options['timeout'])
+        duration = time.perf_counter() - started
+        queries = counter.count - queries_before
+
+        await asyncio.gather(*(client.close() for client in clients))
+        stats = self.summarize(stats, len(sent_at), len(latencies), expected, latencies, duration, queries)
+        stats['notifications_delivered'] = len(notified)
+        return stats
+
+    async def scenario_notifications(self, application, options, counter):
+        from channels.db import database_sync_to_async
+        from channels.layers import get_channel_layer
+
+        users, cookies = await database_sync_to_async(self.create_users)('lt_note_', options['clients'])
+        clients, stats = await self.connect_all(
+            application, [('/ws/notifications/', cookies[user.username]) for user in users], options['timeout'],
+        )
+
+        sent_at, latencies = {}, []
+
+        def on_message(data, now):
+            if data.get('title', '').startswith('lt:'):
+                latencies.append(now - sent_at[data['title']])
+
+        for client in clients:
+            client.start_reader(on_message)
+        await self.settle(counter)
+
+        channel_layer = get_channel_layer()
+        queries_before = counter.count
+        started = time.perf_counter()
+        for n in range(options['messages']):
+            for user in users:
+                token = f'lt:{user.username}:{n}'
+                sent_at[token] = time.perf_counter()
+                await channel_layer.group_send(f'notifications_{user.username}', {
+                    'type': 'general_notification',
+                    'title': token,
+                    'message': 'Load test notification',
+                    'timestamp': '',
+                })
+        expected = len(sent_at)
+        await self.wait_for(lambda: len(latencies) >= expected, options['timeout'])
+        duration = time.perf_counter() - started
+        queries = counter.count - queries_before
+
+        await asyncio.gather(*(client.close() for client in clients))
+        return self.summarize(stats, len(sent_at), len(latencies), expected, latencies, duration, queries)
+
+    async def scenario_game(self, application, options, counter):
+        from channels.db import database_sync_to_async
+        from chat.models import MultiplayerGame2048
+
+        games = options['pairs']
+
+        def setup():
+            users, cookies = self.create_users('lt_game_', games * 2)
+            MultiplayerGame2048.objects.bulk_create([
+                MultiplayerGame2048(game_id=f'lt-{g}', player1=users[2 * g], player2=users[2 * g + 1], status='active')
+                for g in range(games)
+            ])
+            return users, cookies
+
+        users, cookies = await database_sync_to_async(setup)()
+        targets = []
+        for g in range(games):
+            targets.append((f'/ws/game2048/lt-{g}/', cookies[users[2 * g].username]))
+            targets.append((f'/ws/game2048/lt-{g}/', cookies[users[2 * g + 1].username]))
+        clients, stats = await self.connect_all(application, targets, options['timeout'])
+
+        sent_at, latencies, lobby = {}, [], []
+
+        def on_message(data, now):
+            if data.get('type') == 'game_move':
+                key = (data.get('player'), data.get('score'))
+                if key in sent_at:
+                    latencies.append(now - sent_at[key])
+            elif data.get('type') == 'online_count':
+                lobby.append(now)
+
+        for client in clients:
+            client.start_reader(on_message)
+        await self.settle(counter)
+
+        queries_before = counter.count
+        started = time.perf_counter()
+        for n in range(options['messages']):
+            for i, client in enumerate(clients):
+                sent_at[(users[i].username, n)] = time.perf_counter()
+                await client.send({'type': 'move', 'merged_tiles': [4, 8], 'score': n, 'board': []})
+        # game_move goes to both players in the game group
+        expected = len(sent_at) * 2
+        await self.wait_for(lambda: len(latencies) >= expected, options['timeout'])
+        duration = time.perf_counter() - started
+        queries = counter.count - queries_before
+
+        await asyncio.gather(*(client.close() for client in clients))
+        stats = self.summarize(stats, len(sent_at), len(latencies), expected, latencies, duration, queries)
+        stats['lobby_broadcasts_delivered'] = len(lobby)
+        return stats
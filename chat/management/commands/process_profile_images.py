@@ -0,0 +1,32 @@
+"""
+Management command to render profile image variants for existing profiles
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from chat.image_pipeline import VARIANTS, image_pipeline
+from chat.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Render thumbnail/avatar/cover variants for profile images that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Reprocess every profile image, not just unprocessed ones')
+
+    def handle(self, *args, **options):
+        processed = failed = 0
+        for field in VARIANTS:
+            profiles = UserProfile.objects.exclude(Q(**{f'{field}__isnull': True}) | Q(**{field: ''}))
+            for profile in profiles.only('id', field, 'image_variants').iterator():
+                variants = profile.image_variants.get(field)
+                if not options['all'] and variants and variants.get('source') == getattr(profile, field).name:
+                    continue
+                try:
+                    image_pipeline.process(profile.id, field)
+                    processed += 1
+                except Exception as e:
+                    failed += 1
+                    self.stdout.write(self.style.WARNING(f'Profile {profile.id} {field}: {e}'))
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} images ({failed} failed)'))
@@ -0,0 +1,27 @@
+"""
+Management command to rebuild the GIF search index
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.gif_search import gif_search
+
+
+class Command(BaseCommand):
+    help = 'Re-index every active GIF for search (after changing GIF_SEARCH weights or bulk imports that skip signals)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=5000, help='Rows per read and insert batch')
+
+    def handle(self, *args, **options):
+        def progress(indexed, total):
+            self.stdout.write(f'\rIndexed {indexed:,} of {total:,} GIFs', ending='')
+            self.stdout.flush()
+
+        started = time.perf_counter()
+        documents, terms = gif_search.rebuild(batch_size=options['batch'], progress=progress)
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {documents:,} GIFs ({terms:,} terms) in {time.perf_counter() - started:.1f}s'
+        ))
@@ -0,0 +1,33 @@
+"""
+Management command to check Evercoin balances against the ledger
+"""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from chat.evercoin import ledger
+
+
+class Command(BaseCommand):
+    help = 'Compare every Evercoin balance with the sum of its ledger entries (run periodically, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix', action='store_true',
+            help='Journal an adjustment for each mismatch so the ledger matches the current balances',
+        )
+
+    def handle(self, *args, **options):
+        mismatched, unbalanced = ledger.reconcile(fix=options['fix'])
+
+        usernames = dict(User.objects.filter(id__in=list(mismatched)).values_list('id', 'username'))
+        for user_id, (balance, journal) in mismatched.items():
+            self.stdout.write(self.style.WARNING(
+                f'{usernames.get(user_id, user_id)}: balance {balance:,}, ledger {journal:,} ({balance - journal:+,})'
+            ))
+        for transaction_id in unbalanced:
+            self.stdout.write(self.style.ERROR(f'Transaction {transaction_id} does not sum to zero'))
+
+        if not mismatched and not unbalanced:
+            self.stdout.write(self.style.SUCCESS('All Evercoin balances match the ledger'))
+        elif options['fix'] and mismatched:
+            self.stdout.write(self.style.SUCCESS(f'Journalled adjustments for {len(mismatched)} balances'))
@@ -0,0 +1,30 @@
+"""
+Management command to recount cached unread counters from the database
+"""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from chat.unread_counts import unread_counts
+
+
+class Command(BaseCommand):
+    help = 'Recount unread notification and private message counters (run periodically, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', nargs='*', help='Only reconcile these usernames')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Users recounted per batch')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        if options['users']:
+            users = users.filter(username__in=options['users'])
+        user_ids = list(users.values_list('id', flat=True))
+
+        corrected = 0
+        chunk_size = options['chunk_size']
+        for start in range(0, len(user_ids), chunk_size):
+            corrected += unread_counts.reconcile(user_ids[start:start + chunk_size])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Reconciled unread counters for {len(user_ids)} users ({corrected} corrected)'
+        ))
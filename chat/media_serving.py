@@ -1,15 +1,294 @@
 """
 Media file serving utilities for production environments.
 Handles serving GIFs and other media files properly in production.
+
+MediaFilesMiddleware answers /media/ requests before sessions and auth run.
+It used to call Path.exists() and is_file() and open the file for every
+request, always sending the whole body. MediaServer now does the work:
+
+* A stat cache (LRU, STAT_CACHE_SIZE paths) keeps each file's size, mtime,
+  ETag and content type, from a single os.stat re-checked at most every
+  STAT_TTL seconds. Missing files are cached too, so 404 probes cost no
+  syscalls.
+* ETags are strong (mtime and size). If-None-Match / If-Modified-Since get
+  a bodiless 304, and If-Match / If-Unmodified-Since failures get a 412.
+* Single byte ranges (Range: bytes=a-b, a- or -n, honouring If-Range) get
+  a 206 Partial Content, and an unsatisfiable range gets a 416. Large GIFs can
+  then be resumed and seeked.
+* Small files (up to HOT_FILE_MAX_BYTES) are kept in memory in an LRU of at
+  most HOT_CACHE_BYTES, keyed by path and checked against the current ETag.
+  Larger files go out as a FileResponse (the server's wsgi.file_wrapper, and
+  sendfile where it supports it) or are streamed in chunks for a range.
+* Behind nginx or Apache the body can be handed to the proxy: OFFLOAD
+  'x-accel-redirect' answers with X-Accel-Redirect: OFFLOAD_PREFIX + path
+  (an internal nginx location aliased to MEDIA_ROOT), 'x-sendfile' with
+  the absolute path, and 'auto' uses whichever the proxy announces in an
+  X-Sendfile-Type request header. The proxy then serves ranges itself.
+* Content-addressed files (see chat.media_store) never change under their
+  name and are sent with max-age=IMMUTABLE_MAX_AGE, immutable; other files
+  get MAX_AGE.
+
+Configure via the MEDIA_SERVING setting:
+
+    MEDIA_SERVING = {
+        'STAT_TTL': 2.0,
+        'STAT_CACHE_SIZE': 10000,
+        'HOT_CACHE_BYTES': 32 * 1024 * 1024,
+        'HOT_FILE_MAX_BYTES': 256 * 1024,
+        'MAX_AGE': 3600,
+        'IMMUTABLE_MAX_AGE': 31536000,
+        'OFFLOAD': None,  # 'x-accel-redirect', 'x-sendfile' or 'auto'
+        'OFFLOAD_PREFIX': '/protected-media/',
+    }
 """
 
+import mimetypes
 import os
+import re
+import stat
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
 from django.conf import settings
-from django.http import FileResponse, HttpResponseNotFound
-from django.views.static import serve as serve_static
-from django.views.decorators.http import condition
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, HttpResponse, HttpResponseNotFound, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import http_date, parse_http_date_safe
 from pathlib import Path
 
+from .media_store import is_content_addressed
+from .metrics import metrics
+
+
+DEFAULT_MEDIA_SERVING = {
+    'STAT_TTL': 2.0,  # Seconds a cached stat is trusted before the file is stat'ed again
+    'STAT_CACHE_SIZE': 10000,  # Paths kept in the stat cache
+    'HOT_CACHE_BYTES': 32 * 1024 * 1024,  # Memory for small file bodies
+    'HOT_FILE_MAX_BYTES': 256 * 1024,  # Files up to this size are kept in memory
+    'MAX_AGE': 3600,  # Cache-Control max-age for media responses
+    'IMMUTABLE_MAX_AGE': 31536000,  # max-age for content-addressed files (sent with immutable)
+    'OFFLOAD': None,  # None, 'x-accel-redirect', 'x-sendfile' or 'auto'
+    'OFFLOAD_PREFIX': '/protected-media/',  # Internal nginx location for X-Accel-Redirect
+    'CHUNK_SIZE': 64 * 1024,  # Read size when streaming a byte range
+}
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)')
+
+# _byte_range() result for a range that starts past the end of the file
+UNSATISFIABLE = 'unsatisfiable'
+
+
+def get_content_type(file_path):
+    """Determine content type based on file extension"""
+    content_type, _ = mimetypes.guess_type(str(file_path))
+    return content_type or 'application/octet-stream'
+
+
+class MediaFile:
+    """Cached metadata of one media file"""
+
+    __slots__ = ('relative', 'path', 'size', 'mtime', 'etag', 'last_modified', 'content_type', 'immutable')
+
+    def __init__(self, relative, path, st):
+        self.relative = relative
+        self.path = path
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        self.last_modified = http_date(st.st_mtime)
+        self.content_type = get_content_type(path)
+        self.immutable = is_content_addressed(relative)
+
+
+class MediaServer:
+    """Serves files under MEDIA_ROOT with caching, conditional and range support"""
+
+    def __init__(self, root=None, stat_ttl=2.0, stat_cache_size=10000, hot_cache_bytes=32 * 1024 * 1024,
+                 hot_file_max_bytes=256 * 1024, max_age=3600, immutable_max_age=31536000, offload=None,
+                 offload_prefix='/protected-media/', chunk_size=64 * 1024):
+        self.root = str(root or settings.MEDIA_ROOT)
+        self.stat_ttl = stat_ttl
+        self.stat_cache_size = stat_cache_size
+        self.hot_cache_bytes = hot_cache_bytes
+        self.hot_file_max_bytes = hot_file_max_bytes
+        self.max_age = max_age
+        self.immutable_max_age = immutable_max_age
+        self.offload = offload
+        self.offload_prefix = offload_prefix.rstrip('/') + '/'
+        self.chunk_size = chunk_size
+
+        self._lock = threading.Lock()
+        self._stats = OrderedDict()  # relative path -> (checked at, MediaFile or None)
+        self._hot = OrderedDict()  # relative path -> (etag, bytes)
+        self._hot_size = 0
+
+    # ---- metadata ------------------------------------------------------------
+
+    def lookup(self, relative):
+        """The MediaFile for a path relative to the root, or None when it is not a regular file"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._stats.get(relative)
+            if cached is not None and now - cached[0] < self.stat_ttl:
+                self._stats.move_to_end(relative)
+                return cached[1]
+
+        media_file = None
+        try:
+            path = safe_join(self.root, relative)
+            st = os.stat(path)
+            if stat.S_ISREG(st.st_mode):
+                media_file = MediaFile(relative, path, st)
+        except (SuspiciousFileOperation, OSError, ValueError):
+            # Outside the root, missing, or not a valid path
+            pass
+
+        with self._lock:
+            self._stats[relative] = (now, media_file)
+            self._stats.move_to_end(relative)
+            while len(self._stats) > self.stat_cache_size:
+                self._stats.popitem(last=False)
+        return media_file
+
+    def _hot_body(self, media_file):
+        """The file's bytes from the hot cache, read (and cached) on a miss"""
+        with self._lock:
+            cached = self._hot.get(media_file.relative)
+            if cached is not None and cached[0] == media_file.etag:
+                self._hot.move_to_end(media_file.relative)
+                metrics.incr('media.hot_hits')
+                return cached[1]
+
+        with open(media_file.path, 'rb') as f:
+            body = f.read()
+        if len(body) != media_file.size:
+            # Changed since it was stat'ed; serve what was read, cache nothing
+            return body
+
+        with self._lock:
+            previous = self._hot.pop(media_file.relative, None)
+            if previous is not None:
+                self._hot_size -= len(previous[1])
+            self._hot[media_file.relative] = (media_file.etag, body)
+            self._hot_size += len(body)
+            while self._hot_size > self.hot_cache_bytes:
+                _, (_, evicted) = self._hot.popitem(last=False)
+                self._hot_size -= len(evicted)
+        return body
+
+    # ---- responses -----------------------------------------------------------
+
+    def serve(self, request, relative):
+        """A response for a GET/HEAD of the media file, or None when there is no such file"""
+        media_file = self.lookup(relative)
+        if media_file is None:
+            return None
+
+        response = get_conditional_response(request, etag=media_file.etag, last_modified=media_file.mtime)
+        if response is not None:
+            metrics.incr('media.not_modified' if response.status_code == 304 else 'media.precondition_failed')
+            return self._finish(response, media_file)
+
+        offload = self.offload
+        if offload == 'auto':
+            offload = request.META.get('HTTP_X_SENDFILE_TYPE', '').lower() or None
+        if offload in ('x-accel-redirect', 'x-sendfile'):
+            # The proxy sends the body (and handles ranges)
+            response = HttpResponse(content_type=media_file.content_type)
+            if offload == 'x-accel-redirect':
+                response['X-Accel-Redirect'] = self.offload_prefix + quote(media_file.relative)
+            else:
+                response['X-Sendfile'] = media_file.path
+            metrics.incr('media.offloaded')
+            return self._finish(response, media_file)
+
+        byte_range = self._byte_range(request, media_file)
+        if byte_range == UNSATISFIABLE:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{media_file.size}'
+            return self._finish(response, media_file)
+
+        start, end = byte_range or (0, media_file.size - 1)
+        length = end - start + 1 if media_file.size else 0
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=media_file.content_type)
+        elif media_file.size <= self.hot_file_max_bytes:
+            body = self._hot_body(media_file)
+            response = HttpResponse(body[start:end + 1] if byte_range else body, content_type=media_file.content_type)
+        elif byte_range:
+            response = StreamingHttpResponse(self._read(media_file.path, start, length), content_type=media_file.content_type)
+        else:
+            # Whole large file: the server's wsgi.file_wrapper (sendfile where available)
+            response = FileResponse(open(media_file.path, 'rb'), content_type=media_file.content_type)
+
+        if byte_range:
+            response.status_code = 206
+            response['Content-Range'] = f'bytes {start}-{end}/{media_file.size}'
+            metrics.incr('media.partial')
+        response['Content-Length'] = str(length)
+        return self._finish(response, media_file)
+
+    def _finish(self, response, media_file):
+        response['ETag'] = media_file.etag
+        response['Last-Modified'] = media_file.last_modified
+        if media_file.immutable:
+            response['Cache-Control'] = f'public, max-age={self.immutable_max_age}, immutable'
+        else:
+            response['Cache-Control'] = f'public, max-age={self.max_age}'
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    def _byte_range(self, request, media_file):
+        """(start, end) inclusive, UNSATISFIABLE, or None to send the whole file"""
+        header = request.META.get('HTTP_RANGE', '').strip()
+        if not header:
+            return None
+        if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+        if if_range and if_range != media_file.etag and parse_http_date_safe(if_range) != media_file.mtime:
+            # The client's copy is stale: send the whole (current) file
+            return None
+        match = RANGE_RE.fullmatch(header)
+        if not match or not (match[1] or match[2]):
+            # Malformed or multiple ranges: a full response is always allowed
+            return None
+
+        size = media_file.size
+        if match[1]:
+            start = int(match[1])
+            end = min(int(match[2]), size - 1) if match[2] else size - 1
+            if start >= size:
+                return UNSATISFIABLE
+            if end < start:
+                return None
+            return start, end
+        suffix = int(match[2])
+        if suffix == 0 or size == 0:
+            return UNSATISFIABLE
+        return max(size - suffix, 0), size - 1
+
+    def _read(self, path, start, length):
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(self.chunk_size, length))
+                if not chunk:
+                    return
+                length -= len(chunk)
+                yield chunk
+
+
+def create_media_server(config=None):
+    config = dict(DEFAULT_MEDIA_SERVING, **(config or getattr(settings, 'MEDIA_SERVING', {})))
+    return MediaServer(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared media server, created on first use
+media_server = SimpleLazyObject(create_media_server)
+
 
 def serve_media_file(request, path):
     """
@@ -17,71 +296,38 @@ def serve_media_file(request, path):
     This is used when WhiteNoise or Django's static file serving isn't handling media.
     """
     try:
-        # Ensure we're serving from MEDIA_ROOT only
-        media_root = Path(settings.MEDIA_ROOT)
-        file_path = media_root / path
-        
-        # Security check: ensure file is within MEDIA_ROOT
-        try:
-            file_path.resolve().relative_to(media_root.resolve())
-        except ValueError:
-            # Path is outside MEDIA_ROOT
-            return HttpResponseNotFound()
-        
-        # Check if file exists
-        if not file_path.exists() or not file_path.is_file():
-            return HttpResponseNotFound()
-        
-        # Serve the file
-        return FileResponse(
-            open(file_path, 'rb'),
-            content_type=get_content_type(file_path)
-        )
+        return media_server.serve(request, path) or HttpResponseNotFound()
     except Exception as e:
         print(f"Error serving media file {path}: {str(e)}")
         return HttpResponseNotFound()
 
 
-def get_content_type(file_path):
-    """Determine content type based on file extension"""
-    import mimetypes
-    content_type, _ = mimetypes.guess_type(str(file_path))
-    return content_type or 'application/octet-stream'
-
-
 class MediaFilesMiddleware:
     """
     Middleware to ensure media files are accessible in production.
     This acts as a fallback when using WhiteNoise or other static servers.
     """
-    
+
     def __init__(self, get_response):
         self.get_response = get_response
         self.media_root = Path(settings.MEDIA_ROOT)
         self.media_url = settings.MEDIA_URL.lstrip('/')
-    
+
     def __call__(self, request):
         # Check if this is a media file request
         path = request.path_info
-        
-        if path.startswith(settings.MEDIA_URL):
+
+        if path.startswith(settings.MEDIA_URL) and request.method in ('GET', 'HEAD'):
             # Extract relative path
             relative_path = path[len(settings.MEDIA_URL):]
-            
-            # Try to serve the file
-            file_path = self.media_root / relative_path
-            
-            if file_path.exists() and file_path.is_file():
-                try:
-                    response = FileResponse(
-                        open(file_path, 'rb'),
-                        content_type=get_content_type(file_path)
-                    )
-                    # Add cache headers
-                    response['Cache-Control'] = 'public, max-age=3600'
-                    return response
-                except Exception as e:
-                    print(f"Error serving media file: {str(e)}")
-                    return self.get_response(request)
-        
+
+            # Try to serve the file (None: no such file, let the URLconf answer)
+            try:
+                response = media_server.serve(request, relative_path)
+            except Exception as e:
+                print(f"Error serving media file: {str(e)}")
+                response = None
+            if response is not None:
+                return response
+
         return self.get_response(request)
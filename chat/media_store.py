@@ -0,0 +1,168 @@
+"""
+Content-addressed media storage.
+
+Uploads used to be stored under names like profile_pictures/u1_1700000000.png
+and served with a one-hour max-age, so clients revalidated or refetched them
+every hour, and a file replaced under the same name could be served stale.
+Uploaded and imported media is now stored under its SHA-256:
+
+    <directory>/<sha256[:2]>/<sha256>.<ext>
+
+A new file always gets a new name, so MediaServer sends content-addressed
+files (these, and the image pipeline's variants/) with
+Cache-Control: public, max-age=31536000, immutable.
+
+Identical files share one name, so replacing an upload never deletes the old
+file (another row may use it). collect_garbage() - the `gc_media` command -
+removes content-addressed files no row references any more, once they are
+older than GRACE_HOURS so a file saved just before its row is not collected.
+`hash_media` moves files stored before this under content-addressed names.
+
+Configure via the MEDIA_STORE setting:
+
+    MEDIA_STORE = {
+        'GRACE_HOURS': 24,
+    }
+"""
+
+import hashlib
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import metrics
+
+
+DEFAULT_MEDIA_STORE = {
+    'GRACE_HOURS': 24,  # Unreferenced files younger than this are kept
+}
+
+# Directories holding content-addressed files (gifs/ includes gifs/thumbnails/)
+DIRECTORIES = ('profile_pictures', 'cover_images', 'gifs', 'variants')
+
+# <shard>/<hex digest starting with the shard>[-variant].<ext>, as written by
+# MediaStore.save() (64 hex digits) and ImagePipeline.process() (32)
+CONTENT_NAME_RE = re.compile(r'(?:^|/)([0-9a-f]{2})/\1[0-9a-f]{30}(?:[0-9a-f]{32})?(?:-[a-z]+)?\.[0-9a-z]+$')
+
+EXTENSION_RE = re.compile(r'\.[0-9a-z]{1,8}')
+
+
+def is_content_addressed(name):
+    """Whether a storage name (or URL path) names immutable, content-addressed bytes"""
+    return bool(name) and CONTENT_NAME_RE.search(name) is not None
+
+
+class MediaStore:
+    """Saves media under content hashes and collects files nothing references"""
+
+    def __init__(self, grace_hours=24, storage=None):
+        self.grace = timedelta(hours=grace_hours)
+        self.storage = storage or default_storage
+
+    def save(self, content, directory, name='', default_ext='.bin'):
+        """Store content (a File or bytes) in directory under its SHA-256; returns the storage name"""
+        if isinstance(content, bytes):
+            content = ContentFile(content)
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+
+        ext = os.path.splitext(name or getattr(content, 'name', None) or '')[1].lower()
+        if not EXTENSION_RE.fullmatch(ext):
+            ext = default_ext
+        path = f'{directory.strip("/")}/{digest[:2]}/{digest}{ext}'
+
+        if self.storage.exists(path):
+            # Restart its grace period: it may be an orphan about to be referenced again
+            self._touch(path)
+            metrics.incr('media.deduplicated')
+            return path
+        content.seek(0)
+        saved = self.storage.save(path, content)
+        if saved != path:
+            # Saved concurrently by another upload of the same bytes: drop our copy
+            self.storage.delete(saved)
+        metrics.incr('media.stored')
+        return path
+
+    def _touch(self, path):
+        try:
+            os.utime(self.storage.path(path))
+        except (NotImplementedError, OSError):
+            pass
+
+    def rehash(self, name, directory):
+        """Copy a stored file to its content-addressed name in directory and return that name"""
+        with self.storage.open(name, 'rb') as f:
+            return self.save(f, directory, name)
+
+    # ---- garbage collection ------------------------------------------------
+
+    def referenced(self):
+        """Every storage name a profile or GIF points at"""
+        from .models import GifFile, UserProfile
+
+        names = set()
+        for picture, cover, variants in UserProfile.objects.values_list('profile_picture', 'cover_image', 'image_variants').iterator():
+            names.update((picture, cover))
+            for field_variants in (variants or {}).values():
+                for formats in field_variants.values():
+                    if isinstance(formats, dict):
+                        names.update(formats.values())
+        for gif, thumbnail in GifFile.objects.values_list('gif_file', 'thumbnail').iterator():
+            names.update((gif, thumbnail))
+        names.discard('')
+        names.discard(None)
+        return names
+
+    def _walk(self, directory):
+        try:
+            subdirectories, files = self.storage.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in files:
+            yield f'{directory}/{name}'
+        for subdirectory in subdirectories:
+            yield from self._walk(f'{directory}/{subdirectory}')
+
+    def collect_garbage(self, dry_run=False, legacy=False):
+        """Delete unreferenced files older than the grace period; returns their names.
+
+        Only content-addressed files are considered unless legacy is set, which
+        also removes unreferenced files stored under the old names.
+        """
+        referenced = self.referenced()
+        cutoff = timezone.now() - self.grace
+        removed = []
+        for directory in DIRECTORIES:
+            for name in self._walk(directory):
+                if name in referenced or not (legacy or is_content_addressed(name)):
+                    continue
+                try:
+                    if self.storage.get_modified_time(name) > cutoff:
+                        continue
+                    if not dry_run:
+                        self.storage.delete(name)
+                except OSError as e:
+                    print(f'[MEDIA] Could not collect {name}: {e}')
+                    continue
+                removed.append(name)
+        if not dry_run:
+            metrics.incr('media.collected', len(removed))
+        return removed
+
+
+def create_media_store(config=None):
+    config = dict(DEFAULT_MEDIA_STORE, **(config or getattr(settings, 'MEDIA_STORE', {})))
+    return MediaStore(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared store, created on first use
+media_store = SimpleLazyObject(create_media_store)
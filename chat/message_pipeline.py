@@ -0,0 +1,448 @@
+"""
+Write-behind persistence for room chat messages.
+
+ChatConsumer hands each message to the pipeline, which assigns the final
+Message ID up front, appends the record to a local journal and returns
+immediately so the message can be broadcast without waiting for the database.
+A background thread then writes queued messages with one bulk_create per batch,
+whenever FLUSH_INTERVAL_MS elapses or MAX_BATCH messages are waiting.
+
+Durability is at-least-once: the journal is replayed on startup, and because
+IDs are pre-assigned, replaying a message that already reached the database
+is a no-op (ignore_conflicts).
+
+Message IDs embed a worker ID, so two processes must never share one. Each
+pipeline claims a free ID on first use: a lock file per ID in JOURNAL_DIR
+covers the processes on one host, and a lease in the cache covers hosts that
+share a cache (Redis, Memcached). The writer thread renews the lease, and a
+process that finds its lease taken claims another ID. Each process also
+journals to its own messages-<pid>.journal, held by a lock on
+messages-<pid>.lock; on startup, journals whose lock is free (their process
+is gone) are adopted and replayed.
+
+Configure via the MESSAGE_PIPELINE setting:
+
+    MESSAGE_PIPELINE = {
+        'ENABLED': True,
+        'FLUSH_INTERVAL_MS': 200,
+        'MAX_BATCH': 100,
+        'JOURNAL_DIR': BASE_DIR / 'var' / 'journal',
+        'FSYNC': False,
+        'WORKER_ID': None,  # or a fixed 0-31
+        'WORKER_LEASE_SECONDS': 60,
+    }
+"""
+
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+DEFAULT_PIPELINE = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL_MS': 200,  # Longest a message waits before it is written
+    'MAX_BATCH': 100,  # Flush early once this many messages are queued
+    'JOURNAL_DIR': None,  # Defaults to <BASE_DIR>/var/journal
+    'FSYNC': False,  # fsync every journal append (slower, survives power loss)
+    'WORKER_ID': None,  # None claims a free ID; a fixed 0-31 refuses to start when it is taken
+    'WORKER_LEASE_SECONDS': 60,  # Cache lease on the worker ID, renewed by the writer thread
+}
+
+# Message IDs: 41 bits of milliseconds since ID_EPOCH, 5 bits of worker ID and
+# 7 bits of per-millisecond sequence. That stays below 2**53, so IDs survive
+# the round trip through JavaScript numbers in the browser.
+ID_EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def lock_file(path):
+    """Open path with an exclusive, non-blocking lock; None when another process (or handle) holds it"""
+    handle = open(path, 'a+', encoding='utf-8')
+    try:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+
+class MessageIdAllocator:
+    """Time-ordered, JS-safe 53-bit ID generator (one per worker)"""
+
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'WORKER_ID must be between 0 and {MAX_WORKER_ID}')
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+            if now_ms < self._last_ms:
+                # Clock went backwards: keep issuing from the last timestamp
+                now_ms = self._last_ms
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now_ms = self._last_ms + 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return (now_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+class MessagePipeline:
+    """Queues room messages and writes them to the Message table in batches"""
+
+    def __init__(self, enabled=True, flush_interval_ms=200, max_batch=100,
+                 journal_dir=None, fsync=False, worker_id=None, worker_lease_seconds=60):
+        if worker_id is not None and not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'WORKER_ID must be between 0 and {MAX_WORKER_ID}')
+        self.enabled = enabled
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self.worker_id = worker_id
+        self.worker_lease = worker_lease_seconds
+        self.journal_dir = Path(journal_dir) if journal_dir else Path(settings.BASE_DIR) / 'var' / 'journal'
+        self.journal_path = self.journal_dir / f'messages-{os.getpid()}.journal'
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+        # Set by _claim_worker_id() on first use
+        self.allocator = None
+        self._worker_lock = None
+        self._lease_renewed = 0.0
+        self._claim_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._settled = threading.Condition(self._lock)  # Signalled whenever a batch finishes
+        self._pending = []
+        self._in_flight = 0
+        self._journal = None
+        self._journal_lock = None
+        self._thread = None
+        self._stopping = False
+
+    # ---- producer side -------------------------------------------------
+
+    def submit(self, room_id, user_id, content, timestamp=None):
+        """Queue a message and return its pre-assigned ID"""
+        timestamp = timestamp or timezone.now()
+        self._renew_worker_id()
+        record = {
+            'id': self.allocator.next_id(),
+            'room_id': room_id,
+            'user_id': user_id,
+            'content': content,
+            'timestamp': timestamp.isoformat(),
+        }
+        if not self.enabled:
+            self._write([record])
+            return record['id']
+
+        self._ensure_started()
+        with self._lock:
+            self._append_journal(record)
+            self._pending.append(record)
+            metrics.gauge('messages.pipeline.pending', len(self._pending))
+            if len(self._pending) >= self.max_batch:
+                self._wakeup.notify()
+        return record['id']
+
+    def flush(self, timeout=5.0):
+        """
+        Synchronously write everything queued so far (call from sync code only).
+
+        Also waits, for at most timeout seconds, for a batch the writer thread
+        took before this call: its rows are not readable until it commits.
+        Returns False if that batch was still being written at the deadline.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            batch, self._pending = self._pending, []
+            self._in_flight += len(batch)
+        self._write_and_settle(batch, background=False)
+        with self._lock:
+            return self._settled.wait_for(lambda: not self._in_flight, max(deadline - time.monotonic(), 0))
+
+    def is_pending(self, message_id):
+        with self._lock:
+            return any(record['id'] == message_id for record in self._pending)
+
+    # ---- worker ID -----------------------------------------------------
+
+    def _lease_key(self, worker_id):
+        return f'message_pipeline:worker:{worker_id}'
+
+    def _renew_worker_id(self):
+        """Claim a worker ID on first use, and renew its lease once a third of it has passed"""
+        if self.allocator is not None and time.monotonic() - self._lease_renewed < self.worker_lease / 3:
+            return
+        with self._claim_lock:
+            if self.allocator is None:
+                self._claim_worker_id()
+            elif time.monotonic() - self._lease_renewed >= self.worker_lease / 3:
+                key = self._lease_key(self.allocator.worker_id)
+                if cache.get(key) == self.owner and cache.touch(key, self.worker_lease) or cache.add(key, self.owner, self.worker_lease):
+                    self._lease_renewed = time.monotonic()
+                else:
+                    # Another process took the ID while our lease had lapsed: stop using it
+                    print(f'[MESSAGES] Lost worker ID {self.allocator.worker_id}, claiming another')
+                    metrics.incr('messages.pipeline.worker_id_lost')
+                    self._claim_worker_id()
+
+    def _claim_worker_id(self):
+        """Take a worker ID no other process holds; raises RuntimeError when none is free"""
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        previous = self.allocator.worker_id if self.allocator is not None else None
+        candidates = [self.worker_id] if self.worker_id is not None else range(MAX_WORKER_ID + 1)
+        for worker_id in candidates:
+            if worker_id == previous:
+                continue
+            handle = lock_file(self.journal_dir / f'worker-{worker_id}.lock')
+            if handle is None:
+                continue  # Held by another process on this host
+            if not cache.add(self._lease_key(worker_id), self.owner, self.worker_lease):
+                handle.close()
+                continue  # Held by a process on another host
+            self._release_worker_id()
+            self._worker_lock = handle
+            self._lease_renewed = time.monotonic()
+            self.allocator = MessageIdAllocator(worker_id)
+            print(f'[MESSAGES] Claimed worker ID {worker_id}')
+            return
+        if self.worker_id is not None:
+            raise RuntimeError(f'Message worker ID {self.worker_id} is already in use by another process')
+        raise RuntimeError(f'All {MAX_WORKER_ID + 1} message worker IDs are in use')
+
+    def _release_worker_id(self):
+        if self.allocator is not None:
+            key = self._lease_key(self.allocator.worker_id)
+            if cache.get(key) == self.owner:
+                cache.delete(key)
+        if self._worker_lock is not None:
+            self._worker_lock.close()
+            self._worker_lock = None
+
+    # ---- background writer ---------------------------------------------
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self.journal_dir.mkdir(parents=True, exist_ok=True)
+            if self._journal_lock is None:
+                self._journal_lock = lock_file(self.journal_path.with_suffix('.lock'))
+                if self._journal_lock is None:
+                    raise RuntimeError(f'{self.journal_path} is in use by another pipeline')
+            replay = self._read_journal()
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            replay += self._adopt_orphaned_journals()
+            self._pending = replay + self._pending
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='message-pipeline', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        if replay:
+            print(f'[MESSAGES] Replaying {len(replay)} journaled message(s)')
+
+    def _run(self):
+        while True:
+            try:
+                self._renew_worker_id()
+            except Exception as e:
+                print(f'[MESSAGES] Worker ID renewal failed: {e}')
+            with self._lock:
+                if len(self._pending) < self.max_batch and not self._stopping:
+                    # Let the batch fill up for at most one flush interval
+                    self._wakeup.wait(self.flush_interval)
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                self._in_flight += len(batch)
+                stopping = self._stopping and not self._pending
+            if batch:
+                self._write_and_settle(batch, background=True)
+            if stopping:
+                return
+
+    def _write_and_settle(self, batch, background):
+        """Write a taken batch; background is True on the writer thread, False in flush()"""
+        if not batch:
+            return
+        try:
+            if background:
+                # Only the writer thread's connection is ours to recycle; a request
+                # thread's connection belongs to its request
+                close_old_connections()
+            self._write(batch)
+        except Exception as e:
+            # Keep the records queued (and journaled) so the next flush retries them
+            print(f'[MESSAGES] Flush of {len(batch)} message(s) failed: {e}')
+            metrics.incr('messages.pipeline.flush_errors')
+            with self._lock:
+                self._pending = batch + self._pending
+                self._in_flight -= len(batch)
+                self._settled.notify_all()
+            if background:
+                # Back off before the writer retries; a request must not stall on it
+                time.sleep(self.flush_interval)
+            return
+        with self._lock:
+            self._in_flight -= len(batch)
+            self._settled.notify_all()
+            if not self._in_flight:
+                # Everything except the still-queued records is in the database
+                self._compact_journal()
+            metrics.gauge('messages.pipeline.pending', len(self._pending))
+
+    def _write(self, batch):
+        from .models import Message, Room
+        from django.contrib.auth.models import User
+
+        started = time.perf_counter()
+        rows = [self._to_message(record) for record in batch]
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(rows, ignore_conflicts=True)
+        except IntegrityError:
+            # A room or user was deleted while its messages were queued: drop those rows
+            room_ids = set(Room.objects.filter(id__in={m.room_id for m in rows}).values_list('id', flat=True))
+            user_ids = set(User.objects.filter(id__in={m.user_id for m in rows}).values_list('id', flat=True))
+            rows = [m for m in rows if m.room_id in room_ids and m.user_id in user_ids]
+            with transaction.atomic():
+                Message.objects.bulk_create(rows, ignore_conflicts=True)
+        metrics.observe('messages.pipeline.flush_seconds', time.perf_counter() - started)
+        metrics.incr('messages.pipeline.written', len(rows))
+
+    @staticmethod
+    def _to_message(record):
+        from .models import Message
+
+        return Message(
+            id=record['id'],
+            room_id=record['room_id'],
+            user_id=record['user_id'],
+            content=record['content'],
+            timestamp=datetime.fromisoformat(record['timestamp']),
+        )
+
+    def stop(self):
+        """Flush remaining messages and stop the writer thread"""
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            if not self._thread.is_alive():
+                with self._lock:
+                    # Anything still journaled is replayed by the next pipeline to adopt it
+                    for handle in (self._journal, self._journal_lock):
+                        if handle is not None:
+                            handle.close()
+                    self._journal = self._journal_lock = None
+        with self._claim_lock:
+            self._release_worker_id()
+            self.allocator = None
+
+    # ---- journal ---------------------------------------------------------
+
+    def _append_journal(self, record):
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _read_journal(self, path=None):
+        records = []
+        try:
+            with open(path or self.journal_path, 'r', encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Torn final line from a crash mid-write
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _adopt_orphaned_journals(self):
+        """Move the records of journals whose process is gone into ours; returns them"""
+        adopted = []
+        for path in sorted(self.journal_dir.glob('messages-*.journal')):
+            if path == self.journal_path:
+                continue
+            lock_path = path.with_suffix('.lock')
+            handle = lock_file(lock_path)
+            if handle is None:
+                continue  # A live pipeline owns it
+            try:
+                records = self._read_journal(path)
+                for record in records:
+                    self._append_journal(record)
+                # Records are in our journal now (a crash here only replays them twice)
+                path.unlink(missing_ok=True)
+            finally:
+                handle.close()
+            lock_path.unlink(missing_ok=True)
+            adopted.extend(records)
+        return adopted
+
+    def _compact_journal(self):
+        """Rewrite the journal so it only holds records that are still queued"""
+        if self._journal is None:
+            return
+        if not self._pending:
+            self._journal.seek(0)
+            self._journal.truncate()
+            return
+        tmp_path = self.journal_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as tmp:
+            tmp.writelines(json.dumps(record) + '\n' for record in self._pending)
+            tmp.flush()
+            if self.fsync:
+                os.fsync(tmp.fileno())
+        self._journal.close()
+        os.replace(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+
+def create_message_pipeline(config=None):
+    config = dict(DEFAULT_PIPELINE, **(config or getattr(settings, 'MESSAGE_PIPELINE', {})))
+    return MessagePipeline(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared pipeline instance, created on first use
+message_pipeline = SimpleLazyObject(create_message_pipeline)
@@ -0,0 +1,66 @@
+"""
+Lightweight in-process metrics for the chat subsystems.
+
+Counters, gauges and timings are kept in memory per worker process and can be
+read with snapshot() (e.g. from a debug view or a management command).
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and timing summaries"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Record one duration sample (in seconds)"""
+        with self._lock:
+            summary = self._timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+            summary['count'] += 1
+            summary['total'] += seconds
+            summary['max'] = max(summary['max'], seconds)
+            summary['last'] = seconds
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'timings': {name: dict(summary) for name, summary in self._timings.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._timings.clear()
+
+
+metrics = Metrics()
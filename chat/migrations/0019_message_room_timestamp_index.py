@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0018_multiplayergame2048'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chat_messag_room_id_284f10_idx'),
+        ),
+    ]
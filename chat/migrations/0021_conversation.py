@@ -0,0 +1,78 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:22
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def create_conversations(apps, schema_editor):
+    """Group existing private messages into conversations and fill in their summaries"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    PrivateMessage = apps.get_model('chat', 'PrivateMessage')
+
+    pairs = set()
+    for sender_id, receiver_id in PrivateMessage.objects.values_list('sender_id', 'receiver_id').distinct():
+        pairs.add((min(sender_id, receiver_id), max(sender_id, receiver_id)))
+
+    for low, high in pairs:
+        conversation = Conversation.objects.create(user_low_id=low, user_high_id=high)
+        messages = PrivateMessage.objects.filter(
+            Q(sender_id=low, receiver_id=high) | Q(sender_id=high, receiver_id=low)
+        )
+        messages.update(conversation=conversation)
+        last_message = messages.order_by('-timestamp', '-id').first()
+        unread = dict(messages.filter(is_read=False).values_list('receiver_id').annotate(n=Count('id')).order_by())
+        Conversation.objects.filter(id=conversation.id).update(
+            last_message=last_message,
+            last_message_at=last_message.timestamp,
+            low_unread=unread.get(low, 0),
+            high_unread=unread.get(high, 0),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0020_notificationoutbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('low_unread', models.PositiveIntegerField(default=0)),
+                ('high_unread', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.privatemessage')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations_as_high', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations_as_low', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='conversation',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['conversation', 'id'], name='chat_privat_convers_f9c05a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_low', '-last_message_at', '-id'], name='chat_conver_user_lo_e9292e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_high', '-last_message_at', '-id'], name='chat_conver_user_hi_c32cc6_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_conversation_pair'),
+        ),
+        migrations.RunPython(create_conversations, migrations.RunPython.noop),
+    ]
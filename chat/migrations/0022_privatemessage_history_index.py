@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0021_conversation'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='privatemessage',
+            name='chat_privat_convers_f9c05a_idx',
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['conversation', 'timestamp', 'id'], name='chat_privat_convers_5099cc_idx'),
+        ),
+    ]
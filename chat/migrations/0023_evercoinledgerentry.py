@@ -0,0 +1,61 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:32
+
+import uuid
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def record_opening_balances(apps, schema_editor):
+    """Journal every existing balance as one opening transaction so balances reconcile from day one"""
+    EvercoinLedgerEntry = apps.get_model('chat', 'EvercoinLedgerEntry')
+    UserProfile = apps.get_model('chat', 'UserProfile')
+
+    transaction_id = uuid.uuid4()
+    entries = [
+        EvercoinLedgerEntry(
+            transaction_id=transaction_id, user_id=user_id, amount=balance,
+            balance_after=balance, kind='opening_balance',
+        )
+        for user_id, balance in UserProfile.objects.exclude(evercoin=0).values_list('user_id', 'evercoin').iterator()
+    ]
+    if entries:
+        entries.append(EvercoinLedgerEntry(
+            transaction_id=transaction_id, account='opening',
+            amount=-sum(entry.amount for entry in entries), kind='opening_balance',
+        ))
+        EvercoinLedgerEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0022_privatemessage_history_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EvercoinLedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_id', models.UUIDField(db_index=True)),
+                ('account', models.CharField(default='wallet', max_length=32)),
+                ('amount', models.BigIntegerField(help_text='Signed change to the account')),
+                ('balance_after', models.BigIntegerField(blank=True, help_text='Wallet balance after this entry', null=True)),
+                ('kind', models.CharField(choices=[('opening_balance', 'Opening balance'), ('gift', 'Gift'), ('game_reward', 'Game reward'), ('admin_grant', 'Admin grant'), ('admin_deduct', 'Admin deduction'), ('transfer', 'Transfer'), ('adjustment', 'Reconciliation adjustment')], max_length=20)),
+                ('reference', models.CharField(blank=True, default='', max_length=100)),
+                ('memo', models.CharField(blank=True, default='', max_length=200)),
+                ('idempotency_key', models.CharField(blank=True, max_length=150, null=True, unique=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='evercoin_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['user', '-id'], name='chat_everco_user_id_b086ad_idx')],
+            },
+        ),
+        migrations.RunPython(record_opening_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_leaderboard(apps, schema_editor):
+    """Materialize both directions of every existing Intimacy pair"""
+    Intimacy = apps.get_model('chat', 'Intimacy')
+    IntimacyLeaderboardEntry = apps.get_model('chat', 'IntimacyLeaderboardEntry')
+    entries = []
+    for user1_id, user2_id, points in Intimacy.objects.values_list('user1_id', 'user2_id', 'points').iterator():
+        entries.append(IntimacyLeaderboardEntry(user_id=user1_id, other_id=user2_id, points=points))
+        entries.append(IntimacyLeaderboardEntry(user_id=user2_id, other_id=user1_id, points=points))
+    IntimacyLeaderboardEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0024_userprofile_image_variants'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IntimacyLeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='intimacy_leaderboard', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-points', 'other'], name='chat_intima_user_id_cb205e_idx')],
+                'unique_together': {('user', 'other')},
+            },
+        ),
+        migrations.RunPython(build_leaderboard, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:41
+
+import re
+from collections import Counter
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Frozen copies of chat.gif_search's tokenizer and BM25 defaults as of this
+# migration, so the backfill doesn't change with that module
+# (rebuild_gif_search re-indexes with the current code and settings)
+FIELD_WEIGHTS = {'title': 2.0, 'tags': 3.0, 'category': 1.0}
+K1 = 1.2
+B = 0.75
+TOKEN_RE = re.compile(r'\w+')
+MAX_TERM_LENGTH = 64
+
+
+def frequencies(gif):
+    counts = Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        for token in TOKEN_RE.findall((gif[field] or '').casefold()):
+            if len(token) <= MAX_TERM_LENGTH:
+                counts[token] += weight
+    return counts
+
+
+def impact(frequency, length, average_length):
+    norm = K1 * (1 - B + B * length / average_length)
+    return frequency * (K1 + 1) / (frequency + norm)
+
+
+def build_index(apps, schema_editor):
+    """Index the existing catalog"""
+    GifFile = apps.get_model('chat', 'GifFile')
+    GifSearchTerm = apps.get_model('chat', 'GifSearchTerm')
+    GifSearchPosting = apps.get_model('chat', 'GifSearchPosting')
+    documents = {
+        gif['id']: frequencies(gif)
+        for gif in GifFile.objects.filter(is_active=True).values('id', 'title', 'tags', 'category')
+    }
+    if not documents:
+        return
+    doc_counts = Counter(term for counts in documents.values() for term in counts)
+    GifSearchTerm.objects.bulk_create([GifSearchTerm(term=term, doc_count=count) for term, count in doc_counts.items()])
+    term_ids = dict(GifSearchTerm.objects.values_list('term', 'id'))
+    average_length = sum(sum(counts.values()) for counts in documents.values()) / len(documents) or 1.0
+    GifSearchPosting.objects.bulk_create([
+        GifSearchPosting(
+            term_id=term_ids[term], gif_id=gif_id, frequency=frequency,
+            impact=impact(frequency, sum(counts.values()), average_length),
+        )
+        for gif_id, counts in documents.items()
+        for term, frequency in counts.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0025_intimacy_leaderboard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GifSearchPosting',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frequency', models.FloatField(help_text='Field-weighted term frequency')),
+                ('impact', models.FloatField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GifSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64, unique=True)),
+                ('doc_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='giffile',
+            name='chat_giffil_tags_612e9c_idx',
+        ),
+        migrations.AddField(
+            model_name='gifsearchposting',
+            name='gif',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_postings', to='chat.giffile'),
+        ),
+        migrations.AddField(
+            model_name='gifsearchposting',
+            name='term',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postings', to='chat.gifsearchterm'),
+        ),
+        migrations.AddIndex(
+            model_name='gifsearchposting',
+            index=models.Index(fields=['term', '-impact', 'gif'], name='chat_gifsea_term_id_4f00d1_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='gifsearchposting',
+            unique_together={('term', 'gif')},
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:16
+
+import math
+from datetime import datetime, timezone as dt_timezone
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Frozen copies of chat.gif_activity's forward decay as of this migration, with
+# the default half-life, so the stored scores don't depend on GIF_ACTIVITY or
+# later changes to that module
+TRENDING_EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+HALF_LIFE = 24 * 3600.0
+
+
+def weight(at):
+    return (at - TRENDING_EPOCH).total_seconds() / HALF_LIFE
+
+
+def log2_add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def roll_up_usage(apps, schema_editor):
+    """Score every GIF from its usage logs; views without a log count as of the trending epoch"""
+    from django.utils import timezone
+
+    GifFile = apps.get_model('chat', 'GifFile')
+    GifUsageLog = apps.get_model('chat', 'GifUsageLog')
+    GifTrending = apps.get_model('chat', 'GifTrending')
+    scores = {}
+    sends = {}
+    for gif_id, sent_at in GifUsageLog.objects.values_list('gif_id', 'sent_at').iterator():
+        scores[gif_id] = log2_add(scores.get(gif_id), weight(sent_at))
+        sends[gif_id] = sends.get(gif_id, 0) + 1
+    now = timezone.now()
+    rows = []
+    for gif_id, views in GifFile.objects.filter(views__gt=0).values_list('id', 'views').iterator():
+        older = views - sends.get(gif_id, 0)
+        score = log2_add(scores.pop(gif_id, None), math.log2(older) if older > 0 else None)
+        rows.append(GifTrending(gif_id=gif_id, score=score, views=views, updated_at=now))
+    for gif_id, score in scores.items():
+        rows.append(GifTrending(gif_id=gif_id, score=score, views=sends[gif_id], updated_at=now))
+    GifTrending.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0026_gif_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GifTrending',
+            fields=[
+                ('gif', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='trending', serialize=False, to='chat.giffile')),
+                ('score', models.FloatField(help_text='log2 of forward-decayed activity')),
+                ('views', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-score'], name='chat_giftre_score_787e17_idx')],
+            },
+        ),
+        migrations.RunPython(roll_up_usage, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,19 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.core.serializers.json import DjangoJSONEncoder
 
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
 from django.utils import timezone
-from PIL import Image
 import os
 
 
+# UserProfile image fields processed by chat.image_pipeline
+IMAGE_FIELDS = ('profile_picture', 'cover_image')
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     profile_picture = models.ImageField(upload_to='profile_pictures/', null=True, blank=True)
@@ -21,12 +26,38 @@ class UserProfile(models.Model):
     username_changes_year = models.IntegerField(default=timezone.now().year)
     # Gift system
     evercoin = models.BigIntegerField(default=0, help_text='Virtual currency for gifts')
+    # Resized copies of the uploads, written by chat.image_pipeline
+    image_variants = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
+    @classmethod
+    def ensure_for(cls, users):
+        """Make sure each user has a profile and attach it as user.profile (at most three queries for any number of users)"""
+        related = User.profile.related
+        unknown = {}
+        missing = {}
+        for user in users:
+            if not related.is_cached(user):
+                unknown[user.id] = user
+            elif related.get_cached_value(user) is None:
+                # select_related('profile') found no row
+                missing[user.id] = user
+        
+        if unknown:
+            for profile in cls.objects.filter(user_id__in=list(unknown)):
+                unknown.pop(profile.user_id).profile = profile
+            missing.update(unknown)
+        
+        if missing:
+            # Signals are skipped, so a concurrent create_user_profile only makes this a no-op
+            cls.objects.bulk_create([cls(user_id=user_id) for user_id in missing], ignore_conflicts=True)
+            for profile in cls.objects.filter(user_id__in=list(missing)):
+                missing[profile.user_id].profile = profile
+
     def can_change_username(self):
         """Check if user can change username (max 3 times per year)"""
         current_year = timezone.now().year
@@ -49,7 +80,7 @@ class UserProfile(models.Model):
     def get_profile_picture_url(self):
         """Get profile picture URL, fallback to pixel avatar or default"""
         if self.profile_picture:
-            return self.profile_picture.url
+            return self.image_url('profile_picture', 'avatar') or self.profile_picture.url
         elif self.pixel_avatar:
             return f'/static/chat/images/pixel_avatars/{self.pixel_avatar}.png'
         else:
@@ -62,28 +93,40 @@ class UserProfile(models.Model):
             # If cover_choice matches a file in static/chat/covers/<id>.jpg user can swap to actual images later.
             return f'/static/chat/covers/{self.cover_choice}.jpg'
         if self.cover_image:
-            return self.cover_image.url
+            return self.image_url('cover_image', 'cover') or self.cover_image.url
         return '/static/chat/images/default_cover.jpg'
 
+    def image_url(self, field, variant, fmt='jpeg'):
+        """URL of a processed variant (see chat.image_pipeline.VARIANTS), or None until it is ready"""
+        variants = self.image_variants.get(field)
+        if not variants or variants.get('source') != getattr(self, field).name:
+            return None
+        path = variants.get(variant, {}).get(fmt)
+        return default_storage.url(path) if path else None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored files so save() can tell when one changes
+        instance._loaded_images = {
+            field: instance.__dict__.get(field) for field in IMAGE_FIELDS if field in instance.__dict__
+        }
+        return instance
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         
-        # Resize profile picture if it exists
-        if self.profile_picture:
-            self._resize_image(self.profile_picture.path, (300, 300))
-        
-        # Resize cover image if it exists
-        if self.cover_image:
-            self._resize_image(self.cover_image.path, (1200, 400))
-
-    def _resize_image(self, image_path, size):
-        """Resize image to specified size"""
-        try:
-            with Image.open(image_path) as img:
-                img.thumbnail(size, Image.Resampling.LANCZOS)
-                img.save(image_path, optimize=True, quality=85)
-        except Exception as e:
-            print(f"Error resizing image: {e}")
+        # Process profile picture / cover image only when a new file was stored
+        from .image_pipeline import image_pipeline
+        loaded = getattr(self, '_loaded_images', {})
+        for field in IMAGE_FIELDS:
+            if field not in self.__dict__:
+                continue  # Deferred and untouched
+            name = getattr(self, field).name or None
+            if name != (loaded.get(field) or None) and (name or self.image_variants.get(field)):
+                image_pipeline.submit(self.pk, field)
+            loaded[field] = name
+        self._loaded_images = loaded
 
 
 class Room(models.Model):
@@ -241,6 +284,9 @@ class Message(models.Model):
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id']),
+        ]
 
 
 class RoomMember(models.Model):
@@ -347,11 +393,9 @@ class Friendship(models.Model):
     
     @classmethod
     def are_friends(cls, user1, user2):
-        """Check if two users are friends"""
-        return cls.objects.filter(
-            models.Q(sender=user1, receiver=user2, status='accepted') |
-            models.Q(sender=user2, receiver=user1, status='accepted')
-        ).exists()
+        """Check if two users are friends (a lookup in user1's cached friend graph)"""
+        from .friend_graph import friend_graph
+        return friend_graph.are_friends(user1.id, user2.id)
     
     @classmethod
     def get_friendship(cls, user1, user2):
@@ -381,8 +425,85 @@ class FriendNickname(models.Model):
         return f'{self.user.username}\'s nickname for {self.friend.username}: {self.nickname}'
 
 
+class Conversation(models.Model):
+    """Private message thread between two users, with a summary of its last message"""
+    # Canonical pair: user_low always has the smaller user id
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations_as_low')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations_as_high')
+    last_message = models.ForeignKey('PrivateMessage', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    low_unread = models.PositiveIntegerField(default=0)  # Unread messages for user_low
+    high_unread = models.PositiveIntegerField(default=0)  # Unread messages for user_high
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='unique_conversation_pair'),
+        ]
+        indexes = [
+            # One index per side serves a user's inbox, newest first
+            models.Index(fields=['user_low', '-last_message_at', '-id']),
+            models.Index(fields=['user_high', '-last_message_at', '-id']),
+        ]
+    
+    def __str__(self):
+        return f'Conversation {self.user_low_id} <-> {self.user_high_id}'
+    
+    @staticmethod
+    def pair(user1_id, user2_id):
+        """Canonical (low, high) ordering of two user ids"""
+        return (user1_id, user2_id) if user1_id < user2_id else (user2_id, user1_id)
+    
+    @classmethod
+    def between(cls, user1, user2, create=False):
+        """Conversation between two users (None if there is none and create is False)"""
+        low, high = cls.pair(user1.id, user2.id)
+        if create:
+            return cls.objects.get_or_create(user_low_id=low, user_high_id=high)[0]
+        return cls.objects.filter(user_low_id=low, user_high_id=high).first()
+    
+    def other_user_id(self, user_id):
+        return self.user_high_id if user_id == self.user_low_id else self.user_low_id
+    
+    def unread_for(self, user_id):
+        return self.low_unread if user_id == self.user_low_id else self.high_unread
+    
+    @staticmethod
+    def _unread_field(user_id, low_id):
+        return 'low_unread' if user_id == low_id else 'high_unread'
+    
+    @classmethod
+    def post_message(cls, sender, receiver, content):
+        """Create a PrivateMessage and update its conversation summary in one transaction"""
+        from django.db import transaction
+        
+        with transaction.atomic():
+            conversation = cls.between(sender, receiver, create=True)
+            message = PrivateMessage.objects.create(
+                conversation=conversation,
+                sender=sender,
+                receiver=receiver,
+                content=content
+            )
+            cls.objects.filter(id=conversation.id).update(**{
+                'last_message': message,
+                'last_message_at': message.timestamp,
+                cls._unread_field(receiver.id, conversation.user_low_id): models.F(
+                    cls._unread_field(receiver.id, conversation.user_low_id)
+                ) + 1,
+            })
+        return message
+    
+    @classmethod
+    def mark_read(cls, reader, other):
+        """Reset the reader's unread count for the conversation with other"""
+        low, high = cls.pair(reader.id, other.id)
+        cls.objects.filter(user_low_id=low, user_high_id=high).update(**{cls._unread_field(reader.id, low): 0})
+
+
 class PrivateMessage(models.Model):
     """Private messages between friends"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, null=True, blank=True, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_private_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_private_messages')
     content = models.TextField()
@@ -391,6 +512,10 @@ class PrivateMessage(models.Model):
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Keyset history pages within a conversation, newest first
+            models.Index(fields=['conversation', 'timestamp', 'id']),
+        ]
     
     def __str__(self):
         return f'{self.sender.username} -> {self.receiver.username}: {self.content[:50]}'
@@ -441,9 +566,9 @@ class Notification(models.Model):
         self.save()
     
     @classmethod
-    def create_message_notification(cls, sender, receiver, private_message):
+    def create_message_notification(cls, sender, receiver, private_message, commit=True):
         """Create notification for new private message"""
-        return cls.objects.create(
+        notification = cls(
             recipient=receiver,
             sender=sender,
             notification_type='message',
@@ -452,11 +577,14 @@ class Notification(models.Model):
             link=f'/friends/chat/{sender.username}/',
             private_message=private_message
         )
+        if commit:
+            notification.save()
+        return notification
     
     @classmethod
-    def create_friend_request_notification(cls, sender, receiver):
+    def create_friend_request_notification(cls, sender, receiver, commit=True):
         """Create notification for friend request"""
-        return cls.objects.create(
+        notification = cls(
             recipient=receiver,
             sender=sender,
             notification_type='friend_request',
@@ -464,11 +592,14 @@ class Notification(models.Model):
             message=f'{sender.username} wants to be your friend',
             link='/friends/'
         )
+        if commit:
+            notification.save()
+        return notification
     
     @classmethod
-    def create_friend_accepted_notification(cls, sender, receiver):
+    def create_friend_accepted_notification(cls, sender, receiver, commit=True):
         """Create notification when friend request is accepted"""
-        return cls.objects.create(
+        notification = cls(
             recipient=sender,
             sender=receiver,
             notification_type='friend_accepted',
@@ -476,11 +607,14 @@ class Notification(models.Model):
             message=f'You and {receiver.username} are now friends!',
             link=f'/friends/chat/{receiver.username}/'
         )
+        if commit:
+            notification.save()
+        return notification
     
     @classmethod
-    def create_kick_notification(cls, kicked_user, room, kicked_by):
+    def create_kick_notification(cls, kicked_user, room, kicked_by, commit=True):
         """Create notification for being kicked from room"""
-        return cls.objects.create(
+        notification = cls(
             recipient=kicked_user,
             sender=kicked_by,
             notification_type='kicked',
@@ -489,11 +623,14 @@ class Notification(models.Model):
             room=room,
             link='/chat/'
         )
+        if commit:
+            notification.save()
+        return notification
     
     @classmethod
-    def create_ban_notification(cls, banned_user, room, banned_by):
+    def create_ban_notification(cls, banned_user, room, banned_by, commit=True):
         """Create notification for being banned from room"""
-        return cls.objects.create(
+        notification = cls(
             recipient=banned_user,
             sender=banned_by,
             notification_type='banned',
@@ -502,6 +639,28 @@ class Notification(models.Model):
             room=room,
             link='/chat/'
         )
+        if commit:
+            notification.save()
+        return notification
+
+
+class NotificationOutbox(models.Model):
+    """Notification rows and channel events waiting for the dispatcher (see chat.notification_outbox)"""
+    notifications = models.JSONField(default=list, encoder=DjangoJSONEncoder)  # Notification field values
+    events = models.JSONField(default=list, encoder=DjangoJSONEncoder)  # [group, event] pairs, in send order
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['available_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f'Outbox entry {self.id} ({len(self.notifications)} notifications, {len(self.events)} events)'
 
 
 class Gift(models.Model):
@@ -573,6 +732,42 @@ class GiftTransaction(models.Model):
         return f"{self.sender.username} sent {self.quantity}x {self.gift.name} to {self.receiver.username}"
 
 
+class EvercoinLedgerEntry(models.Model):
+    """Append-only Evercoin journal written by chat.evercoin (the entries of one transaction sum to zero)"""
+    KIND_CHOICES = [
+        ('opening_balance', 'Opening balance'),
+        ('gift', 'Gift'),
+        ('game_reward', 'Game reward'),
+        ('admin_grant', 'Admin grant'),
+        ('admin_deduct', 'Admin deduction'),
+        ('transfer', 'Transfer'),
+        ('adjustment', 'Reconciliation adjustment'),
+    ]
+
+    transaction_id = models.UUIDField(db_index=True)
+    # 'wallet' entries belong to user; any other account is a system account (user is null)
+    account = models.CharField(max_length=32, default='wallet')
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='evercoin_entries')
+    amount = models.BigIntegerField(help_text='Signed change to the account')
+    balance_after = models.BigIntegerField(null=True, blank=True, help_text='Wallet balance after this entry')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    reference = models.CharField(max_length=100, blank=True, default='')
+    memo = models.CharField(max_length=200, blank=True, default='')
+    # Only a transaction's first wallet entry carries the key
+    idempotency_key = models.CharField(max_length=150, null=True, blank=True, unique=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['user', '-id']),
+        ]
+
+    def __str__(self):
+        owner = self.user.username if self.user_id else self.account
+        return f"{owner} {self.amount:+,} EC ({self.kind})"
+
+
 class Intimacy(models.Model):
     """Track intimacy points between two users (亲密度)"""
     user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name='intimacy_as_user1')
@@ -593,22 +788,31 @@ class Intimacy(models.Model):
     @staticmethod
     def get_intimacy(user_a, user_b):
         """Get intimacy points between two users"""
-        if user_a.id > user_b.id:
-            user_a, user_b = user_b, user_a
-        
-        intimacy, _ = Intimacy.objects.get_or_create(user1=user_a, user2=user_b)
-        return intimacy.points
+        from .intimacy import intimacy
+        return intimacy.points(user_a, user_b)
     
     @staticmethod
     def add_intimacy(user_a, user_b, points):
-        """Add intimacy points between two users"""
-        if user_a.id > user_b.id:
-            user_a, user_b = user_b, user_a
-        
-        intimacy, _ = Intimacy.objects.get_or_create(user1=user_a, user2=user_b)
-        intimacy.points += points
-        intimacy.save()
-        return intimacy
+        """Add intimacy points between two users; returns the new total"""
+        from .intimacy import intimacy
+        return intimacy.add(user_a, user_b, points)
+
+
+class IntimacyLeaderboardEntry(models.Model):
+    """One direction of an Intimacy pair, so a user's top-N is a single index range scan"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='intimacy_leaderboard')
+    other = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    points = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = [['user', 'other']]
+        indexes = [
+            models.Index(fields=['user', '-points', 'other']),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} -> {self.other.username}: {self.points}"
 
 
 class GifPack(models.Model):
@@ -655,7 +859,6 @@ class GifFile(models.Model):
         ordering = ['pack', 'order', 'title']
         indexes = [
             models.Index(fields=['pack', '-created_at']),
-            models.Index(fields=['tags']),
         ]
     
     def __str__(self):
@@ -676,9 +879,10 @@ class GifFile(models.Model):
         return ''
     
     def increment_views(self):
-        """Increment view counter"""
+        """Increment view counter (buffered and written in aggregate by gif_activity)"""
+        from .gif_activity import gif_activity
         self.views += 1
-        self.save(update_fields=['views'])
+        gif_activity.record_view(self.id)
 
 
 class GifUsageLog(models.Model):
@@ -700,6 +904,49 @@ class GifUsageLog(models.Model):
         return f"{self.user.username} sent {self.gif.title} in {self.room.name}"
 
 
+
+
+class GifTrending(models.Model):
+    """Rolled-up GIF activity with a time-decayed trending score (see chat.gif_activity)"""
+    gif = models.OneToOneField(GifFile, on_delete=models.CASCADE, primary_key=True, related_name='trending')
+    score = models.FloatField(help_text='log2 of forward-decayed activity')
+    views = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['-score']),
+        ]
+    
+    def __str__(self):
+        return f"{self.gif_id}: {self.score:.3f}"
+
+class GifSearchTerm(models.Model):
+    """Search vocabulary: one row per distinct token, with its document frequency"""
+    term = models.CharField(max_length=64, unique=True)
+    doc_count = models.IntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.term} ({self.doc_count})"
+
+
+class GifSearchPosting(models.Model):
+    """A GIF containing a term; impact is the term's BM25 weight in that GIF (without IDF)"""
+    term = models.ForeignKey(GifSearchTerm, on_delete=models.CASCADE, related_name='postings')
+    gif = models.ForeignKey(GifFile, on_delete=models.CASCADE, related_name='search_postings')
+    frequency = models.FloatField(help_text='Field-weighted term frequency')
+    impact = models.FloatField()
+    
+    class Meta:
+        unique_together = [['term', 'gif']]
+        indexes = [
+            # Top postings of a term, read with LIMIT
+            models.Index(fields=['term', '-impact', 'gif']),
+        ]
+    
+    def __str__(self):
+        return f"{self.term_id} in {self.gif_id}: {self.impact:.3f}"
+
 class GameSession(models.Model):
     """Track user game sessions and rewards"""
     GAME_CHOICES = [
@@ -827,7 +1074,7 @@ class MultiplayerGame2048(models.Model):
 
 
 # Signal to automatically create UserProfile when User is created
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
 @receiver(post_save, sender=User)
@@ -845,3 +1092,55 @@ def save_user_profile(sender, instance, **kwargs):
         print(f'[SIGNAL] Created missing profile for user: {instance.username}')
 
 
+
+@receiver(post_save, sender=Notification)
+def announce_notification(sender, instance, created, **kwargs):
+    """Count a new unread notification and push it to the recipient's sockets"""
+    if created:
+        from .notification_feed import created_events
+        from .notification_outbox import notification_outbox
+        from .unread_counts import unread_counts
+        if not instance.is_read:
+            unread_counts.add_notifications(instance.recipient_id)
+        notification_outbox.enqueue(events=created_events([instance]))
+
+@receiver(post_save, sender=PrivateMessage)
+def count_unread_private_message(sender, instance, created, **kwargs):
+    """Keep the receiver's cached unread counter for this sender in step"""
+    if created and not instance.is_read:
+        from .unread_counts import unread_counts
+        unread_counts.add_message(instance.receiver_id, instance.sender_id)
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def invalidate_friend_graph(sender, instance, **kwargs):
+    """Both users' cached friend sets are rebuilt on their next read"""
+    from .friend_graph import friend_graph
+    friend_graph.invalidate(instance.sender_id, instance.receiver_id)
+
+@receiver(post_save, sender=GifFile)
+def index_gif(sender, instance, update_fields=None, **kwargs):
+    """Re-index a GIF when its searchable fields change (not on view count updates)"""
+    from .gif_search import INDEXED_FIELDS, gif_search
+    if update_fields is not None and not INDEXED_FIELDS.intersection(update_fields):
+        return
+    gif_search.submit(instance.pk)
+
+@receiver(pre_delete, sender=GifFile)
+def unindex_gif(sender, instance, **kwargs):
+    """Release the GIF's document frequencies before its postings cascade away"""
+    from .gif_search import gif_search
+    gif_search.remove(instance.pk)
+
+@receiver(post_save, sender=Gift)
+@receiver(post_delete, sender=Gift)
+@receiver(post_save, sender=GifPack)
+@receiver(post_delete, sender=GifPack)
+@receiver(post_save, sender=GifFile)
+@receiver(post_delete, sender=GifFile)
+def invalidate_catalog(sender, instance, update_fields=None, **kwargs):
+    """Gift and GIF picker snapshots are rebuilt on their next request"""
+    from .catalog import catalog
+    if update_fields is not None and set(update_fields) <= {'views'}:
+        return
+    catalog.invalidate()
@@ -3,6 +3,9 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
 
+from .fanout import dumps, encoded_event
+from .notification_feed import mark_read, snapshot
+
 
 class NotificationConsumer(AsyncWebsocketConsumer):
     """WebSocket consumer for real-time notifications"""
@@ -26,6 +29,9 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         
         await self.accept()
         print(f'[NOTIFICATION] User {self.user.username} connected to notifications')
+        
+        # Initial state: unread count and newest notifications (replaces HTTP polling)
+        await self.send(text_data=dumps(await self.load_snapshot()))
     
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection"""
@@ -37,8 +43,32 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             print(f'[NOTIFICATION] User {self.user.username} disconnected from notifications')
     
     async def receive(self, text_data):
-        """Handle messages from WebSocket (not used for notifications, but required)"""
-        pass
+        """Handle read acknowledgements from the client"""
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            return
+        
+        if data.get('type') == 'mark_read':
+            ids = [int(i) for i in data.get('ids', []) if str(i).isdigit()]
+            if ids:
+                await self.acknowledge(ids)
+        elif data.get('type') == 'mark_all_read':
+            await self.acknowledge(None)
+    
+    async def acknowledge(self, ids):
+        """Mark notifications read and update the badge on all of this user's sockets"""
+        badge_delta = await database_sync_to_async(mark_read)(self.user, ids)
+        if badge_delta:
+            await self.channel_layer.group_send(self.notification_group_name, encoded_event(badge_delta))
+    
+    @database_sync_to_async
+    def load_snapshot(self):
+        return snapshot(self.user.id)
+    
+    async def send_encoded(self, event):
+        """Forward a pre-encoded feed event (notification_created, badge_delta)"""
+        await self.send(text_data=event['text'])
     
     async def new_message_notification(self, event):
         """Send new message notification to WebSocket"""
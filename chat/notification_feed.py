@@ -0,0 +1,105 @@
+"""
+Notification feed pushed over NotificationConsumer.
+
+A notification socket receives a snapshot on connect (the unread count plus
+the newest SNAPSHOT_SIZE notifications) and then incremental events, so the
+page no longer polls chat/notifications/count/ and chat/notifications/list/:
+
+    {"type": "snapshot", "unread_count": 3, "notifications": [...]}
+    {"type": "notification_created", "notification": {...}}
+    {"type": "badge_delta", "delta": -1, "unread_count": 3, "ids": [12]}
+
+Clients add one to the badge for each unread notification_created and take
+unread_count from every badge_delta. badge_delta goes to all of a user's
+sockets whenever notifications are marked read, over HTTP or with a
+{"type": "mark_read", "ids": [...]} or {"type": "mark_all_read"} message on
+the socket (the latter's badge_delta carries "all": true instead of "ids").
+"""
+
+from .fanout import encoded_event
+from .unread_counts import unread_counts
+
+
+SNAPSHOT_SIZE = 20
+
+
+def notification_group(username):
+    return f'notifications_{username}'
+
+
+def serialize_notification(notification, sender_username=None):
+    if sender_username is None and notification.sender_id:
+        sender_username = notification.sender.username
+    return {
+        'id': notification.id,
+        'type': notification.notification_type,
+        'sender': sender_username or 'System',
+        'title': notification.title,
+        'message': notification.message,
+        'link': notification.link,
+        'timestamp': notification.created_at.isoformat(),
+        'is_read': notification.is_read,
+    }
+
+
+def recent_notifications(user_id, limit=SNAPSHOT_SIZE):
+    from .models import Notification
+
+    notifications = Notification.objects.filter(
+        recipient_id=user_id
+    ).select_related('sender').order_by('-created_at', '-id')[:limit]
+    return [serialize_notification(notification) for notification in notifications]
+
+
+def snapshot(user_id):
+    """Client payload sent when a notification socket connects"""
+    return {
+        'type': 'snapshot',
+        'unread_count': unread_counts.notifications(user_id),
+        'notifications': recent_notifications(user_id),
+    }
+
+
+def created_events(notifications):
+    """(group, event) pairs announcing freshly written Notification rows, in the same order"""
+    from django.contrib.auth.models import User
+
+    usernames = dict(User.objects.filter(
+        id__in={notification.recipient_id for notification in notifications}
+        | {notification.sender_id for notification in notifications if notification.sender_id}
+    ).values_list('id', 'username'))
+    return [
+        (notification_group(usernames[notification.recipient_id]), encoded_event({
+            'type': 'notification_created',
+            'notification': serialize_notification(notification, usernames.get(notification.sender_id)),
+        }))
+        for notification in notifications
+    ]
+
+
+def mark_read(user, ids=None):
+    """Mark the user's notifications read (all unread ones when ids is None); returns the badge_delta payload or None"""
+    from .models import Notification
+
+    unread = Notification.objects.filter(recipient=user, is_read=False)
+    if ids is not None:
+        unread = unread.filter(id__in=ids)
+    marked = unread.update(is_read=True)
+    if not marked:
+        return None
+    unread_counts.read_notifications(user.id, marked)
+    payload = {
+        'type': 'badge_delta',
+        'delta': -marked,
+        'unread_count': unread_counts.notifications(user.id),
+    }
+    if ids is None:
+        payload['all'] = True
+    else:
+        payload['ids'] = list(ids)
+    return payload
+
+
+def badge_delta_events(user, payload):
+    """(group, event) pair sending a badge_delta to all of the user's sockets"""
+    return [(notification_group(user.username), encoded_event(payload))]
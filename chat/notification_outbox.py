@@ -0,0 +1,308 @@
+"""
+Transactional outbox for notifications and their WebSocket events.
+
+Views used to create Notification rows and call group_send once per recipient
+channel, in series, before returning. They now enqueue a single
+NotificationOutbox row holding the Notification field values and the channel
+events, and return. A dispatcher drains the outbox in batches: it writes every
+batch's Notification rows with one bulk_create, then sends the events
+concurrently (one ordered chain per group, all groups at once), each entry's
+notification_created events (see chat.notification_feed) first.
+
+Failed sends are retried with exponential backoff; notification rows are
+cleared from an entry as soon as they are written, so a retry never
+duplicates them. Entries that still fail after MAX_ATTEMPTS are dropped and
+counted as notifications.outbox.dropped.
+
+The dispatcher runs inside the web process (MODE 'thread': as a task on the
+ASGI server's event loop, or in a background thread outside a server) or in
+`python manage.py dispatch_notifications` (MODE 'worker'). Configure via the
+NOTIFICATION_OUTBOX setting:
+
+    NOTIFICATION_OUTBOX = {
+        'MODE': 'thread',
+        'BATCH_SIZE': 100,
+        'POLL_INTERVAL_MS': 1000,
+        'MAX_ATTEMPTS': 8,
+        'RETRY_BACKOFF_MS': 500,
+        'LEASE_SECONDS': 30,
+    }
+"""
+
+import asyncio
+import atexit
+import contextvars
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from asgiref.sync import SyncToAsync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import metrics
+from .notification_feed import created_events
+from .unread_counts import unread_counts
+
+
+DEFAULT_NOTIFICATION_OUTBOX = {
+    'MODE': 'thread',  # 'thread' (dispatch in-process) or 'worker' (manage.py dispatch_notifications)
+    'BATCH_SIZE': 100,  # Outbox entries claimed per dispatch round
+    'POLL_INTERVAL_MS': 1000,  # Idle poll for entries enqueued by other processes or due for retry
+    'MAX_ATTEMPTS': 8,  # Send attempts before an entry is dropped
+    'RETRY_BACKOFF_MS': 500,  # First retry delay, doubled on every attempt
+    'LEASE_SECONDS': 30,  # How long a claimed entry is hidden from other dispatchers
+}
+
+
+def notification_fields(notification):
+    """Field values of an unsaved Notification, as stored in the outbox"""
+    return {
+        field.attname: field.value_from_object(notification)
+        for field in notification._meta.concrete_fields
+        if not field.primary_key
+    }
+
+
+def notification_from_fields(fields):
+    """Unsaved Notification rebuilt from outbox field values (datetimes come back as strings)"""
+    from .models import Notification
+
+    return Notification(**{
+        name: Notification._meta.get_field(name).to_python(value) for name, value in fields.items()
+    })
+
+
+class NotificationDispatcher:
+    """Enqueues notification work and delivers it off the request path"""
+
+    def __init__(self, mode='thread', batch_size=100, poll_interval_ms=1000,
+                 max_attempts=8, retry_backoff_ms=500, lease_seconds=30):
+        if mode not in ('thread', 'worker'):
+            raise ValueError("NOTIFICATION_OUTBOX['MODE'] must be 'thread' or 'worker'")
+        self.mode = mode
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval_ms / 1000.0
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff_ms / 1000.0
+        self.lease = timedelta(seconds=lease_seconds)
+
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._thread = None
+        self._stopping = False
+
+    # ---- producer side -------------------------------------------------
+
+    def enqueue(self, notifications=(), events=()):
+        """Queue unsaved Notification objects and (group, event) pairs; returns the outbox entry"""
+        from .models import NotificationOutbox
+
+        notifications = [notification_fields(n) for n in notifications]
+        events = [[group, event] for group, event in events]
+        if not notifications and not events:
+            return None
+        entry = NotificationOutbox.objects.create(notifications=notifications, events=events)
+        metrics.incr('notifications.outbox.enqueued')
+        if self.mode == 'thread':
+            self._ensure_started()
+            # Wake the dispatcher once the row is visible to its connection
+            transaction.on_commit(self.wake)
+        return entry
+
+    # ---- dispatcher ------------------------------------------------------
+
+    def _ensure_started(self):
+        # Inside an ASGI server, sync views run in a worker thread of the server's
+        # event loop: dispatch on that loop, next to the consumers (the in-memory
+        # channel layer only delivers within one loop). Elsewhere use a thread.
+        server_loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+        with self._lock:
+            if self._task is not None and not self._task.done():
+                return
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if server_loop is not None and server_loop.is_running():
+                # A fresh context, so the task doesn't inherit this request's sync_to_async state
+                self._task = contextvars.Context().run(asyncio.run_coroutine_threadsafe, self.run(), server_loop)
+            else:
+                self._thread = threading.Thread(
+                    target=asyncio.run, args=(self.run(),), name='notification-dispatcher', daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.stop)
+
+    async def run(self, once=False):
+        """Dispatch until stopped (or until the outbox is empty when once=True)"""
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                dispatched = await self.dispatch_batch()
+            except Exception as e:
+                print(f'[NOTIFICATIONS] Dispatch round failed: {e}')
+                metrics.incr('notifications.outbox.dispatch_errors')
+                dispatched = 0
+            if once and not dispatched:
+                return
+            if dispatched < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def stop(self):
+        self._stopping = True
+        self.wake()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def wake(self):
+        """Start a dispatch round now instead of at the next poll"""
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            # The dispatcher's loop has already closed
+            pass
+
+    def _claim(self):
+        """Lease the next due entries so concurrent dispatchers skip them"""
+        from .models import NotificationOutbox
+
+        close_old_connections()
+        now = timezone.now()
+        with transaction.atomic():
+            entries = list(
+                NotificationOutbox.objects.select_for_update(skip_locked=True)
+                .filter(available_at__lte=now)
+                .order_by('id')[:self.batch_size]
+            )
+            if entries:
+                NotificationOutbox.objects.filter(id__in=[e.id for e in entries]).update(available_at=now + self.lease)
+        return entries
+
+    async def dispatch_batch(self):
+        """Deliver one batch of due outbox entries; returns how many were claimed"""
+        entries = await database_sync_to_async(self._claim)()
+        if not entries:
+            return 0
+        started = time.perf_counter()
+        errors = {}
+        await database_sync_to_async(self._write_notifications)(entries, errors)
+        failed = await self._send_events(entries, errors)
+        await database_sync_to_async(self._settle)(entries, failed, errors)
+        metrics.observe('notifications.outbox.dispatch_seconds', time.perf_counter() - started)
+        return len(entries)
+
+    def _write_notifications(self, entries, errors):
+        pending = [entry for entry in entries if entry.notifications]
+        if not pending:
+            return
+        try:
+            self._bulk_write(pending)
+        except DatabaseError:
+            # One bad entry (e.g. a recipient deleted meanwhile) must not hold back the rest
+            for entry in pending:
+                try:
+                    self._bulk_write([entry])
+                except DatabaseError as e:
+                    errors[entry.id] = f'notification write failed: {e}'
+
+    @staticmethod
+    def _bulk_write(entries):
+        from .models import Notification, NotificationOutbox
+
+        rows = [[notification_from_fields(fields) for fields in entry.notifications] for entry in entries]
+        written = [row for entry_rows in rows for row in entry_rows]
+        with transaction.atomic():
+            Notification.objects.bulk_create(written)
+            # Announce the rows ahead of each entry's own events; clearing the
+            # rows from the entry in the same transaction keeps retries idempotent
+            created = iter(created_events(written))
+            updated = [
+                NotificationOutbox(id=entry.id, notifications=[], events=[
+                    list(next(created)) for _ in entry_rows
+                ] + entry.events)
+                for entry, entry_rows in zip(entries, rows)
+            ]
+            NotificationOutbox.objects.bulk_update(updated, ['notifications', 'events'])
+        for entry, update in zip(entries, updated):
+            entry.notifications, entry.events = update.notifications, update.events
+        # bulk_create sends no post_save, so bump the unread counters here
+        recipients = Counter(row.recipient_id for row in written if not row.is_read)
+        for recipient_id, count in recipients.items():
+            unread_counts.add_notifications(recipient_id, count)
+        metrics.incr('notifications.outbox.written', len(written))
+
+    async def _send_events(self, entries, errors):
+        """Send all events, one ordered chain per group; returns {entry_id: unsent events}"""
+        channel_layer = get_channel_layer()
+        chains = {}
+        for entry in entries:
+            if entry.id in errors:
+                continue
+            for index, (group, event) in enumerate(entry.events):
+                chains.setdefault(group, []).append((entry.id, index, event))
+
+        async def send_chain(group, chain):
+            for position, (entry_id, index, event) in enumerate(chain):
+                try:
+                    await channel_layer.group_send(group, event)
+                except Exception as e:
+                    # Later events for this group wait too, so the group sees them in order
+                    return [(entry_id, index, str(e)) for entry_id, index, _ in chain[position:]]
+            metrics.incr('notifications.outbox.sent', len(chain))
+            return []
+
+        results = await asyncio.gather(*(send_chain(group, chain) for group, chain in chains.items()))
+        failed = {}
+        for result in results:
+            for entry_id, index, error in result:
+                failed.setdefault(entry_id, set()).add(index)
+                errors.setdefault(entry_id, error)
+        return failed
+
+    def _settle(self, entries, failed, errors):
+        from .models import NotificationOutbox
+
+        done = []
+        now = timezone.now()
+        for entry in entries:
+            if entry.id not in errors:
+                done.append(entry.id)
+                metrics.observe('notifications.outbox.lag_seconds', (now - entry.created_at).total_seconds())
+                continue
+            entry.attempts += 1
+            if entry.attempts >= self.max_attempts:
+                print(f'[NOTIFICATIONS] Dropping outbox entry {entry.id} after {entry.attempts} attempts: {errors[entry.id]}')
+                metrics.incr('notifications.outbox.dropped')
+                done.append(entry.id)
+                continue
+            if entry.id in failed:
+                entry.events = [event for index, event in enumerate(entry.events) if index in failed[entry.id]]
+            entry.last_error = errors[entry.id]
+            entry.available_at = now + timedelta(seconds=self.retry_backoff * 2 ** (entry.attempts - 1))
+            entry.save(update_fields=['events', 'attempts', 'last_error', 'available_at'])
+            metrics.incr('notifications.outbox.retries')
+        if done:
+            NotificationOutbox.objects.filter(id__in=done).delete()
+
+
+def create_notification_dispatcher(config=None):
+    config = dict(DEFAULT_NOTIFICATION_OUTBOX, **(config or getattr(settings, 'NOTIFICATION_OUTBOX', {})))
+    return NotificationDispatcher(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared dispatcher instance, created on first use
+notification_outbox = SimpleLazyObject(create_notification_dispatcher)
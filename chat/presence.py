@@ -0,0 +1,495 @@
+"""
+Room presence tracking for chat rooms.
+
+Each room member is stored as an individual entry with its own last-seen
+timestamp, so joins, leaves and heartbeats touch a single member instead of
+rewriting the whole active-user list. Entries older than the configured TTL
+are treated as expired and are hidden from reads even before they are removed.
+
+Configure via the PRESENCE setting:
+
+    PRESENCE = {
+        'BACKEND': 'chat.presence.RedisPresenceBackend',
+        'LOCATION': 'redis://localhost:6379/0',
+        'TTL': 120,
+        'REAP_INTERVAL': 30,
+    }
+
+Expired members are removed by a single PresenceReaper per worker process
+rather than by every connection; with a shared backend only the worker holding
+the reaper lease evicts, so each departure is announced exactly once.
+"""
+
+import asyncio
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from django.utils.module_loading import import_string
+
+from .fanout import encoded_event
+from .metrics import metrics
+
+
+DEFAULT_PRESENCE = {
+    'BACKEND': 'chat.presence.LocMemPresenceBackend',
+    'TTL': 120,  # Seconds without a heartbeat before a member is considered gone
+    'REAP_INTERVAL': 30,  # Seconds between reaper passes
+}
+
+
+class BasePresenceBackend:
+    """Common interface for presence backends"""
+
+    def __init__(self, ttl=120, reap_interval=30, key_prefix='presence', **options):
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+        self.key_prefix = key_prefix
+
+    def join(self, room, username, display_name, now=None):
+        """Add or refresh a member. Returns the previous last-seen time, or None if they were absent."""
+        raise NotImplementedError
+
+    def leave(self, room, username):
+        """
+        Remove a member. Returns their display name to the one caller that actually
+        removed them, and None to everyone else (so departures are announced once).
+        """
+        raise NotImplementedError
+
+    def touch(self, room, username, now=None):
+        """Refresh a member's last-seen time. Returns False if they are not present."""
+        raise NotImplementedError
+
+    def touch_many(self, room, usernames, now=None):
+        """Refresh several members of one room in a single round trip"""
+        for username in usernames:
+            self.touch(room, username, now=now)
+
+    def acquire_leadership(self, name, owner, ttl):
+        """Claim (or renew) a named lease so only one worker runs a periodic job"""
+        return True
+
+    def last_seen(self, room, username):
+        """Last-seen timestamp for a member, or None if absent"""
+        raise NotImplementedError
+
+    def members(self, room, now=None):
+        """Live members of a room as a list of {'username', 'display_name'} dicts"""
+        raise NotImplementedError
+
+    def expired(self, room, now=None):
+        """Usernames whose last-seen time is older than the TTL, oldest first"""
+        raise NotImplementedError
+
+    def rooms(self):
+        """Names of all rooms that currently have presence entries"""
+        raise NotImplementedError
+
+    def clear(self, room):
+        """Drop every presence entry for a room (e.g. when it is deleted)"""
+        raise NotImplementedError
+
+    def forget_if_empty(self, room):
+        """Drop a room from the room index once its last member has left"""
+
+    def evict_expired(self, room, now=None):
+        """
+        Remove a room's expired members (and the room from the index once it is
+        empty). Returns {username: display_name} of the members this call removed.
+        """
+        removed = {}
+        for username in self.expired(room, now=now):
+            display_name = self.leave(room, username)
+            if display_name is not None:
+                removed[username] = display_name
+        self.forget_if_empty(room)
+        return removed
+
+    def usernames(self, room, now=None):
+        return {member['username'] for member in self.members(room, now=now)}
+
+    def is_present(self, room, username, now=None):
+        seen = self.last_seen(room, username)
+        if seen is None:
+            return False
+        now = time.time() if now is None else now
+        return (now - seen) <= self.ttl
+
+
+class LocMemPresenceBackend(BasePresenceBackend):
+    """Process-local backend for development and single-worker deployments"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._lock = threading.Lock()
+        # room -> OrderedDict(username -> (last_seen, display_name)), oldest first
+        self._rooms = {}
+
+    def join(self, room, username, display_name, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = self._rooms.setdefault(room, OrderedDict())
+            previous = entries.pop(username, None)
+            entries[username] = (now, display_name)
+        return previous[0] if previous else None
+
+    def leave(self, room, username):
+        with self._lock:
+            entries = self._rooms.get(room)
+            if not entries or username not in entries:
+                return None
+            _, display_name = entries.pop(username)
+            if not entries:
+                del self._rooms[room]
+        return display_name
+
+    def touch(self, room, username, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = self._rooms.get(room)
+            if not entries or username not in entries:
+                return False
+            _, display_name = entries.pop(username)
+            entries[username] = (now, display_name)
+        return True
+
+    def last_seen(self, room, username):
+        with self._lock:
+            entry = self._rooms.get(room, {}).get(username)
+        return entry[0] if entry else None
+
+    def members(self, room, now=None):
+        cutoff = (time.time() if now is None else now) - self.ttl
+        with self._lock:
+            entries = list(self._rooms.get(room, {}).items())
+        return [
+            {'username': username, 'display_name': display_name}
+            for username, (seen, display_name) in entries
+            if seen >= cutoff
+        ]
+
+    def expired(self, room, now=None):
+        cutoff = (time.time() if now is None else now) - self.ttl
+        stale = []
+        with self._lock:
+            # Entries are kept in last-seen order, so stop at the first live one
+            for username, (seen, _) in self._rooms.get(room, {}).items():
+                if seen >= cutoff:
+                    break
+                stale.append(username)
+        return stale
+
+    def rooms(self):
+        with self._lock:
+            return list(self._rooms.keys())
+
+    def clear(self, room):
+        with self._lock:
+            self._rooms.pop(room, None)
+
+
+class RedisPresenceBackend(BasePresenceBackend):
+    """
+    Redis backend shared by every worker.
+
+    Per room it keeps a hash of username -> display name and a sorted set of
+    username -> last-seen time, which doubles as the ordered expiry index.
+    """
+
+    def __init__(self, location=None, client=None, **options):
+        super().__init__(**options)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(location, decode_responses=True)
+        self.client = client
+        # Keys outlive the member TTL so an abandoned room eventually disappears
+        self.key_expiry = max(int(self.ttl) * 10, 3600)
+
+    def _members_key(self, room):
+        return f'{self.key_prefix}:{room}:members'
+
+    def _seen_key(self, room):
+        return f'{self.key_prefix}:{room}:seen'
+
+    def _rooms_key(self):
+        return f'{self.key_prefix}:rooms'
+
+    def join(self, room, username, display_name, now=None):
+        now = time.time() if now is None else now
+        members_key, seen_key = self._members_key(room), self._seen_key(room)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zscore(seen_key, username)
+        pipe.hset(members_key, username, display_name)
+        pipe.zadd(seen_key, {username: now})
+        pipe.sadd(self._rooms_key(), room)
+        pipe.expire(members_key, self.key_expiry)
+        pipe.expire(seen_key, self.key_expiry)
+        previous = pipe.execute()[0]
+        return float(previous) if previous is not None else None
+
+    def leave(self, room, username):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hget(self._members_key(room), username)
+        pipe.hdel(self._members_key(room), username)
+        pipe.zrem(self._seen_key(room), username)
+        display_name, removed, unindexed = pipe.execute()
+        if not (removed or unindexed):
+            return None
+        return display_name or username
+
+    def touch(self, room, username, now=None):
+        now = time.time() if now is None else now
+        # XX: only update members that still exist, never resurrect a reaped one
+        changed = self.client.zadd(self._seen_key(room), {username: now}, xx=True, ch=True)
+        if changed:
+            return True
+        return self.client.zscore(self._seen_key(room), username) is not None
+
+    def touch_many(self, room, usernames, now=None):
+        usernames = list(usernames)
+        if not usernames:
+            return
+        now = time.time() if now is None else now
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(self._seen_key(room), {username: now for username in usernames}, xx=True)
+        pipe.expire(self._members_key(room), self.key_expiry)
+        pipe.expire(self._seen_key(room), self.key_expiry)
+        pipe.execute()
+
+    def acquire_leadership(self, name, owner, ttl):
+        key = f'{self.key_prefix}:leader:{name}'
+        if self.client.set(key, owner, nx=True, ex=int(ttl)):
+            return True
+        if self.client.get(key) == owner:
+            self.client.expire(key, int(ttl))
+            return True
+        return False
+
+    def last_seen(self, room, username):
+        seen = self.client.zscore(self._seen_key(room), username)
+        return float(seen) if seen is not None else None
+
+    def members(self, room, now=None):
+        cutoff = (time.time() if now is None else now) - self.ttl
+        usernames = self.client.zrangebyscore(self._seen_key(room), cutoff, '+inf')
+        if not usernames:
+            return []
+        display_names = self.client.hmget(self._members_key(room), usernames)
+        return [
+            {'username': username, 'display_name': display_name or username}
+            for username, display_name in zip(usernames, display_names)
+        ]
+
+    def expired(self, room, now=None):
+        cutoff = (time.time() if now is None else now) - self.ttl
+        return self.client.zrangebyscore(self._seen_key(room), '-inf', f'({cutoff}')
+
+    def rooms(self):
+        return list(self.client.smembers(self._rooms_key()))
+
+    def forget_if_empty(self, room):
+        """Drop a room from the room index once its last member has left"""
+        from redis.exceptions import WatchError
+
+        seen_key = self._seen_key(room)
+        with self.client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    # WATCH: a join between the check and the SREM aborts the SREM
+                    pipe.watch(seen_key)
+                    if pipe.zcard(seen_key):
+                        pipe.unwatch()
+                        return
+                    pipe.multi()
+                    pipe.srem(self._rooms_key(), room)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue  # Check again
+
+    def evict_expired(self, room, now=None):
+        """Remove a room's expired members in one transaction, however many there are"""
+        from redis.exceptions import WatchError
+
+        cutoff = (time.time() if now is None else now) - self.ttl
+        members_key, seen_key = self._members_key(room), self._seen_key(room)
+        with self.client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    # WATCH: a join, touch or leave before the EXEC aborts it, so a
+                    # member is never evicted after a heartbeat or announced twice
+                    pipe.watch(seen_key)
+                    reads = self.client.pipeline(transaction=False)
+                    reads.zrangebyscore(seen_key, '-inf', f'({cutoff}')
+                    reads.zcard(seen_key)
+                    expired, count = reads.execute()
+                    if expired:
+                        pipe.multi()
+                        pipe.hmget(members_key, expired)
+                        pipe.hdel(members_key, *expired)
+                        pipe.zrem(seen_key, *expired)
+                    elif count:
+                        pipe.unwatch()
+                        return {}
+                    else:
+                        pipe.multi()
+                    if len(expired) == count:
+                        pipe.srem(self._rooms_key(), room)
+                    results = pipe.execute()
+                    break
+                except WatchError:
+                    continue  # Check again
+        if not expired:
+            return {}
+        return {
+            username: display_name or username
+            for username, display_name in zip(expired, results[0])
+        }
+
+    def clear(self, room):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(self._members_key(room), self._seen_key(room))
+        pipe.srem(self._rooms_key(), room)
+        pipe.execute()
+
+
+def create_presence_backend(config=None):
+    """Build a presence backend from a PRESENCE-style config dict"""
+    config = dict(DEFAULT_PRESENCE, **(config or getattr(settings, 'PRESENCE', {})))
+    backend_cls = import_string(config.pop('BACKEND'))
+    options = {key.lower(): value for key, value in config.items()}
+    options.update(options.pop('options', {}) or {})
+    return backend_cls(**options)
+
+
+# Shared backend instance, created on first use (like django.core.cache.cache)
+presence = SimpleLazyObject(create_presence_backend)
+
+
+class PresenceReaper:
+    """
+    Per-process presence maintenance.
+
+    Every pass refreshes the last-seen time of all sockets held by this worker
+    (one batched call per room), then - on the worker holding the reaper lease -
+    evicts expired members across all rooms (one backend call per room), marks
+    them offline in one UPDATE per room and sends one user_leave per member plus
+    one active_users_update per affected room. Backend calls may block on Redis,
+    so they run in a thread rather than on the event loop.
+    """
+
+    LEASE_NAME = 'reaper'
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else presence
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._local = {}  # room -> {username: open socket count} on this worker
+        self._task = None
+
+    def register(self, room, username):
+        """Track a socket opened on this worker"""
+        users = self._local.setdefault(room, {})
+        users[username] = users.get(username, 0) + 1
+
+    def unregister(self, room, username):
+        """Stop tracking a socket closed on this worker"""
+        users = self._local.get(room)
+        if not users or username not in users:
+            return
+        users[username] -= 1
+        if users[username] <= 0:
+            del users[username]
+        if not users:
+            del self._local[room]
+
+    def is_connected_locally(self, room, username):
+        return username in self._local.get(room, {})
+
+    def ensure_running(self):
+        """Start the reaper loop on the current event loop if it isn't already running"""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.backend.reap_interval)
+                try:
+                    await self.run_once()
+                except Exception as e:
+                    print(f'[PRESENCE] Reaper pass failed: {e}')
+        except asyncio.CancelledError:
+            pass  # Event loop shutting down
+
+    async def run_once(self, now=None):
+        """Run a single pass. Returns {room: {username: display_name}} of evicted members."""
+        now = time.time() if now is None else now
+        started = time.perf_counter()
+
+        # Snapshot the sockets here: register/unregister keep running on the loop
+        local = {room: list(users) for room, users in self._local.items()}
+        evictions, members = await sync_to_async(self._sweep, thread_sensitive=False)(local, now)
+        if evictions:
+            await self._mark_offline(evictions)
+            await self._announce(evictions, members)
+
+        eviction_count = sum(len(removed) for removed in evictions.values())
+        metrics.observe('presence.reaper.pass_seconds', time.perf_counter() - started)
+        metrics.incr('presence.reaper.evictions', eviction_count)
+        if eviction_count:
+            print(f'[PRESENCE] Reaper evicted {eviction_count} member(s) from {len(evictions)} room(s)')
+        return evictions
+
+    def _sweep(self, local, now):
+        """Refresh local sockets and, with the lease, evict; returns (evictions, members of affected rooms)"""
+        for room, usernames in local.items():
+            self.backend.touch_many(room, usernames, now=now)
+
+        evictions = {}
+        lease_ttl = self.backend.reap_interval * 2
+        if self.backend.acquire_leadership(self.LEASE_NAME, self.owner, lease_ttl):
+            for room in self.backend.rooms():
+                removed = self.backend.evict_expired(room, now=now)
+                if removed:
+                    evictions[room] = removed
+        members = {room: self.backend.members(room, now=now) for room in evictions}
+        return evictions, members
+
+    @database_sync_to_async
+    def _mark_offline(self, evictions):
+        from .models import RoomMember
+
+        seen_at = timezone.now()
+        for room, removed in evictions.items():
+            RoomMember.objects.filter(
+                room__name=room, user__username__in=list(removed)
+            ).update(status='offline', last_seen=seen_at)
+
+    async def _announce(self, evictions, members):
+        channel_layer = get_channel_layer()
+        for room, removed in evictions.items():
+            group_name = f'chat_{room}'
+            for username, display_name in removed.items():
+                await channel_layer.group_send(group_name, encoded_event({
+                    'type': 'user_leave',
+                    'username': username,
+                    'display_name': display_name,
+                }))
+            await channel_layer.group_send(group_name, encoded_event({
+                'type': 'active_users',
+                'users': members[room],
+            }))
+
+
+presence_reaper = PresenceReaper()
@@ -2,7 +2,9 @@ import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from .models import PrivateMessage, Friendship
+from .models import PrivateMessage, Friendship, Conversation
+from .conversations import fetch_private_history, serialize_private_message
+from .history import InvalidCursor, clamp_page_size
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from datetime import datetime
@@ -79,6 +81,9 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
                     # Send notification to receiver
                     await self.send_notification_to_receiver(message)
             
+            elif message_type == 'history':
+                await self.send_history(data.get('before'), data.get('limit'))
+            
             elif message_type == 'typing':
                 is_typing = data.get('is_typing', False)
                 
@@ -95,6 +100,28 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             print(f'[PRIVATE CHAT ERROR] {str(e)}')
     
+    async def send_history(self, before, limit):
+        """Reply with one page of messages older than the given cursor (newest page without one)"""
+        try:
+            page, next_cursor = await self.load_history(before or None, clamp_page_size(limit))
+        except InvalidCursor:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Invalid history cursor'}))
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'history',
+            'messages': page,
+            'next_cursor': next_cursor,
+        }))
+    
+    @database_sync_to_async
+    def load_history(self, before, limit):
+        friend = User.objects.get(username=self.friend_username)
+        conversation = Conversation.between(self.user, friend)
+        if conversation is None:
+            return [], None
+        page, next_cursor = fetch_private_history(conversation.id, before=before, limit=limit)
+        return [serialize_private_message(message) for message in page], next_cursor
+    
     async def chat_message(self, event):
         """Send chat message to WebSocket"""
         await self.send(text_data=json.dumps({
@@ -131,11 +158,7 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
             
             friend = User.objects.get(username=self.friend_username)
             
-            message = PrivateMessage.objects.create(
-                sender=self.user,
-                receiver=friend,
-                content=content
-            )
+            message = Conversation.post_message(self.user, friend, content)
             
             # Create notification for the message
             Notification.create_message_notification(self.user, friend, message)
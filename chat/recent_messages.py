@@ -0,0 +1,154 @@
+"""
+Per-room ring buffer of recently sent messages, kept in the Django cache.
+
+Opening a room (including the reload after a dropped WebSocket) is served from
+here instead of the Message table. ChatConsumer appends every message it
+sends, unsend_message patches deleted entries in place, and a cold buffer is
+primed from the database with the newest history page.
+
+The buffer is a fixed set of SIZE slot keys plus a head counter: appending
+increments the head and writes slot (head % SIZE), so no read-modify-write of
+a shared list is needed and concurrent workers never lose each other's
+entries. Each slot records the sequence number it was written for, which lets
+readers skip slots that still hold an older lap of the ring.
+
+Configure via the RECENT_MESSAGES setting:
+
+    RECENT_MESSAGES = {
+        'SIZE': 50,
+        'TIMEOUT': 3600,
+    }
+
+Hits and misses are counted in chat.metrics as messages.recent.hits and
+messages.recent.misses.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from .history import encode_cursor, fetch_room_history, serialize_message
+from .metrics import metrics
+
+
+DEFAULT_RECENT_MESSAGES = {
+    'SIZE': 50,  # Messages kept per room (also the size of the first page)
+    'TIMEOUT': 3600,  # Seconds an idle room's buffer stays cached
+}
+
+
+class RecentMessageBuffer:
+    """Bounded cache of the newest serialized messages for each room"""
+
+    def __init__(self, size=50, timeout=3600, key_prefix='recent_messages'):
+        self.size = size
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _head_key(self, room_id):
+        return f'{self.key_prefix}:{room_id}:head'
+
+    def _slot_key(self, room_id, seq):
+        return f'{self.key_prefix}:{room_id}:{seq % self.size}'
+
+    @staticmethod
+    def _new_generation():
+        # Sequence numbers of a re-primed buffer must not collide with slots left
+        # over from an expired one, so each generation starts from the clock.
+        return int(time.time() * 1000) * 1024
+
+    def _window(self, room_id, head):
+        """Slot entries for the last SIZE sequence numbers, oldest first"""
+        seqs = range(max(head - self.size + 1, 0), head + 1)
+        found = cache.get_many([self._slot_key(room_id, seq) for seq in seqs])
+        entries = []
+        for seq in seqs:
+            entry = found.get(self._slot_key(room_id, seq))
+            if entry is not None and entry['seq'] == seq:
+                entries.append(entry)
+        return entries
+
+    def append(self, room_id, message):
+        """Add a freshly sent Message; a cold buffer is left to the next prime"""
+        try:
+            head = cache.incr(self._head_key(room_id))
+        except ValueError:
+            return
+        cache.set(self._slot_key(room_id, head), {
+            'seq': head,
+            'message': serialize_message(message),
+            'cursor': encode_cursor(message),
+            'first': False,
+        }, self.timeout)
+        cache.touch(self._head_key(room_id), self.timeout)
+
+    def patch(self, room_id, message_id, **changes):
+        """Update a buffered message in place (e.g. is_deleted=True)"""
+        head = cache.get(self._head_key(room_id))
+        if head is None:
+            return False
+        for entry in self._window(room_id, head):
+            if entry['message']['message_id'] == message_id:
+                entry['message'].update(changes)
+                cache.set(self._slot_key(room_id, entry['seq']), entry, self.timeout)
+                return True
+        return False
+
+    def _prime(self, room_id):
+        """Seed a cold buffer with the newest page loaded from the database"""
+        base = self._new_generation()
+        # Reserve the head before reading so messages sent meanwhile are appended
+        # after the primed page rather than lost; duplicates are dropped on read.
+        reserved = cache.add(self._head_key(room_id), base, self.timeout)
+        page, next_cursor = fetch_room_history(room_id, limit=self.size)
+        if reserved:
+            entries = {}
+            first_seq = base - len(page) + 1
+            for offset, message in enumerate(page):
+                entries[self._slot_key(room_id, first_seq + offset)] = {
+                    'seq': first_seq + offset,
+                    'message': serialize_message(message),
+                    'cursor': encode_cursor(message),
+                    'first': offset == 0 and next_cursor is None,
+                }
+            cache.set_many(entries, self.timeout)
+        return [serialize_message(message) for message in page], next_cursor
+
+    def page(self, room_id):
+        """Return (serialized newest messages, cursor for the next older page)"""
+        head = cache.get(self._head_key(room_id))
+        entries = self._window(room_id, head) if head is not None else []
+        if not entries:
+            metrics.incr('messages.recent.misses')
+            return self._prime(room_id)
+        metrics.incr('messages.recent.hits')
+
+        next_cursor = None if entries[0]['first'] else entries[0]['cursor']
+        messages, seen = [], set()
+        for entry in entries:
+            message = entry['message']
+            if message['message_id'] in seen or message.get('is_deleted'):
+                continue
+            seen.add(message['message_id'])
+            messages.append(message)
+        return messages, next_cursor
+
+    def clear(self, room_id):
+        cache.delete(self._head_key(room_id))
+
+    @staticmethod
+    def hit_rate():
+        hits = metrics.counter('messages.recent.hits')
+        total = hits + metrics.counter('messages.recent.misses')
+        return hits / total if total else 0.0
+
+
+def create_recent_message_buffer(config=None):
+    config = dict(DEFAULT_RECENT_MESSAGES, **(config or getattr(settings, 'RECENT_MESSAGES', {})))
+    return RecentMessageBuffer(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared buffer instance, created on first use
+recent_messages = SimpleLazyObject(create_recent_message_buffer)
@@ -0,0 +1,114 @@
+"""
+Sequenced room events for gap-free WebSocket resume.
+
+Every chat_message, delete_message and gift_animation broadcast to a room gets
+the next per-room sequence number and is appended, pre-encoded (see
+chat.fanout), to a bounded event log in the Django cache before it is sent to
+the channel layer. A client that reconnects with the last sequence number it
+saw is replayed only the events it missed; if those have already rolled out of the log (or the log expired) it is
+sent a snapshot of the recent-message buffer instead.
+
+The log uses the same fixed-slot ring layout as chat.recent_messages. Configure
+via the ROOM_EVENT_LOG setting:
+
+    ROOM_EVENT_LOG = {
+        'SIZE': 200,
+        'TIMEOUT': 3600,
+    }
+"""
+
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from .fanout import encoded_event
+from .metrics import metrics
+
+
+DEFAULT_ROOM_EVENT_LOG = {
+    'SIZE': 200,  # Events kept per room for replay
+    'TIMEOUT': 3600,  # Seconds an idle room's log stays cached
+}
+
+
+class RoomEventLog:
+    """Assigns per-room sequence numbers and keeps the last SIZE events"""
+
+    def __init__(self, size=200, timeout=3600, key_prefix='room_events'):
+        self.size = size
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _seq_key(self, room_name):
+        return f'{self.key_prefix}:{room_name}:seq'
+
+    def _slot_key(self, room_name, seq):
+        return f'{self.key_prefix}:{room_name}:{seq % self.size}'
+
+    def _start_generation(self, room_name):
+        # A log that expired restarts from the clock, so sequence numbers keep
+        # increasing and stale client positions are recognised as gaps.
+        cache.add(self._seq_key(room_name), int(time.time() * 1000) * 1024, self.timeout)
+
+    def current(self, room_name):
+        """Latest sequence number for the room (starting a log if there is none)"""
+        seq = cache.get(self._seq_key(room_name))
+        if seq is None:
+            self._start_generation(room_name)
+            seq = cache.get(self._seq_key(room_name))
+        return seq
+
+    def record(self, room_name, payload):
+        """Stamp the client payload with the next sequence number, log it and return its group event"""
+        try:
+            seq = cache.incr(self._seq_key(room_name))
+        except ValueError:
+            self._start_generation(room_name)
+            seq = cache.incr(self._seq_key(room_name))
+        payload['seq'] = seq
+        event = dict(encoded_event(payload), seq=seq)
+        cache.set(self._slot_key(room_name, seq), event, self.timeout)
+        cache.touch(self._seq_key(room_name), self.timeout)
+        return event
+
+    def since(self, room_name, last_seq):
+        """Return (events after last_seq, current seq); events is None if the gap can't be replayed"""
+        seq = cache.get(self._seq_key(room_name))
+        if seq is None or last_seq is None or last_seq > seq or seq - last_seq > self.size:
+            metrics.incr('room_events.resume.snapshots')
+            return None, seq
+        wanted = range(last_seq + 1, seq + 1)
+        found = cache.get_many([self._slot_key(room_name, n) for n in wanted])
+        events = []
+        for n in wanted:
+            event = found.get(self._slot_key(room_name, n))
+            if event is None or event['seq'] != n:
+                # Evicted, or still being written by another worker
+                metrics.incr('room_events.resume.snapshots')
+                return None, seq
+            events.append(event)
+        metrics.incr('room_events.resume.replays')
+        metrics.incr('room_events.resume.replayed_events', len(events))
+        return events, seq
+
+    def clear(self, room_name):
+        cache.delete(self._seq_key(room_name))
+
+
+def create_room_event_log(config=None):
+    config = dict(DEFAULT_ROOM_EVENT_LOG, **(config or getattr(settings, 'ROOM_EVENT_LOG', {})))
+    return RoomEventLog(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared log instance, created on first use
+room_events = SimpleLazyObject(create_room_event_log)
+
+
+def broadcast_room_event(room_name, payload):
+    """Sequence, log and send a client payload to a chat room group (from sync code)"""
+    event = room_events.record(room_name, payload)
+    async_to_sync(get_channel_layer().group_send)(f'chat_{room_name}', event)
@@ -0,0 +1,393 @@
+"""
+Channel layer built on Redis Streams.
+
+channels_redis keeps one bounded list per channel and silently drops group
+messages once a consumer's list is full. This layer instead writes each group
+message once to a bounded per-group stream and lets every worker process read
+the streams of the groups its sockets belong to through its own consumer
+group, so:
+
+* a burst only ever costs one XADD per group_send, however many sockets
+  listen, and the stream length (MAXLEN) is set per group pattern;
+* publishers can see how far the slowest reader is behind (group_lag) and are
+  signalled when it passes LAG_LIMIT seconds (metric, or ChannelFull when
+  BACKPRESSURE is 'raise');
+* drops are counted instead of silent: messages a reader never got because the
+  stream was trimmed past it, messages that expired before delivery and
+  messages a socket's local queue had no room for.
+
+Point the layer at a fake server in tests with client_factory, e.g.
+lambda: fakeredis.FakeAsyncRedis(server=server).
+
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.streams_layer.RedisStreamsChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+                'capacity': 1500,
+                'expiry': 60,
+                'group_retention': {
+                    'chat_*': {'maxlen': 2000, 'expiry': 60},
+                    'notifications_*': {'maxlen': 200, 'expiry': 300},
+                    'game2048_*': {'maxlen': 500, 'expiry': 10},
+                },
+            },
+        },
+    }
+"""
+
+import asyncio
+import fnmatch
+import re
+import time
+import uuid
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+from .metrics import metrics
+
+
+def _id_ms(entry_id):
+    """Millisecond timestamp of a stream entry ID (b'1700000000000-3')"""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return int(entry_id.split('-', 1)[0])
+
+
+class _LoopState:
+    """Per-event-loop connection, reader task and local socket queues"""
+
+    def __init__(self, client):
+        self.client = client
+        self.prefix = uuid.uuid4().hex[:12]
+        self.queues = {}  # channel name -> asyncio.Queue
+        self.groups = {}  # group name -> set of local channel names
+        self.reader = None
+        self.last_heartbeat = 0.0
+
+
+class RedisStreamsChannelLayer(BaseChannelLayer):
+    """Channel layer where each group is one bounded Redis stream"""
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, hosts=None, prefix='asgi', expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None, group_retention=None,
+                 default_maxlen=1000, lag_limit=5.0, lag_check_interval=1.0,
+                 backpressure='signal', block_ms=1000, client_factory=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.hosts = hosts or ['redis://localhost:6379/0']
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.default_maxlen = default_maxlen
+        self.group_retention = [
+            (re.compile(fnmatch.translate(pattern)), retention)
+            for pattern, retention in (group_retention or {}).items()
+        ]
+        self.lag_limit = lag_limit
+        self.lag_check_interval = lag_check_interval
+        if backpressure not in ('signal', 'raise'):
+            raise ValueError("backpressure must be 'signal' or 'raise'")
+        self.backpressure = backpressure
+        self.block_ms = block_ms
+        if isinstance(client_factory, str):
+            client_factory = import_string(client_factory)
+        self.client_factory = client_factory
+        self._states = {}
+        self._lag_checked = {}  # group -> monotonic time of the last lag check
+        self._backpressured = set()
+
+    # ---- keys and configuration -------------------------------------------
+
+    def _group_key(self, group):
+        return f'{self.prefix}:group:{group}'
+
+    def _channel_key(self, channel):
+        return f'{self.prefix}:channel:{channel}'
+
+    def _process_key(self, process):
+        return f'{self.prefix}:process:{process}'
+
+    def _alive_key(self, process):
+        return f'{self.prefix}:alive:{process}'
+
+    def retention(self, group):
+        """MAXLEN and message expiry for a group, from the first matching pattern"""
+        for pattern, retention in self.group_retention:
+            if pattern.match(group):
+                return {
+                    'maxlen': retention.get('maxlen', self.default_maxlen),
+                    'expiry': retention.get('expiry', self.expiry),
+                }
+        return {'maxlen': self.default_maxlen, 'expiry': self.expiry}
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._states.get(loop)
+        if state is None:
+            if self.client_factory is not None:
+                client = self.client_factory()
+            else:
+                import redis.asyncio
+                client = redis.asyncio.Redis.from_url(self.hosts[0])
+            state = self._states[loop] = _LoopState(client)
+        return state
+
+    @staticmethod
+    def _pack(message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def _unpack(data):
+        return msgpack.unpackb(data, raw=False)
+
+    # ---- channel layer API -------------------------------------------------
+
+    async def new_channel(self, prefix='specific'):
+        state = self._state()
+        channel = f'{prefix}.{state.prefix}!{uuid.uuid4().hex}'
+        state.queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        state = self._state()
+        if '!' in channel:
+            # Process-specific channel: route through the owning process's stream
+            process = channel[:channel.index('!')].rsplit('.', 1)[-1]
+            await state.client.xadd(
+                self._process_key(process),
+                {'c': channel, 'm': self._pack(message)},
+                maxlen=self.get_capacity(channel) * 10, approximate=True,
+            )
+            return
+        key = self._channel_key(channel)
+        if await state.client.xlen(key) >= self.get_capacity(channel):
+            metrics.incr('channels.dropped.full')
+            raise ChannelFull(channel)
+        await state.client.xadd(key, {'m': self._pack(message)})
+        await state.client.expire(key, self.expiry * 2)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        state = self._state()
+        if '!' in channel:
+            self._ensure_reader(state)
+            queue = state.queues.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+            try:
+                return await queue.get()
+            except asyncio.CancelledError:
+                # The consumer is shutting down; forget its queue
+                if queue.empty() and not any(channel in members for members in state.groups.values()):
+                    state.queues.pop(channel, None)
+                raise
+        return await self._receive_normal(state, channel)
+
+    async def _receive_normal(self, state, channel):
+        """Normal channels are a stream read by one shared consumer group, so each message goes to one receiver"""
+        key = self._channel_key(channel)
+        await self._create_consumer_group(state, key, 'receivers', start='0')
+        while True:
+            response = await state.client.xreadgroup(
+                'receivers', state.prefix, {key: '>'}, count=1, block=self.block_ms, noack=True,
+            )
+            for _, entries in response or []:
+                for entry_id, fields in entries:
+                    # Consumed: remove it so XLEN keeps measuring the backlog
+                    await state.client.xdel(key, entry_id)
+                    if time.time() * 1000 - _id_ms(entry_id) > self.expiry * 1000:
+                        metrics.incr('channels.dropped.expired')
+                        continue
+                    return self._unpack(fields[b'm'])
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        state = self._state()
+        members = state.groups.setdefault(group, set())
+        if not members:
+            # First local member: this process starts reading the group's stream
+            await self._create_consumer_group(state, self._group_key(group), state.prefix)
+            await state.client.expire(self._group_key(group), self.group_expiry)
+            self._ensure_reader(state)
+            await self._wake_reader(state)
+        members.add(channel)
+        state.queues.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        state = self._state()
+        members = state.groups.get(group)
+        if not members:
+            return
+        members.discard(channel)
+        if not members:
+            del state.groups[group]
+            await state.client.xgroup_destroy(self._group_key(group), state.prefix)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Group name not valid'
+        state = self._state()
+        key = self._group_key(group)
+        async with state.client.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {'m': self._pack(message)}, maxlen=self.retention(group)['maxlen'], approximate=True)
+            pipe.expire(key, self.group_expiry)
+            entry_id, _ = await pipe.execute()
+        metrics.incr('channels.group_sent')
+
+        now = time.monotonic()
+        if now - self._lag_checked.get(group, 0.0) >= self.lag_check_interval:
+            self._lag_checked[group] = now
+            lag = await self._check_group(state, group, _id_ms(entry_id))
+            if lag > self.lag_limit:
+                self._backpressured.add(group)
+                metrics.incr('channels.backpressure')
+                if self.backpressure == 'raise':
+                    raise ChannelFull(f'Group {group} readers are {lag:.1f}s behind')
+            else:
+                self._backpressured.discard(group)
+
+    async def flush(self):
+        for state in list(self._states.values()):
+            if state.reader is not None:
+                state.reader.cancel()
+        state = self._state()
+        async for key in state.client.scan_iter(match=f'{self.prefix}:*'):
+            await state.client.delete(key)
+        self._states.clear()
+        self._lag_checked.clear()
+        self._backpressured.clear()
+
+    # ---- backpressure and lag ---------------------------------------------
+
+    def is_backpressured(self, group):
+        """True if the last lag check found this group's slowest reader past LAG_LIMIT"""
+        return group in self._backpressured
+
+    async def group_lag(self, group):
+        """Seconds the slowest live reader of a group is behind its newest message"""
+        state = self._state()
+        info = await state.client.xinfo_stream(self._group_key(group))
+        return await self._check_group(state, group, _id_ms(info['last-generated-id']))
+
+    async def _check_group(self, state, group, newest_ms):
+        key = self._group_key(group)
+        try:
+            readers = await state.client.xinfo_groups(key)
+            first_entry = (await state.client.xinfo_stream(key)).get('first-entry')
+        except Exception:
+            return 0.0
+        names = [reader['name'].decode() if isinstance(reader['name'], bytes) else reader['name'] for reader in readers]
+        alive = await state.client.mget([self._alive_key(name) for name in names]) if names else []
+
+        worst = 0.0
+        for name, reader, is_alive in zip(names, readers, alive):
+            if is_alive is None:
+                # The process that owned this reader is gone
+                await state.client.xgroup_destroy(key, name)
+                continue
+            delivered = reader['last-delivered-id']
+            delivered = delivered.decode() if isinstance(delivered, bytes) else delivered
+            if first_entry is not None and _id_ms(delivered) and _id_ms(delivered) < _id_ms(first_entry[0]):
+                # The stream was trimmed past entries this reader never got
+                metrics.incr('channels.dropped.trimmed')
+            # Lag is how long the oldest message this reader hasn't consumed has been waiting
+            oldest_unread = await state.client.xrange(key, min=f'({delivered}', count=1)
+            if oldest_unread:
+                worst = max(worst, (newest_ms - _id_ms(oldest_unread[0][0])) / 1000.0)
+        metrics.gauge(f'channels.lag_seconds.{group}', worst)
+        return worst
+
+    # ---- reader -----------------------------------------------------------
+
+    async def _create_consumer_group(self, state, key, name, start='$'):
+        import redis.exceptions
+        try:
+            await state.client.xgroup_create(key, name, id=start, mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def _ensure_reader(self, state):
+        if state.reader is None or state.reader.done():
+            state.reader = asyncio.get_running_loop().create_task(self._read_loop(state))
+
+    async def _wake_reader(self, state):
+        # An empty entry on our own stream ends the reader's blocking call so it
+        # picks up the new group immediately
+        await state.client.xadd(self._process_key(state.prefix), {'c': ''}, maxlen=1000, approximate=True)
+
+    async def _heartbeat(self, state):
+        now = time.monotonic()
+        if now - state.last_heartbeat < 5:
+            return
+        state.last_heartbeat = now
+        async with state.client.pipeline(transaction=False) as pipe:
+            pipe.set(self._alive_key(state.prefix), 1, ex=30)
+            for group in state.groups:
+                pipe.expire(self._group_key(group), self.group_expiry)
+            await pipe.execute()
+
+    async def _read_loop(self, state):
+        import redis.exceptions
+        process_key = self._process_key(state.prefix)
+        # Only this process reads its stream: from the start, so messages sent to
+        # its channels before the reader was up are not skipped
+        await self._create_consumer_group(state, process_key, state.prefix, start='0')
+        while True:
+            await self._heartbeat(state)
+            streams = {process_key: '>'}
+            streams.update({self._group_key(group): '>' for group in state.groups})
+            try:
+                response = await state.client.xreadgroup(
+                    state.prefix, 'reader', streams, count=100, block=self.block_ms, noack=True,
+                )
+            except redis.exceptions.ResponseError as e:
+                # A stream expired or was flushed underneath us: recreate our groups
+                print(f'[CHANNELS] Recreating stream readers after: {e}')
+                await self._create_consumer_group(state, process_key, state.prefix, start='0')
+                for group in list(state.groups):
+                    await self._create_consumer_group(state, self._group_key(group), state.prefix)
+                continue
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                print(f'[CHANNELS] Stream reader lost Redis connection: {e}')
+                await asyncio.sleep(1)
+                continue
+            for key, entries in response or []:
+                key = key.decode() if isinstance(key, bytes) else key
+                for entry_id, fields in entries:
+                    self._deliver(state, key, entry_id, fields)
+
+    def _deliver(self, state, key, entry_id, fields):
+        if key.startswith(f'{self.prefix}:process:'):
+            channel = fields.get(b'c', b'').decode()
+            if not channel:
+                return
+            targets = [channel]
+            expiry = self.expiry
+        else:
+            group = key[len(f'{self.prefix}:group:'):]
+            targets = state.groups.get(group, ())
+            expiry = self.retention(group)['expiry']
+
+        age = time.time() - _id_ms(entry_id) / 1000.0
+        if age > expiry:
+            metrics.incr('channels.dropped.expired', len(targets))
+            return
+        metrics.observe('channels.delivery_lag_seconds', max(age, 0.0))
+
+        for channel in targets:
+            queue = state.queues.get(channel)
+            if queue is None:
+                continue
+            try:
+                # Unpacked per channel: consumers may mutate the message they receive
+                queue.put_nowait(self._unpack(fields[b'm']))
+            except asyncio.QueueFull:
+                metrics.incr('channels.dropped.full')
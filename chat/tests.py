@@ -1,3 +1,743 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .evercoin import GIFTS, GRANTS, REWARDS, InsufficientEvercoin, ledger
+from .friend_graph import FriendsOverview
+from .gif_search import GifSearch
+from .history import fetch_room_history, older_than
+from .intimacy import intimacy
+from .routing import websocket_urlpatterns
+from .message_pipeline import MAX_WORKER_ID, SEQUENCE_BITS, MessagePipeline
+from .presence import LocMemPresenceBackend, PresenceReaper, RedisPresenceBackend, presence_reaper
+from .streams_layer import RedisStreamsChannelLayer
+from .models import (
+    EvercoinLedgerEntry, Friendship, GameSession, Gift, GiftTransaction, GifFile, GifPack, Intimacy,
+    IntimacyLeaderboardEntry, Message, Room, RoomMember, UserProfile,
+)
+
+
+class FriendsOverviewQueryTests(TestCase):
+    """The friends overview must not issue a query per friend"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='x')
+        self.client.force_login(self.user)
+
+    def add_relations(self, prefix, friends=0, blocked=0, incoming=0, outgoing=0):
+        for n in range(friends):
+            Friendship.objects.create(sender=self.user, receiver=User.objects.create_user(f'{prefix}f{n}'), status='accepted')
+        for n in range(blocked):
+            Friendship.objects.create(sender=User.objects.create_user(f'{prefix}b{n}'), receiver=self.user, status='blocked')
+        for n in range(incoming):
+            Friendship.objects.create(sender=User.objects.create_user(f'{prefix}i{n}'), receiver=self.user)
+        for n in range(outgoing):
+            Friendship.objects.create(sender=self.user, receiver=User.objects.create_user(f'{prefix}o{n}'))
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_overview_query_count(self):
+        self.add_relations('a', friends=5, blocked=2, incoming=3, outgoing=2)
+        overview = FriendsOverview(self.user)
+        # Friend graph, friend and blocked users, pending requests
+        with self.assertNumQueries(3):
+            self.assertEqual(len(overview.friends), 5)
+            self.assertEqual(len(overview.blocked_users), 2)
+            self.assertEqual(len(overview.incoming_requests), 3)
+            self.assertEqual(len(overview.outgoing_requests), 2)
+            for friend in overview.friends + overview.blocked_users:
+                friend.profile
+            for request in overview.incoming_requests + overview.outgoing_requests:
+                request.sender.profile, request.receiver.profile
+
+    def test_missing_profiles_are_created_in_bulk(self):
+        self.add_relations('a', friends=4, blocked=2)
+        UserProfile.objects.exclude(user=self.user).delete()
+        cache.clear()
+        # Friend graph, users, bulk insert, read back the new profiles
+        with self.assertNumQueries(4):
+            friends = FriendsOverview(self.user).friends
+            self.assertTrue(all(friend.profile.pk for friend in friends))
+        self.assertEqual(UserProfile.objects.count(), 7)
+
+    def test_index_query_count_does_not_grow_with_friends(self):
+        self.add_relations('a', friends=1, blocked=1, incoming=1, outgoing=1)
+        self.count_queries(reverse('chat:chat_index'))  # Warm the friend graph
+        baseline = self.count_queries(reverse('chat:chat_index'))
+        # Session, user, MFA devices (twice), own profile, friend users, requests, rooms, session save (3 statements)
+        self.assertEqual(baseline, 14)
+
+        self.add_relations('b', friends=10, blocked=3, incoming=4, outgoing=4)
+        self.count_queries(reverse('chat:chat_index'))
+        self.assertEqual(self.count_queries(reverse('chat:chat_index')), baseline)
+
+    def test_friends_list_query_count_does_not_grow_with_friends(self):
+        self.add_relations('a', friends=1, incoming=1, outgoing=1)
+        self.count_queries(reverse('chat:friends_list'))
+        baseline = self.count_queries(reverse('chat:friends_list'))
+        self.assertEqual(baseline, 7)
+
+        self.add_relations('b', friends=10, incoming=4, outgoing=4)
+        self.count_queries(reverse('chat:friends_list'))
+        self.assertEqual(self.count_queries(reverse('chat:friends_list')), baseline)
+
+
+class RoomHistoryTests(TestCase):
+    """Room history pages walk back on (timestamp, id) without gaps or repeats"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.room = Room.objects.create(name='1234567', creator=self.user)
+        now = timezone.now()
+        # Pairs of messages share a timestamp, so pages split ties on id
+        Message.objects.bulk_create([
+            Message(room=self.room, user=self.user, content=str(n), timestamp=now - timedelta(seconds=n // 2))
+            for n in range(25)
+        ])
+
+    def test_pages_cover_the_room_once(self):
+        seen = []
+        messages, cursor = fetch_room_history(self.room.id, limit=7)
+        seen.extend(messages)
+        while cursor:
+            messages, cursor = fetch_room_history(self.room.id, before=cursor, limit=7)
+            seen = messages + seen
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len({message.id for message in seen}), 25)
+        self.assertEqual(seen, sorted(seen, key=lambda message: (message.timestamp, message.id)))
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+    def test_older_pages_seek_on_timestamp(self):
+        _, cursor = fetch_room_history(self.room.id, limit=7)
+        plan = Message.objects.filter(room_id=self.room.id).filter(older_than(cursor)).order_by('-timestamp', '-id')[:8].explain()
+        self.assertIn('timestamp<', plan.replace(' ', ''))
+
+
+class GifSearchTests(TestCase):
+    """Searching the GIF index while a word is being typed"""
+
+    def setUp(self):
+        cache.clear()
+        self.search = GifSearch(prefix_expansions=3)
+        pack = GifPack.objects.create(name='Animals')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cat = GifFile.objects.create(pack=pack, title='cat', tags='cat', gif_file='gifs/cat.gif')
+            # More common completions of "cat" than "cat" itself
+            for n, word in enumerate(['cats', 'catch', 'cattle', 'catalog', 'catnip']):
+                for copy in range(n + 2):
+                    GifFile.objects.create(pack=pack, title=f'{word} {copy}', tags=word, gif_file='gifs/other.gif')
+
+    def test_exact_term_is_found_while_typing(self):
+        self.assertEqual(self.search.search('cat')[0], self.cat)
+        self.assertEqual(self.search.search('cat ')[0], self.cat)
+
+    def test_completions_fill_remaining_expansions(self):
+        titles = {gif.title.split()[0] for gif in self.search.search('cat', limit=50)}
+        # The exact term plus the two most common completions
+        self.assertEqual(titles, {'cat', 'catnip', 'catalog'})
+
+
+class MessagePipelineWorkerIdTests(TestCase):
+    """Pipelines must never share a worker ID (it is part of every message ID) or a journal"""
+
+    def setUp(self):
+        cache.clear()
+        self.journal_dir = tempfile.mkdtemp()
+        self.user = User.objects.create_user('alice')
+        self.room = Room.objects.create(name='general', creator=self.user)
+
+    def pipeline(self, **options):
+        # A long interval leaves the writes to flush(), on the test's connection
+        pipeline = MessagePipeline(journal_dir=self.journal_dir, flush_interval_ms=60000, **options)
+        self.addCleanup(pipeline.stop)
+        return pipeline
+
+    def worker_id(self, message_id):
+        return (message_id >> SEQUENCE_BITS) & MAX_WORKER_ID
+
+    def test_pipelines_claim_distinct_worker_ids(self):
+        first = self.pipeline(enabled=False).submit(self.room.id, self.user.id, 'one')
+        second = self.pipeline(enabled=False).submit(self.room.id, self.user.id, 'two')
+        self.assertNotEqual(self.worker_id(first), self.worker_id(second))
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_pinned_worker_id_in_use_refuses_to_start(self):
+        self.pipeline(enabled=False, worker_id=3).submit(self.room.id, self.user.id, 'one')
+        with self.assertRaises(RuntimeError):
+            self.pipeline(enabled=False, worker_id=3).submit(self.room.id, self.user.id, 'two')
+
+    def test_lost_lease_claims_another_worker_id(self):
+        pipeline = self.pipeline(enabled=False)
+        first = pipeline.submit(self.room.id, self.user.id, 'one')
+        cache.set(pipeline._lease_key(self.worker_id(first)), 'another-host', 60)
+        pipeline._lease_renewed = 0
+        second = pipeline.submit(self.room.id, self.user.id, 'two')
+        self.assertNotEqual(self.worker_id(first), self.worker_id(second))
+
+    def test_orphaned_journal_is_replayed(self):
+        record = {'id': 4242, 'room_id': self.room.id, 'user_id': self.user.id,
+                  'content': 'journaled', 'timestamp': '2026-01-01T00:00:00+00:00'}
+        with open(f'{self.journal_dir}/messages-999999.journal', 'w', encoding='utf-8') as journal:
+            journal.write(json.dumps(record) + '\n')
+        pipeline = self.pipeline()
+        pipeline.submit(self.room.id, self.user.id, 'live')
+        pipeline.flush()
+        self.assertEqual(Message.objects.get(id=4242).content, 'journaled')
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class MessagePipelineFlushTests(TestCase):
+    """flush() makes every message submitted so far readable, without disturbing the calling request"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.room = Room.objects.create(name='general', creator=self.user)
+        # A long interval keeps the writer thread idle: tests take its batches by hand
+        self.pipeline = MessagePipeline(journal_dir=tempfile.mkdtemp(), flush_interval_ms=60000)
+        self.addCleanup(self.pipeline.stop)
+
+    def take_batch(self):
+        """Take the queued records the way the writer thread does"""
+        with self.pipeline._lock:
+            batch, self.pipeline._pending = self.pipeline._pending, []
+            self.pipeline._in_flight += len(batch)
+        return batch
+
+    def test_flush_waits_for_the_writer_threads_batch(self):
+        self.pipeline.submit(self.room.id, self.user.id, 'hello')
+        batch = self.take_batch()
+        written = []
+
+        def slow_write(records):
+            time.sleep(0.2)
+            written.extend(records)
+
+        with mock.patch.object(self.pipeline, '_write', slow_write), \
+                mock.patch('chat.message_pipeline.close_old_connections'):
+            writer = threading.Thread(target=self.pipeline._write_and_settle, args=(batch, True))
+            writer.start()
+            self.assertTrue(self.pipeline.flush())
+            self.assertEqual(written, batch)
+            writer.join()
+
+    def test_flush_gives_up_on_a_stuck_batch(self):
+        self.pipeline.submit(self.room.id, self.user.id, 'hello')
+        self.take_batch()
+        self.assertFalse(self.pipeline.flush(timeout=0.1))
+
+    def test_failed_flush_keeps_the_request_connection_and_does_not_back_off(self):
+        message_id = self.pipeline.submit(self.room.id, self.user.id, 'hello')
+        with mock.patch.object(self.pipeline, '_write', side_effect=DatabaseError('down')), \
+                mock.patch('chat.message_pipeline.close_old_connections') as close_old_connections, \
+                mock.patch('chat.message_pipeline.time.sleep') as sleep:
+            self.pipeline.flush()
+        close_old_connections.assert_not_called()
+        sleep.assert_not_called()
+        self.assertTrue(self.pipeline.is_pending(message_id))
+        self.assertTrue(self.pipeline.flush())
+        self.assertTrue(Message.objects.filter(id=message_id).exists())
+
+
+class EvercoinLedgerTests(TestCase):
+    """Balance changes through chat.evercoin (UPDATE ... RETURNING where the database has it)"""
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        ledger.credit(self.alice, 100, 'admin_grant', GRANTS)
+
+    def balance(self, user):
+        return UserProfile.objects.get(user=user).evercoin
+
+    def assertJournalBalanced(self):
+        self.assertEqual(ledger.reconcile(), ({}, []))
+
+    def test_debit_without_funds_changes_nothing(self):
+        with self.assertRaises(InsufficientEvercoin):
+            ledger.debit(self.alice, 101, 'gift', GIFTS)
+        self.assertEqual(self.balance(self.alice), 100)
+        entry = ledger.debit(self.alice, 100, 'gift', GIFTS)
+        self.assertEqual((entry.amount, entry.balance_after), (-100, 0))
+        self.assertJournalBalanced()
+
+    def test_debit_replays_idempotency_key(self):
+        first = ledger.debit(self.alice, 30, 'gift', GIFTS, idempotency_key='k1')
+        retry = ledger.debit(self.alice, 30, 'gift', GIFTS, idempotency_key='k1')
+        self.assertFalse(first.replayed)
+        self.assertTrue(retry.replayed)
+        self.assertEqual((retry.pk, retry.balance_after), (first.pk, 70))
+        self.assertEqual(self.balance(self.alice), 70)
+        self.assertJournalBalanced()
+
+    def test_replay_after_balance_dropped(self):
+        first = ledger.debit(self.alice, 60, 'gift', GIFTS, idempotency_key='k1')
+        ledger.debit(self.alice, 30, 'gift', GIFTS)
+        # The retry can no longer be paid for, but it already was
+        retry = ledger.debit(self.alice, 60, 'gift', GIFTS, idempotency_key='k1')
+        self.assertTrue(retry.replayed)
+        self.assertEqual(retry.pk, first.pk)
+        self.assertEqual(self.balance(self.alice), 10)
+        with self.assertRaises(InsufficientEvercoin):
+            ledger.debit(self.alice, 60, 'gift', GIFTS, idempotency_key='k2')
+
+    def test_credit_many_creates_missing_profiles(self):
+        carol = User.objects.create_user('carol')
+        UserProfile.objects.filter(user__in=[self.bob, carol]).delete()
+        entries = ledger.credit_many([carol.id, self.alice.id, self.bob.id, carol.id], 25, 'game_reward', REWARDS)
+        self.assertEqual({entry.user_id: entry.balance_after for entry in entries},
+                         {self.alice.id: 125, self.bob.id: 25, carol.id: 25})
+        self.assertEqual([self.balance(user) for user in (self.alice, self.bob, carol)], [125, 25, 25])
+        self.assertJournalBalanced()
+
+    def test_transfer_in_either_direction(self):
+        # Rows are locked in id order whichever way the coins move
+        entry = ledger.transfer(self.alice, self.bob, 40)
+        self.assertEqual((entry.user_id, entry.amount, entry.balance_after), (self.alice.id, -40, 60))
+        entry = ledger.transfer(self.bob, self.alice, 15)
+        self.assertEqual((entry.user_id, entry.amount, entry.balance_after), (self.bob.id, -15, 25))
+        self.assertEqual((self.balance(self.alice), self.balance(self.bob)), (75, 25))
+        with self.assertRaises(InsufficientEvercoin):
+            ledger.transfer(self.bob, self.alice, 26)
+        # The failed transfer credited nobody
+        self.assertEqual((self.balance(self.alice), self.balance(self.bob)), (75, 25))
+        self.assertEqual(EvercoinLedgerEntry.objects.filter(kind='transfer').count(), 4)
+        self.assertJournalBalanced()
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        UserProfile.objects.filter(user=self.bob).update(evercoin=7)
+        mismatched, unbalanced = ledger.reconcile()
+        self.assertEqual(mismatched, {self.bob.id: (7, 0)})
+        self.assertEqual(unbalanced, [])
+        # Reporting alone writes nothing
+        self.assertEqual(ledger.reconcile()[0], mismatched)
+
+        ledger.reconcile(fix=True)
+        self.assertEqual(self.balance(self.bob), 7)
+        self.assertJournalBalanced()
+        adjustment = EvercoinLedgerEntry.objects.get(kind='adjustment', user=self.bob)
+        self.assertEqual((adjustment.amount, adjustment.balance_after), (7, 7))
+
+
+class EvercoinLedgerFallbackTests(EvercoinLedgerTests):
+    """The same, through the F() update used where UPDATE ... RETURNING is unavailable (MySQL, MariaDB)"""
+
+    def setUp(self):
+        patcher = mock.patch('chat.evercoin.update_returning_supported', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+
+class EvercoinViewTests(TestCase):
+    """Paid endpoints answer a retried request (same Idempotency-Key) without paying twice"""
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.room = Room.objects.create(name='1234567', creator=self.alice)
+        self.gift = Gift.objects.create(name='Rose', emoji='R', icon_url='', cost=40, rarity='rare')
+        ledger.credit(self.alice, 100, 'admin_grant', GRANTS)
+        self.client.force_login(self.alice)
+
+    def post(self, url, data, key):
+        return self.client.post(url, json.dumps(data), content_type='application/json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_send_gift_retry_is_not_charged_twice(self):
+        url = reverse('chat:send_gift_new', args=[self.room.name])
+        data = {'gift_id': self.gift.id, 'recipient_id': self.bob.id}
+        first = self.post(url, data, 'gift-1').json()
+        retry = self.post(url, data, 'gift-1').json()
+        self.assertTrue(first['success'])
+        self.assertTrue(retry['replayed'])
+        self.assertEqual(retry['remaining_evercoin'], 60)
+        self.assertEqual(ledger.balance(self.alice.id), 60)
+        self.assertEqual(GiftTransaction.objects.count(), 1)
+
+        # A new key is a new gift, until the money runs out
+        self.assertTrue(self.post(url, data, 'gift-2').json()['success'])
+        response = self.post(url, data, 'gift-3')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ledger.balance(self.alice.id), 20)
+        self.assertEqual(GiftTransaction.objects.count(), 2)
+
+    def test_game_score_retry_is_not_paid_twice(self):
+        url = reverse('chat:submit_game_score')
+        data = {'game_type': 'snake', 'score': 150, 'play_time': 60, 'reward': 30}
+        first = self.post(url, data, 'game-1').json()
+        retry = self.post(url, data, 'game-1').json()
+        self.assertEqual(first['total_evercoin'], 130)
+        self.assertEqual(retry['total_evercoin'], 130)
+        self.assertEqual(ledger.balance(self.alice.id), 130)
+        self.assertEqual(GameSession.objects.count(), 1)
+
+
+class IntimacyTests(TestCase):
+    """Pair totals and both leaderboard directions move together (ON CONFLICT upsert where available)"""
+
+    def setUp(self):
+        cache.clear()
+        self.alice, self.bob, self.carol = (User.objects.create_user(name) for name in ('alice', 'bob', 'carol'))
+
+    def assertInStep(self):
+        for pair in Intimacy.objects.all():
+            for user_id, other_id in ((pair.user1_id, pair.user2_id), (pair.user2_id, pair.user1_id)):
+                entry = IntimacyLeaderboardEntry.objects.get(user_id=user_id, other_id=other_id)
+                self.assertEqual(entry.points, pair.points)
+        self.assertEqual(IntimacyLeaderboardEntry.objects.count(), 2 * Intimacy.objects.count())
+
+    def test_add_returns_total_and_updates_both_directions(self):
+        self.assertEqual(intimacy.add(self.alice, self.bob, 5), 5)
+        self.assertEqual(intimacy.add(self.bob, self.alice, 15), 20)
+        self.assertEqual(intimacy.add(self.carol, self.alice, 30), 30)
+        self.assertEqual(intimacy.points(self.alice, self.bob), 20)
+        self.assertEqual(intimacy.points(self.bob, self.carol), 0)
+        self.assertInStep()
+
+    def test_leaderboard_orders_by_points(self):
+        intimacy.add(self.alice, self.bob, 5)
+        intimacy.add(self.alice, self.carol, 50)
+        intimacy.add(self.bob, self.carol, 10)
+        self.assertEqual(intimacy.leaderboard(self.alice), [(self.carol, 50), (self.bob, 5)])
+        self.assertEqual(intimacy.leaderboard(self.carol), [(self.alice, 50), (self.bob, 10)])
+        self.assertEqual(intimacy.leaderboard(self.bob, limit=1), [(self.carol, 10)])
+        self.assertInStep()
+
+
+class IntimacyFallbackTests(IntimacyTests):
+    """The same, through the F() update and create used on MySQL and MariaDB"""
+
+    def setUp(self):
+        patcher = mock.patch('chat.intimacy.upsert_returning_supported', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+
+class RedisPresenceBackendTests(TestCase):
+    """Room index maintenance and eviction of the Redis presence backend (on fakeredis)"""
+
+    def setUp(self):
+        import fakeredis
+
+        self.backend = RedisPresenceBackend(client=fakeredis.FakeRedis(decode_responses=True))
+
+    def test_forget_if_empty(self):
+        self.backend.join('lobby', 'alice', 'Alice')
+        self.backend.forget_if_empty('lobby')
+        self.assertEqual(self.backend.rooms(), ['lobby'])
+        self.backend.leave('lobby', 'alice')
+        self.backend.forget_if_empty('lobby')
+        self.assertEqual(self.backend.rooms(), [])
+
+    def test_join_racing_forget_keeps_the_room_indexed(self):
+        self.backend.join('lobby', 'alice', 'Alice')
+        self.backend.leave('lobby', 'alice')
+        client = self.backend.client
+
+        def join_after(zcard):
+            def zcard_then_join(key):
+                count = zcard(key)
+                # Bob joins right after the room was found empty
+                if self.backend.last_seen('lobby', 'bob') is None:
+                    self.backend.join('lobby', 'bob', 'Bob')
+                return count
+            return zcard_then_join
+
+        def racing_pipeline(*args, pipeline=client.pipeline, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            pipe.zcard = join_after(pipe.zcard)
+            return pipe
+
+        with mock.patch.object(client, 'zcard', join_after(client.zcard)), \
+                mock.patch.object(client, 'pipeline', racing_pipeline):
+            self.backend.forget_if_empty('lobby')
+        self.assertEqual(self.backend.rooms(), ['lobby'])
+        self.assertEqual(self.backend.usernames('lobby'), {'bob'})
+
+    def test_evict_expired(self):
+        now = time.time()
+        self.backend.join('lobby', 'alice', 'Alice', now=now - 300)
+        self.backend.join('lobby', 'bob', 'Bob', now=now - 200)
+        self.backend.join('lobby', 'carol', 'Carol', now=now)
+        self.assertEqual(self.backend.evict_expired('lobby', now=now), {'alice': 'Alice', 'bob': 'Bob'})
+        self.assertEqual(self.backend.evict_expired('lobby', now=now), {})
+        self.assertEqual(self.backend.rooms(), ['lobby'])
+        # The last member expiring drops the room from the index too
+        self.assertEqual(self.backend.evict_expired('lobby', now=now + 300), {'carol': 'Carol'})
+        self.assertEqual(self.backend.rooms(), [])
+        self.assertIsNone(self.backend.last_seen('lobby', 'carol'))
+
+    def test_heartbeat_racing_eviction_keeps_the_member(self):
+        now = time.time()
+        self.backend.join('lobby', 'alice', 'Alice', now=now - 300)
+        client = self.backend.client
+
+        def racing_pipeline(*args, pipeline=client.pipeline, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            if not kwargs.get('transaction', True):
+                execute = pipe.execute
+
+                def execute_then_touch():
+                    results = execute()
+                    # Alice's heartbeat lands after she was found expired
+                    self.backend.touch('lobby', 'alice', now=now)
+                    return results
+                pipe.execute = execute_then_touch
+            return pipe
+
+        with mock.patch.object(client, 'pipeline', racing_pipeline):
+            self.assertEqual(self.backend.evict_expired('lobby', now=now), {})
+        self.assertEqual(self.backend.usernames('lobby', now=now), {'alice'})
+
+    async def test_reaper_pass(self):
+        from channels.layers import get_channel_layer
+
+        now = time.time()
+        self.backend.join('1234567', 'alice', 'Alice', now=now)
+        self.backend.join('1234567', 'bob', 'Bob', now=now - 300)
+        reaper = PresenceReaper(backend=self.backend)
+        reaper.register('1234567', 'alice')
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add('chat_1234567', channel)
+
+        self.assertEqual(await reaper.run_once(now=now + 60), {'1234567': {'bob': 'Bob'}})
+        self.assertIn('"user_leave"', (await channel_layer.receive(channel))['text'])
+        update = json.loads((await channel_layer.receive(channel))['text'])
+        self.assertEqual(update['users'], [{'username': 'alice', 'display_name': 'Alice'}])
+        # Alice's socket was refreshed by the pass, so she outlives the TTL from her join
+        self.assertEqual(await reaper.run_once(now=now + 150), {})
+        await channel_layer.flush()
+
+
+class RedisStreamsChannelLayerTests(SimpleTestCase):
+    """The Redis Streams channel layer (on fakeredis), with two layers standing in for two worker processes"""
+
+    def setUp(self):
+        import fakeredis
+
+        self.server = fakeredis.FakeServer()
+
+    def layer(self, **options):
+        import fakeredis
+
+        return RedisStreamsChannelLayer(
+            client_factory=lambda: fakeredis.FakeAsyncRedis(server=self.server), block_ms=50, **options,
+        )
+
+    async def receive(self, layer, channel, timeout=2):
+        return await asyncio.wait_for(layer.receive(channel), timeout)
+
+    async def assertNothingReceived(self, layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.receive(layer, channel, timeout=0.3)
+
+    async def close(self, *layers):
+        for layer in layers:
+            await layer.flush()
+
+    async def test_send_and_receive(self):
+        first, second = self.layer(), self.layer()
+        try:
+            # A normal channel is shared: any process may receive
+            await first.send('jobs', {'type': 'job', 'n': 1})
+            self.assertEqual(await self.receive(second, 'jobs'), {'type': 'job', 'n': 1})
+            # A process-specific channel is delivered through its owner's stream
+            channel = await second.new_channel()
+            await first.send(channel, {'type': 'direct'})
+            self.assertEqual(await self.receive(second, channel), {'type': 'direct'})
+        finally:
+            await self.close(first, second)
+
+    async def test_group_add_send_discard(self):
+        first, second = self.layer(), self.layer()
+        try:
+            a, b, c = await first.new_channel(), await second.new_channel(), await second.new_channel()
+            for channel in (a, b, c):
+                await (first if channel == a else second).group_add('chat_1', channel)
+            await first.group_send('chat_1', {'type': 'chat', 'text': 'hi'})
+            self.assertEqual(await self.receive(first, a), {'type': 'chat', 'text': 'hi'})
+            self.assertEqual(await self.receive(second, b), {'type': 'chat', 'text': 'hi'})
+            self.assertEqual(await self.receive(second, c), {'type': 'chat', 'text': 'hi'})
+
+            await second.group_discard('chat_1', b)
+            await first.group_send('chat_1', {'type': 'chat', 'text': 'again'})
+            self.assertEqual(await self.receive(second, c), {'type': 'chat', 'text': 'again'})
+            self.assertEqual(await self.receive(first, a), {'type': 'chat', 'text': 'again'})
+            await self.assertNothingReceived(second, b)
+        finally:
+            await self.close(first, second)
+
+    async def test_each_channel_gets_its_own_copy(self):
+        layer = self.layer()
+        try:
+            a, b = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add('chat_1', a)
+            await layer.group_add('chat_1', b)
+            await layer.group_send('chat_1', {'type': 'chat', 'users': ['alice']})
+            received = await self.receive(layer, a)
+            received['users'].append('mallory')
+            self.assertEqual(await self.receive(layer, b), {'type': 'chat', 'users': ['alice']})
+        finally:
+            await self.close(layer)
+
+    async def test_expired_group_messages_are_dropped(self):
+        layer = self.layer(group_retention={'game_*': {'expiry': 10}})
+        try:
+            channel = await layer.new_channel()
+            await layer.group_add('game_1', channel)
+            await layer.group_add('chat_1', channel)
+            # The reader only gets to the move a minute after it was sent
+            later = mock.Mock(wraps=time, time=lambda: time.time() + 60)
+            with mock.patch('chat.streams_layer.time', later):
+                await layer.group_send('game_1', {'type': 'move'})
+                await self.assertNothingReceived(layer, channel)
+            # Groups without a short expiry use the layer's (60s)
+            await layer.group_send('chat_1', {'type': 'chat'})
+            self.assertEqual(await self.receive(layer, channel), {'type': 'chat'})
+        finally:
+            await self.close(layer)
+
+    async def test_reader_recovers_from_connection_errors_and_lost_streams(self):
+        import redis.exceptions
+
+        layer = self.layer()
+        try:
+            channel = await layer.new_channel()
+            await layer.group_add('chat_1', channel)
+            state = layer._state()
+            xreadgroup = state.client.xreadgroup
+            failures = [redis.exceptions.ConnectionError('connection reset')]
+
+            async def flaky_xreadgroup(*args, **kwargs):
+                if failures:
+                    raise failures.pop()
+                return await xreadgroup(*args, **kwargs)
+
+            with mock.patch.object(state.client, 'xreadgroup', flaky_xreadgroup):
+                await layer.group_send('chat_1', {'type': 'chat', 'n': 1})
+                self.assertEqual(await self.receive(layer, channel, timeout=3), {'type': 'chat', 'n': 1})
+
+            # The group's stream (and our consumer group on it) vanishes, e.g. on expiry
+            await state.client.delete(layer._group_key('chat_1'))
+            await asyncio.sleep(0.2)
+            await layer.group_send('chat_1', {'type': 'chat', 'n': 2})
+            self.assertEqual(await self.receive(layer, channel), {'type': 'chat', 'n': 2})
+        finally:
+            await self.close(layer)
+
+
+class ThreadRecordingPresence(LocMemPresenceBackend):
+    """Remembers which thread each presence call ran on"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.threads = {}
+
+    def join(self, *args, **kwargs):
+        self.threads['join'] = threading.get_ident()
+        return super().join(*args, **kwargs)
+
+    def members(self, *args, **kwargs):
+        self.threads['members'] = threading.get_ident()
+        return super().members(*args, **kwargs)
+
+
+class ChatConsumerTests(TestCase):
+    """Room sockets, end to end through the WebSocket routing"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.room = Room.objects.create(name='1234567', creator=self.user, is_finalized=True)
+        self.room.add_member(self.user, 'host')
+        self.presence = ThreadRecordingPresence()
+        patcher = mock.patch('chat.consumers.presence', self.presence)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self):
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+
+        router = URLRouter(websocket_urlpatterns)
+
+        async def application(scope, receive, send):
+            return await router(dict(scope, user=self.user), receive, send)
+
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{self.room.name}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def drain(self, communicator):
+        messages = []
+        while not await communicator.receive_nothing(0.1):
+            messages.append(await communicator.receive_json_from())
+        return messages
+
+    async def close(self, communicator):
+        await communicator.disconnect()
+        if presence_reaper._task is not None:
+            presence_reaper._task.cancel()
+
+    async def test_presence_calls_run_off_the_event_loop(self):
+        communicator = await self.connect()
+        try:
+            messages = await self.drain(communicator)
+            self.assertIn({'type': 'active_users', 'users': [{'username': 'alice', 'display_name': 'alice'}]}, messages)
+            self.assertEqual(set(self.presence.threads), {'join', 'members'})
+            self.assertNotIn(threading.get_ident(), self.presence.threads.values())
+        finally:
+            await self.close(communicator)
+
+    async def invalidate_and_request(self, communicator, request):
+        from channels.layers import get_channel_layer
+
+        # Unban, transfer and the like invalidate every socket in the room
+        await get_channel_layer().group_send(f'chat_{self.room.name}', {'type': 'room_access_changed', 'username': None})
+        await communicator.receive_nothing(0.1)
+        await communicator.send_json_to(request)
+        return await self.drain(communicator)
+
+    async def test_history_and_resume_reload_invalidated_access(self):
+        communicator = await self.connect()
+        try:
+            await self.drain(communicator)
+            replies = await self.invalidate_and_request(communicator, {'type': 'history'})
+            self.assertEqual([reply['type'] for reply in replies], ['history'])
+            replies = await self.invalidate_and_request(communicator, {'type': 'resume', 'last_seq': None})
+            self.assertEqual([reply['type'] for reply in replies], ['resume_snapshot'])
+        finally:
+            await self.close(communicator)
+
+    async def test_denied_history_and_resume_get_an_error(self):
+        communicator = await self.connect()
+        try:
+            await self.drain(communicator)
+            await database_sync_to_async(RoomMember.objects.filter(room=self.room, user=self.user).delete)()
+            for request in ('history', 'resume'):
+                replies = await self.invalidate_and_request(communicator, {'type': request})
+                self.assertEqual([(reply['type'], reply.get('request')) for reply in replies], [('error', request)])
+        finally:
+            await self.close(communicator)
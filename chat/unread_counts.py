@@ -0,0 +1,161 @@
+"""
+Cached unread counters for notifications and private messages.
+
+The notification badge used to run a COUNT(*) on every poll and the friends
+list ran one unread-message COUNT per friend. Both now read counters kept in
+the Django cache: one per user for unread notifications and one per
+(user, friend) pair for unread private messages from that friend.
+
+The database stays the source of truth. A missing counter is recounted on
+read (all of a friends list's missing pairs with one grouped query), counters
+are incremented when rows are created and decremented by the number of rows
+a mark-read actually flipped. Counters expire after TIMEOUT seconds, so any
+drift is recounted from the database at least that often; the
+`reconcile_unread_counts` command recounts everything immediately.
+
+Configure via the UNREAD_COUNTS setting:
+
+    UNREAD_COUNTS = {
+        'TIMEOUT': 900,
+    }
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import metrics
+
+
+DEFAULT_UNREAD_COUNTS = {
+    'TIMEOUT': 900,  # Seconds before a counter is recounted from the database
+}
+
+
+class UnreadCounters:
+    """Per-user unread notification and private message counters"""
+
+    def __init__(self, timeout=900, key_prefix='unread'):
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _notifications_key(self, user_id):
+        return f'{self.key_prefix}:notifications:{user_id}'
+
+    def _messages_key(self, user_id, friend_id):
+        return f'{self.key_prefix}:messages:{user_id}:{friend_id}'
+
+    def _adjust(self, key, delta):
+        """Apply delta to a cached counter; a missing counter is left for the next recount"""
+        try:
+            value = cache.incr(key, delta)
+        except ValueError:
+            return
+        if value < 0:
+            # Lost an increment somewhere: recount on the next read
+            cache.delete(key)
+            metrics.incr('unread.counter_resets')
+
+    # ---- notifications ---------------------------------------------------
+
+    def notifications(self, user_id):
+        """Unread notification count for a user (one cache lookup when warm)"""
+        key = self._notifications_key(user_id)
+        count = cache.get(key)
+        if count is not None:
+            metrics.incr('unread.hits')
+            return count
+        from .models import Notification
+
+        metrics.incr('unread.misses')
+        count = Notification.objects.filter(recipient_id=user_id, is_read=False).count()
+        cache.add(key, count, self.timeout)
+        return count
+
+    def add_notifications(self, user_id, count=1):
+        self._adjust(self._notifications_key(user_id), count)
+
+    def read_notifications(self, user_id, count=1):
+        if count:
+            self._adjust(self._notifications_key(user_id), -count)
+
+    # ---- private messages ------------------------------------------------
+
+    def messages_from(self, user_id, friend_ids):
+        """Return {friend_id: unread messages from that friend} for a user"""
+        friend_ids = list(friend_ids)
+        keys = {self._messages_key(user_id, friend_id): friend_id for friend_id in friend_ids}
+        found = cache.get_many(keys)
+        counts = {keys[key]: value for key, value in found.items()}
+        missing = [friend_id for friend_id in friend_ids if friend_id not in counts]
+        metrics.incr('unread.hits', len(counts))
+        if missing:
+            from .models import PrivateMessage
+
+            metrics.incr('unread.misses', len(missing))
+            recounted = dict.fromkeys(missing, 0)
+            recounted.update(
+                PrivateMessage.objects.filter(receiver_id=user_id, sender_id__in=missing, is_read=False)
+                .values_list('sender_id')
+                .annotate(unread=Count('id'))
+                .order_by()
+            )
+            for friend_id, count in recounted.items():
+                cache.add(self._messages_key(user_id, friend_id), count, self.timeout)
+            counts.update(recounted)
+        return counts
+
+    def add_message(self, user_id, friend_id, count=1):
+        self._adjust(self._messages_key(user_id, friend_id), count)
+
+    def read_messages(self, user_id, friend_id, count=1):
+        if count:
+            self._adjust(self._messages_key(user_id, friend_id), -count)
+
+    # ---- reconciliation --------------------------------------------------
+
+    def reconcile(self, user_ids):
+        """Recount the given users' counters from the database; returns how many were corrected"""
+        from .models import Friendship, Notification, PrivateMessage
+
+        user_ids = list(user_ids)
+        notifications = dict.fromkeys(user_ids, 0)
+        notifications.update(
+            Notification.objects.filter(recipient_id__in=user_ids, is_read=False)
+            .values_list('recipient_id')
+            .annotate(unread=Count('id'))
+            .order_by()
+        )
+        values = {self._notifications_key(user_id): count for user_id, count in notifications.items()}
+
+        friendships = Friendship.objects.filter(
+            Q(sender_id__in=user_ids) | Q(receiver_id__in=user_ids), status='accepted'
+        ).values_list('sender_id', 'receiver_id')
+        for sender_id, receiver_id in friendships:
+            if sender_id in notifications:
+                values[self._messages_key(sender_id, receiver_id)] = 0
+            if receiver_id in notifications:
+                values[self._messages_key(receiver_id, sender_id)] = 0
+        for receiver_id, sender_id, count in (
+            PrivateMessage.objects.filter(receiver_id__in=user_ids, is_read=False)
+            .values_list('receiver_id', 'sender_id')
+            .annotate(unread=Count('id'))
+            .order_by()
+        ):
+            values[self._messages_key(receiver_id, sender_id)] = count
+
+        cached = cache.get_many(list(values))
+        corrected = sum(1 for key, count in cached.items() if count != values[key])
+        cache.set_many(values, self.timeout)
+        metrics.incr('unread.reconciled', corrected)
+        return corrected
+
+
+def create_unread_counters(config=None):
+    config = dict(DEFAULT_UNREAD_COUNTS, **(config or getattr(settings, 'UNREAD_COUNTS', {})))
+    return UnreadCounters(**{key.lower(): value for key, value in config.items()})
+
+
+# Shared counters instance, created on first use
+unread_counts = SimpleLazyObject(create_unread_counters)
@@ -19,11 +19,13 @@ urlpatterns = [
     # Dynamic room routes (placed after specific endpoints)
     path('chat/<str:room_name>/', views.room, name='chat_room'),
     path('chat/<str:room_name>/delete/', views.delete_room, name='delete_room'),
+    path('chat/<str:room_name>/history/', views.room_history, name='room_history'),
     path('chat/<str:room_name>/settings/', views.room_settings, name='room_settings'),
     path('friends/', views.friends_list, name='friends_list'),
     path('friends/send-request/', views.send_friend_request, name='send_friend_request'),
     path('friends/respond-request/', views.respond_friend_request, name='respond_friend_request'),
     path('friends/chat/<str:username>/', views.private_chat, name='private_chat'),
+    path('friends/chat/<str:username>/history/', views.private_history, name='private_history'),
     path('friends/send-message/', views.send_private_message, name='send_private_message'),
     path('friends/set-nickname/', views.set_friend_nickname, name='set_friend_nickname'),
     path('friends/get-nickname/', views.get_friend_nickname, name='get_friend_nickname'),
@@ -31,6 +33,7 @@ urlpatterns = [
     path('friends/unblock/', views.unblock_friend, name='unblock_friend'),
     path('friends/remove/', views.remove_friend, name='remove_friend'),
     path('friends/mark-as-read/', views.mark_messages_as_read, name='mark_messages_as_read'),
+    path('friends/inbox/', views.conversation_inbox, name='conversation_inbox'),
     # Message Management URLs
     path('chat/message/unsend/', views.unsend_message, name='unsend_message'),
     # Profile URLs
@@ -13,7 +13,22 @@ from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from django.utils import timezone
 from django.core.paginator import Paginator
-from .models import Room, Message, RoomMember, RoomBan, Friendship, PrivateMessage, UserProfile, GifPack, GifFile, GifUsageLog
+from .models import Room, Message, RoomMember, RoomBan, Friendship, PrivateMessage, Conversation, UserProfile, GifPack, GifFile, GifUsageLog, GifTrending
+from .message_pipeline import message_pipeline
+from .history import fetch_room_history, serialize_message, clamp_page_size, InvalidCursor
+from .conversations import fetch_inbox, serialize_conversation, clamp_inbox_page_size, fetch_private_history, serialize_private_message
+from .recent_messages import recent_messages
+from .room_events import room_events, broadcast_room_event
+from .presence import presence
+from .notification_outbox import notification_outbox
+from .unread_counts import unread_counts
+from .friend_graph import friend_graph, FriendsOverview
+from .gif_search import gif_search
+from .gif_activity import gif_activity
+from .catalog import catalog
+from .media_store import media_store
+from .evercoin import ledger, InsufficientEvercoin, GIFTS, REWARDS
+from .notification_feed import recent_notifications, badge_delta_events, mark_read as mark_notifications_read
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from functools import wraps
@@ -41,6 +56,17 @@ class KickBanDiagnosticMiddleware:
 def is_ajax(request):
     return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
 
+def invalidate_room_access(room_name, username=None):
+    """Tell connected ChatConsumers to drop their cached room authorization (everyone if no username)"""
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        f'chat_{room_name}',
+        {
+            'type': 'room_access_changed',
+            'username': username,
+        }
+    )
+
 def ajax_login_required(view_func):
     """
     Decorator for AJAX views that require authentication.
@@ -100,42 +126,12 @@ def index(request):
         # Ensure user has a profile
         UserProfile.objects.get_or_create(user=request.user)
         
-        # Get accepted friendships
-        friends_relationships = Friendship.objects.filter(
-            models.Q(sender=request.user) | models.Q(receiver=request.user),
-            status='accepted'
-        ).select_related('sender__profile', 'receiver__profile')
-        
-        friends = []
-        for friendship in friends_relationships:
-            friend = friendship.receiver if friendship.sender == request.user else friendship.sender
-            # Ensure friend has a profile
-            UserProfile.objects.get_or_create(user=friend)
-            friends.append(friend)
-        
-        # Get pending incoming requests
-        incoming_requests = Friendship.objects.filter(
-            receiver=request.user,
-            status='pending'
-        ).select_related('sender', 'sender__profile')
-        
-        # Get pending outgoing requests
-        outgoing_requests = Friendship.objects.filter(
-            sender=request.user,
-            status='pending'
-        ).select_related('receiver', 'receiver__profile')
-        
-        # Get blocked users
-        blocked_users = []
-        blocked_relationships = Friendship.objects.filter(
-            models.Q(sender=request.user) | models.Q(receiver=request.user),
-            status='blocked'
-        ).select_related('sender__profile', 'receiver__profile')
-        
-        for blocked in blocked_relationships:
-            blocked_user = blocked.receiver if blocked.sender == request.user else blocked.sender
-            UserProfile.objects.get_or_create(user=blocked_user)
-            blocked_users.append(blocked_user)
+        # Friends, requests and blocked users in a fixed number of queries
+        overview = FriendsOverview(request.user)
+        friends = overview.friends
+        incoming_requests = overview.incoming_requests
+        outgoing_requests = overview.outgoing_requests
+        blocked_users = overview.blocked_users
     
     return render(request, 'chat/index.html', {
         'rooms': rooms,
@@ -211,7 +207,11 @@ def room(request, room_name):
     except RoomMember.DoesNotExist:
         pass
     
-    messages_list = Message.objects.filter(room=room_obj).order_by('timestamp')[:50]  # Last 50 messages
+    # Read the event position before the page, so resuming from it never skips a message the page lacks
+    room_seq = room_events.current(room_name)
+    # Newest page only, served from the recent-message buffer; older pages are
+    # loaded on scroll via room_history / the WebSocket
+    messages_list, history_cursor = recent_messages.page(room_obj.id)
     user_has_mfa = user_has_device(request.user)
     
     # Get online members for display
@@ -221,6 +221,8 @@ def room(request, room_name):
         'room_name': room_name,
         'room_obj': room_obj,
         'messages': messages_list,
+        'history_cursor': history_cursor or '',
+        'room_seq': room_seq,
         'user': request.user,
         'user_has_mfa': user_has_mfa,
         'is_room_creator': room_obj.can_delete(request.user),
@@ -229,6 +231,35 @@ def room(request, room_name):
         'online_count': online_members.count(),
     })
 
+@ajax_login_required
+@require_http_methods(["GET"])
+def room_history(request, room_name):
+    """Page backwards through a room's messages (?before=<cursor>&limit=<n>)"""
+    try:
+        room_obj = Room.objects.get(name=room_name)
+    except Room.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'Room not found'}, status=404)
+
+    if room_obj.is_user_banned(request.user):
+        return JsonResponse({'success': False, 'message': 'You are banned from this room'}, status=403)
+    if room_obj.is_private() and room_obj.creator != request.user and not request.session.get(f'room_access_{room_name}'):
+        return JsonResponse({'success': False, 'message': 'Room password required'}, status=403)
+
+    try:
+        page, next_cursor = fetch_room_history(
+            room_obj.id,
+            before=request.GET.get('before') or None,
+            limit=clamp_page_size(request.GET.get('limit')),
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+
+    return JsonResponse({
+        'success': True,
+        'messages': [serialize_message(message) for message in page],
+        'next_cursor': next_cursor,
+    })
+
 @login_required
 @require_POST
 def create_room(request):
@@ -396,6 +427,7 @@ def delete_room_ajax(request):
             })
         
         # Notify all connected users before deleting the room
+        invalidate_room_access(room_name)
         channel_layer = get_channel_layer()
         room_group_name = f'chat_{room_name}'
         
@@ -407,10 +439,10 @@ def delete_room_ajax(request):
             }
         )
         
-        # Clear active users from cache
-        from django.core.cache import cache
-        cache_key = f"active_users_{room_name}"
-        cache.delete(cache_key)
+        # Clear presence entries and buffered messages for the room
+        presence.clear(room_name)
+        recent_messages.clear(room.id)
+        room_events.clear(room_name)
         
         room.delete()
         return JsonResponse({
@@ -443,6 +475,7 @@ def delete_room(request, room_name):
     
     if request.method == 'POST':
         # Notify all connected users before deleting the room
+        invalidate_room_access(room_name)
         channel_layer = get_channel_layer()
         room_group_name = f'chat_{room_name}'
         
@@ -454,10 +487,10 @@ def delete_room(request, room_name):
             }
         )
         
-        # Clear active users from cache
-        from django.core.cache import cache
-        cache_key = f"active_users_{room_name}"
-        cache.delete(cache_key)
+        # Clear presence entries and buffered messages for the room
+        presence.clear(room_name)
+        recent_messages.clear(room_obj.id)
+        room_events.clear(room_name)
         
         # Send WebSocket notification to room list clients
         async_to_sync(channel_layer.group_send)(
@@ -489,11 +522,8 @@ def room_settings(request, room_name):
         messages.error(request, 'Only the room host can access room settings.')
         return redirect('chat:chat_room', room_name=room_name)
     
-    # Presence: derive online from cache active_users to avoid stale DB status
-    from django.core.cache import cache
-    cache_key = f"active_users_{room_name}"
-    active_cache = cache.get(cache_key, {})  # dict of username -> {username, display_name}
-    active_usernames = {data['username'] for data in active_cache.values() if 'username' in data}
+    # Presence: derive online from the presence service to avoid stale DB status
+    active_usernames = presence.usernames(room_name)
 
     all_members = room_obj.get_all_members().select_related('user')
     online_members = [m for m in all_members if m.user.username in active_usernames]
@@ -586,34 +616,25 @@ def kick_member(request):
         
         # Kick the user
         room_obj.kick_user(user_to_kick)
+        invalidate_room_access(room_name, username)
         
-        # Create notification for kicked user
+        # Notify the kicked user and remove them from the room (delivered by the outbox dispatcher)
         from .models import Notification
-        notification = Notification.create_kick_notification(user_to_kick, room_obj, request.user)
-        
-        # Send WebSocket notification to kicked user's notification channel
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f'notifications_{user_to_kick.username}',
-            {
+        notification = Notification.create_kick_notification(user_to_kick, room_obj, request.user, commit=False)
+        notification_outbox.enqueue(notifications=[notification], events=[
+            (f'notifications_{user_to_kick.username}', {
                 'type': 'kick_notification',
                 'sender': request.user.username,
                 'room': room_name,
                 'message': f'You were kicked from {room_name} by {request.user.username}',
                 'timestamp': notification.created_at.isoformat()
-            }
-        )
-        
-        # Send WebSocket notification to kick user from the room
-        room_group_name = f'chat_{room_name}'
-        async_to_sync(channel_layer.group_send)(
-            room_group_name,
-            {
+            }),
+            (f'chat_{room_name}', {
                 'type': 'user_kicked',
                 'username': username,
                 'message': 'You have been kicked from this room.'
-            }
-        )
+            }),
+        ])
         
         if is_ajax_req:
             return JsonResponse({'success': True,'message': f'{username} has been kicked from the room.'})
@@ -703,34 +724,25 @@ def ban_member(request):
         
         # Ban the user
         room_obj.ban_user(user_to_ban, request.user, reason)
+        invalidate_room_access(room_name, username)
         
-        # Create notification for banned user
+        # Notify the banned user and remove them from the room (delivered by the outbox dispatcher)
         from .models import Notification
-        notification = Notification.create_ban_notification(user_to_ban, room_obj, request.user)
-        
-        # Send WebSocket notification to banned user's notification channel
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f'notifications_{user_to_ban.username}',
-            {
+        notification = Notification.create_ban_notification(user_to_ban, room_obj, request.user, commit=False)
+        notification_outbox.enqueue(notifications=[notification], events=[
+            (f'notifications_{user_to_ban.username}', {
                 'type': 'ban_notification',
                 'sender': request.user.username,
                 'room': room_name,
                 'message': f'You were banned from {room_name} by {request.user.username}',
                 'timestamp': notification.created_at.isoformat()
-            }
-        )
-        
-        # Send WebSocket notification to ban user from the room
-        room_group_name = f'chat_{room_name}'
-        async_to_sync(channel_layer.group_send)(
-            room_group_name,
-            {
+            }),
+            (f'chat_{room_name}', {
                 'type': 'user_banned',
                 'username': username,
                 'message': f'You have been banned from this room. Reason: {reason}' if reason else 'You have been banned from this room.'
-            }
-        )
+            }),
+        ])
         
         if is_ajax_req:
             return JsonResponse({'success': True,'message': f'{username} has been banned from the room.'})
@@ -787,6 +799,7 @@ def unban_member(request):
         
         # Unban the user
         room_obj.unban_user(user_to_unban)
+        invalidate_room_access(room_name, username)
         
         return JsonResponse({
             'success': True,
@@ -865,21 +878,17 @@ def send_friend_request(request):
                 status='pending'
             )
             
-            # Create notification for friend request
+            # Create notification for friend request (delivered by the outbox dispatcher)
             from .models import Notification
-            notification = Notification.create_friend_request_notification(request.user, target_user)
-            
-            # Send WebSocket notification
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f'notifications_{target_user.username}',
-                {
+            notification = Notification.create_friend_request_notification(request.user, target_user, commit=False)
+            notification_outbox.enqueue(notifications=[notification], events=[
+                (f'notifications_{target_user.username}', {
                     'type': 'friend_request_notification',
                     'sender': request.user.username,
                     'message': f'{request.user.username} sent you a friend request',
                     'timestamp': notification.created_at.isoformat()
-                }
-            )
+                }),
+            ])
             
             return JsonResponse({
                 'success': True,
@@ -923,21 +932,17 @@ def respond_friend_request(request):
             friendship.accept()
             message = f'You are now friends with {friendship.sender.username}!'
             
-            # Create notification for sender
+            # Notify the sender (delivered by the outbox dispatcher)
             from .models import Notification
-            notification = Notification.create_friend_accepted_notification(friendship.sender, request.user)
-            
-            # Send WebSocket notification to sender
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f'notifications_{friendship.sender.username}',
-                {
+            notification = Notification.create_friend_accepted_notification(friendship.sender, request.user, commit=False)
+            notification_outbox.enqueue(notifications=[notification], events=[
+                (f'notifications_{friendship.sender.username}', {
                     'type': 'friend_accepted_notification',
                     'sender': request.user.username,
                     'message': f'{request.user.username} accepted your friend request',
                     'timestamp': notification.created_at.isoformat()
-                }
-            )
+                }),
+            ])
         elif status == 'declined':
             friendship.decline()
             message = f'Friend request from {friendship.sender.username} declined.'
@@ -1011,6 +1016,7 @@ def transfer_ownership(request):
         
         # Transfer ownership
         room_obj.transfer_ownership(new_owner)
+        invalidate_room_access(room_name)
         
         # Send WebSocket notification
         channel_layer = get_channel_layer()
@@ -1158,18 +1164,16 @@ def get_intimacy_level(intimacy_points):
 @login_required
 def friends_list(request):
     """Display user's friends list with intimacy levels"""
-    # Get accepted friendships
+    # Friends and requests from the cached friend graph
     friends = []
-    friendships = Friendship.objects.filter(
-        models.Q(sender=request.user, status='accepted') |
-        models.Q(receiver=request.user, status='accepted')
-    )
+    overview = FriendsOverview(request.user)
     
-    for friendship in friendships:
-        friend = friendship.receiver if friendship.sender == request.user else friendship.sender
-        
-        # Get intimacy points from friendship
-        intimacy_points = friendship.intimacy_points if hasattr(friendship, 'intimacy_points') else 0
+    # Unread message counts for every friend in one cache lookup
+    unread = unread_counts.messages_from(request.user.id, overview.relations['accepted'])
+    
+    for friend in overview.friends:
+        # Friendship rows carry no intimacy points (they live in Intimacy)
+        intimacy_points = 0
         
         # Calculate intimacy level
         level_info = get_intimacy_level(intimacy_points)
@@ -1177,9 +1181,7 @@ def friends_list(request):
         friends.append({
             'user': friend,
             'is_online': False,  # TODO: Implement online status tracking
-            'unread_count': PrivateMessage.objects.filter(
-                sender=friend, receiver=request.user, is_read=False
-            ).count(),
+            'unread_count': unread[friend.id],
             'intimacy_points': intimacy_points,
             'intimacy_level': level_info
         })
@@ -1187,20 +1189,10 @@ def friends_list(request):
     # Sort friends by intimacy level (highest first)
     friends.sort(key=lambda x: x['intimacy_points'], reverse=True)
     
-    # Get incoming friend requests
-    incoming_requests = Friendship.objects.filter(
-        receiver=request.user, status='pending'
-    )
-    
-    # Get outgoing friend requests
-    outgoing_requests = Friendship.objects.filter(
-        sender=request.user, status='pending'
-    )
-    
     return render(request, 'chat/friends_list.html', {
         'friends': friends,
-        'incoming_requests': incoming_requests,
-        'outgoing_requests': outgoing_requests,
+        'incoming_requests': overview.incoming_requests,
+        'outgoing_requests': overview.outgoing_requests,
     })
 
 
@@ -1224,20 +1216,21 @@ def private_chat(request, username):
     intimacy_points = friendship.intimacy_points if friendship and hasattr(friendship, 'intimacy_points') else 0
     intimacy_level = get_intimacy_level(intimacy_points)
     
-    # Get conversation messages
-    messages_list = PrivateMessage.objects.filter(
-        models.Q(sender=request.user, receiver=friend) |
-        models.Q(sender=friend, receiver=request.user)
-    ).order_by('timestamp')[:50]
+    # Newest page of the conversation; older pages load on scroll (see private_history)
+    conversation = Conversation.between(request.user, friend)
+    messages_list, history_cursor = fetch_private_history(conversation.id) if conversation else ([], None)
     
     # Mark messages from friend as read
-    PrivateMessage.objects.filter(
+    marked = PrivateMessage.objects.filter(
         sender=friend, receiver=request.user, is_read=False
     ).update(is_read=True)
+    unread_counts.read_messages(request.user.id, friend.id, marked)
+    Conversation.mark_read(request.user, friend)
     
     return render(request, 'chat/private_chat.html', {
         'friend': friend,
         'messages': messages_list,
+        'history_cursor': history_cursor,
         'intimacy_points': intimacy_points,
         'intimacy_level': intimacy_level,
     })
@@ -1267,9 +1260,9 @@ def send_private_message(request):
         print(f"[PRIVATE MSG DEBUG] Are friends check: {are_friends}")
         
         # Debug: Show friendship status
-        friendship = Friendship.get_friendship(request.user, receiver)
-        if friendship:
-            print(f"[PRIVATE MSG DEBUG] Friendship exists: sender={friendship.sender.username}, receiver={friendship.receiver.username}, status={friendship.status}")
+        relation = friend_graph.relation(request.user.id, receiver.id)
+        if relation:
+            print(f"[PRIVATE MSG DEBUG] Friendship exists: relation={relation}")
         else:
             print(f"[PRIVATE MSG DEBUG] No friendship record found between {request.user.username} and {username}")
         
@@ -1279,33 +1272,24 @@ def send_private_message(request):
                 'message': 'You can only send messages to friends. Make sure the friend request is accepted.'
             })
         
-        # Create private message
-        message = PrivateMessage.objects.create(
-            sender=request.user,
-            receiver=receiver,
-            content=content
-        )
+        # Create private message (and update the conversation summary)
+        message = Conversation.post_message(request.user, receiver, content)
         
         print(f"[PRIVATE MSG DEBUG] Message created successfully: ID={message.id}")
         
-        # Send real-time notification via WebSocket
+        # Queue the real-time notification for the outbox dispatcher
         try:
-            channel_layer = get_channel_layer()
-            notification_group = f'notifications_{receiver.username}'
-            
-            async_to_sync(channel_layer.group_send)(
-                notification_group,
-                {
+            notification_outbox.enqueue(events=[
+                (f'notifications_{receiver.username}', {
                     'type': 'new_message_notification',
                     'sender': request.user.username,
                     'message': content[:100],  # Truncate for notification
                     'timestamp': message.timestamp.isoformat(),
                     'message_id': message.id
-                }
-            )
-            print(f"[NOTIFICATION] Sent WebSocket notification to {receiver.username}")
+                }),
+            ])
         except Exception as e:
-            print(f"[NOTIFICATION ERROR] Failed to send WebSocket notification: {str(e)}")
+            print(f"[NOTIFICATION ERROR] Failed to queue WebSocket notification: {str(e)}")
             # Don't fail the entire request if notification fails
         
         return JsonResponse({
@@ -1541,6 +1525,58 @@ def remove_friend(request):
         })
 
 
+@ajax_login_required
+@require_http_methods(["GET"])
+def private_history(request, username):
+    """Page backwards through a private chat (?before=<cursor>&limit=<n>)"""
+    try:
+        friend = User.objects.get(username=username)
+    except User.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'User not found'}, status=404)
+
+    if not Friendship.are_friends(request.user, friend):
+        return JsonResponse({'success': False, 'message': f'You are not friends with {username}.'}, status=403)
+
+    conversation = Conversation.between(request.user, friend)
+    if conversation is None:
+        return JsonResponse({'success': True, 'messages': [], 'next_cursor': None})
+
+    try:
+        page, next_cursor = fetch_private_history(
+            conversation.id,
+            before=request.GET.get('before') or None,
+            limit=clamp_page_size(request.GET.get('limit')),
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+
+    return JsonResponse({
+        'success': True,
+        'messages': [serialize_private_message(message) for message in page],
+        'next_cursor': next_cursor,
+    })
+
+
+@ajax_login_required
+@require_http_methods(["GET"])
+def conversation_inbox(request):
+    """List the user's private conversations, most recent first (?before=<cursor>&limit=<n>)"""
+    try:
+        page, next_cursor = fetch_inbox(
+            request.user,
+            before=request.GET.get('before') or None,
+            limit=clamp_inbox_page_size(request.GET.get('limit')),
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+
+    return JsonResponse({
+        'success': True,
+        'conversations': [serialize_conversation(conversation, request.user) for conversation in page],
+        'next_cursor': next_cursor,
+    })
+
+
 @login_required
 @require_POST
 def mark_messages_as_read(request):
@@ -1557,11 +1593,13 @@ def mark_messages_as_read(request):
         sender = get_object_or_404(User, username=sender_username)
         
         # Mark all unread messages from this sender as read
-        PrivateMessage.objects.filter(
+        marked = PrivateMessage.objects.filter(
             sender=sender,
             receiver=request.user,
             is_read=False
         ).update(is_read=True)
+        unread_counts.read_messages(request.user.id, sender.id, marked)
+        Conversation.mark_read(request.user, sender)
         
         return JsonResponse({
             'success': True
@@ -1587,6 +1625,9 @@ def unsend_message(request):
                 'message': 'Message ID is required.'
             })
         
+        # The message may still be queued in the write-behind pipeline
+        if not Message.objects.filter(id=message_id).exists():
+            message_pipeline.flush()
         message = get_object_or_404(Message, id=message_id)
         
         # Check if user can delete the message
@@ -1600,20 +1641,15 @@ def unsend_message(request):
         message.is_deleted = True
         message.content = '[Message deleted]'
         message.save()
+        recent_messages.patch(message.room_id, message.id, is_deleted=True, message=message.content)
         
         # Broadcast deletion to all users in the room via WebSocket
         try:
-            channel_layer = get_channel_layer()
-            room_group = f'chat_{message.room.name}'
-            
-            async_to_sync(channel_layer.group_send)(
-                room_group,
-                {
-                    'type': 'delete_message',
-                    'message_id': message_id,
-                    'username': request.user.username
-                }
-            )
+            broadcast_room_event(message.room.name, {
+                'type': 'delete_message',
+                'message_id': message_id,
+                'username': request.user.username
+            })
         except Exception as e:
             print(f"[UNSEND ERROR] Failed to send WebSocket notification: {str(e)}")
         
@@ -1825,26 +1861,15 @@ def upload_profile_picture(request):
         return JsonResponse({'success': False, 'message': 'File size cannot exceed 5MB.'})
     
     try:
-        import os, time
-        from django.core.files.storage import default_storage
+        import os
         from urllib.parse import urljoin
-        # Delete old profile picture if exists
-        if profile.profile_picture:
-            try:
-                profile.profile_picture.delete()
-            except Exception:
-                pass
-        base, ext = os.path.splitext(file.name)
-        if not ext:
-            ext = '.jpg'
-        unique_name = f"u{request.user.id}_{int(time.time())}{ext.lower()}"
-        relative_path = f"profile_pictures/{unique_name}"
-        full_dir = os.path.join(settings.MEDIA_ROOT, 'profile_pictures')
-        os.makedirs(full_dir, exist_ok=True)
+        # Stored under its content hash; the previous picture may be shared with
+        # another profile, so it is left for gc_media instead of deleted here
+        saved_path = media_store.save(file, 'profile_pictures', file.name, default_ext='.jpg')
+        ext = os.path.splitext(saved_path)[1]
+        full_dir = os.path.join(settings.MEDIA_ROOT, os.path.dirname(saved_path))
         # Clear pixel avatar when uploading custom picture
         profile.pixel_avatar = ''
-        # Save via storage explicitly to ensure directory creation
-        saved_path = default_storage.save(relative_path, file)
         profile.profile_picture.name = saved_path
         profile.save()
         full_path = os.path.join(settings.MEDIA_ROOT, saved_path.replace('/', os.sep))
@@ -1852,9 +1877,8 @@ def upload_profile_picture(request):
         if not exists:
             return JsonResponse({'success': False, 'message': 'File save failed on server (not found after write).'} , status=500)
         img_url = profile.get_profile_picture_url()
-        # Build absolute URL
-        absolute_url = urljoin(request.build_absolute_uri('/'), img_url.lstrip('/'))
-        img_url_versioned = f"{absolute_url}?v={int(time.time())}"
+        # Build absolute URL (content-addressed, so it needs no ?v= cache buster)
+        img_url_versioned = urljoin(request.build_absolute_uri('/'), img_url.lstrip('/'))
         print(f"[UPLOAD PROFILE] Saved {full_path} exists={exists} url={img_url_versioned}")
         # List directory contents for debugging
         try:
@@ -1899,22 +1923,12 @@ def upload_cover_image(request):
         return JsonResponse({'success': False, 'message': 'File size cannot exceed 10MB.'})
     
     try:
-        import os, time
-        from django.core.files.storage import default_storage
+        import os
         from urllib.parse import urljoin
-        if profile.cover_image:
-            try:
-                profile.cover_image.delete()
-            except Exception:
-                pass
-        base, ext = os.path.splitext(file.name)
-        if not ext:
-            ext = '.jpg'
-        unique_name = f"c{request.user.id}_{int(time.time())}{ext.lower()}"
-        relative_path = f"cover_images/{unique_name}"
-        full_dir = os.path.join(settings.MEDIA_ROOT, 'cover_images')
-        os.makedirs(full_dir, exist_ok=True)
-        saved_path = default_storage.save(relative_path, file)
+        # Content-addressed like profile pictures; gc_media removes the previous cover
+        saved_path = media_store.save(file, 'cover_images', file.name, default_ext='.jpg')
+        ext = os.path.splitext(saved_path)[1]
+        full_dir = os.path.join(settings.MEDIA_ROOT, os.path.dirname(saved_path))
         profile.cover_image.name = saved_path
         profile.save()
         full_path = os.path.join(settings.MEDIA_ROOT, saved_path.replace('/', os.sep))
@@ -1922,8 +1936,7 @@ def upload_cover_image(request):
         if not exists:
             return JsonResponse({'success': False, 'message': 'File save failed on server (not found after write).'}, status=500)
         img_url = profile.get_cover_image_url()
-        absolute_url = urljoin(request.build_absolute_uri('/'), img_url.lstrip('/'))
-        img_url_versioned = f"{absolute_url}?v={int(time.time())}"
+        img_url_versioned = urljoin(request.build_absolute_uri('/'), img_url.lstrip('/'))
         print(f"[UPLOAD COVER] Saved {full_path} exists={exists} url={img_url_versioned}")
         try:
             cover_dir_listing = os.listdir(full_dir)
@@ -1954,10 +1967,7 @@ def view_profile(request, username=None):
     profile, created = UserProfile.objects.get_or_create(user=user)
 
     # Get friend count
-    from .models import Friendship
-    friend_count = Friendship.objects.filter(
-        Q(sender=user, status='accepted') | Q(receiver=user, status='accepted')
-    ).count()
+    friend_count = FriendsOverview(user).friend_count
 
     # Determine animated cover CSS class (reuse logic from edit_profile)
     cover_css_class = ''
@@ -2011,12 +2021,7 @@ def view_profile(request, username=None):
 def notification_count(request):
     """Get unread notification count for the current user"""
     try:
-        from .models import Notification
-        
-        unread_count = Notification.objects.filter(
-            recipient=request.user,
-            is_read=False
-        ).count()
+        unread_count = unread_counts.notifications(request.user.id)
         
         return JsonResponse({
             'success': True,
@@ -2034,25 +2039,8 @@ def notification_count(request):
 def notification_list(request):
     """Get list of recent notifications"""
     try:
-        from .models import Notification
-        
         # Get recent notifications (all types)
-        notifications = Notification.objects.filter(
-            recipient=request.user
-        ).select_related('sender', 'room').order_by('-created_at')[:20]
-        
-        notification_data = []
-        for notif in notifications:
-            notification_data.append({
-                'id': notif.id,
-                'type': notif.notification_type,
-                'sender': notif.sender.username if notif.sender else 'System',
-                'title': notif.title,
-                'message': notif.message,
-                'link': notif.link,
-                'timestamp': notif.created_at.isoformat(),
-                'is_read': notif.is_read,
-            })
+        notification_data = recent_notifications(request.user.id)
         
         return JsonResponse({
             'success': True,
@@ -2078,7 +2066,9 @@ def mark_notification_read(request, notification_id):
             id=notification_id,
             recipient=request.user
         )
-        notification.mark_as_read()
+        badge_delta = mark_notifications_read(request.user, [notification.id])
+        if badge_delta:
+            notification_outbox.enqueue(events=badge_delta_events(request.user, badge_delta))
         
         return JsonResponse({
             'success': True,
@@ -2096,12 +2086,10 @@ def mark_notification_read(request, notification_id):
 def mark_all_notifications_read(request):
     """Mark all notifications as read for the current user"""
     try:
-        from .models import Notification
-        
-        updated_count = Notification.objects.filter(
-            recipient=request.user,
-            is_read=False
-        ).update(is_read=True)
+        badge_delta = mark_notifications_read(request.user)
+        updated_count = -badge_delta['delta'] if badge_delta else 0
+        if badge_delta:
+            notification_outbox.enqueue(events=badge_delta_events(request.user, badge_delta))
         
         return JsonResponse({
             'success': True,
@@ -2211,33 +2199,25 @@ def send_gift(request):
 def get_room_users(request, room_name):
     """Get online users in a room (for gift recipient selection)"""
     try:
-        from django.core.cache import cache
-        from django.contrib.auth.models import User
-        
         room = get_object_or_404(Room, name=room_name)
         
-        # Get active users from cache (real-time tracking)
-        cache_key = f"active_users_{room_name}"
-        active_users = cache.get(cache_key, {})
+        # Get active users from the presence service (real-time tracking)
+        active_usernames = presence.usernames(room_name)
+        active_usernames.discard(request.user.username)
         
         # Build user list with proper display names, excluding current user
         users = []
-        for username, display_name in active_users.items():
-            if username != request.user.username:
-                try:
-                    user = User.objects.get(username=username)
-                    # Use proper display name
-                    full_name = f"{user.first_name} {user.last_name}".strip()
-                    if not full_name:
-                        full_name = user.username
-                    
-                    users.append({
-                        'id': user.id,
-                        'username': user.username,
-                        'first_name': full_name
-                    })
-                except User.DoesNotExist:
-                    continue
+        for user in User.objects.filter(username__in=active_usernames).order_by('username'):
+            # Use proper display name
+            full_name = f"{user.first_name} {user.last_name}".strip()
+            if not full_name:
+                full_name = user.username
+            
+            users.append({
+                'id': user.id,
+                'username': user.username,
+                'first_name': full_name
+            })
         
         return JsonResponse({
             'success': True,
@@ -2255,6 +2235,7 @@ def get_room_users(request, room_name):
 def send_gift_new(request, room_name):
     """Send a gift to a user with Evercoin deduction and intimacy increase"""
     try:
+        from django.db import transaction as db_transaction
         from .models import Gift, GiftTransaction, Intimacy
         import json
         
@@ -2272,92 +2253,90 @@ def send_gift_new(request, room_name):
         gift = get_object_or_404(Gift, id=gift_id)
         room = get_object_or_404(Room, name=room_name)
         
-        # Check Evercoin balance
-        sender_profile = sender.profile
-        if sender_profile.evercoin < gift.cost:
-            return JsonResponse({
-                'success': False,
-                'error': f'Not enough Evercoin! Need {gift.cost}, have {sender_profile.evercoin}'
-            }, status=400)
-        
-        # Deduct Evercoin
-        sender_profile.evercoin -= gift.cost
-        sender_profile.save()
-        
-        # Calculate intimacy gain (based on gift rarity)
-        rarity_points = {
-            'common': 5,
-            'rare': 15,
-            'epic': 30,
-            'legendary': 50
-        }
-        intimacy_points = rarity_points.get(gift.rarity, 5)
-        
-        # Create gift transaction
-        transaction = GiftTransaction.objects.create(
-            gift=gift,
-            sender=sender,
-            receiver=recipient,
-            room=room,
-            message=message,
-            intimacy_gained=intimacy_points
-        )
-        
-        # Add intimacy between users
-        Intimacy.add_intimacy(sender, recipient, intimacy_points)
-        
-        # Get current intimacy
-        total_intimacy = Intimacy.get_intimacy(sender, recipient)
+        # Pay for the gift: one conditional UPDATE, so concurrent gifts cannot overspend.
+        # A retried request with the same Idempotency-Key is answered without paying again.
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        with db_transaction.atomic():
+            try:
+                payment = ledger.debit(
+                    sender, gift.cost, 'gift', GIFTS,
+                    reference=f'gift:{gift.id}:to:{recipient.id}', idempotency_key=idempotency_key,
+                )
+            except InsufficientEvercoin:
+                return JsonResponse({
+                    'success': False,
+                    'error': f'Not enough Evercoin! Need {gift.cost}, have {ledger.balance(sender.id)}'
+                }, status=400)
+            
+            if payment.replayed:
+                return JsonResponse({
+                    'success': True,
+                    'replayed': True,
+                    'message': 'Gift already sent',
+                    'remaining_evercoin': payment.balance_after,
+                    'animation': gift.animation,
+                    'gift_emoji': gift.emoji,
+                    'gift_name': gift.name,
+                })
+            
+            # Calculate intimacy gain (based on gift rarity)
+            rarity_points = {
+                'common': 5,
+                'rare': 15,
+                'epic': 30,
+                'legendary': 50
+            }
+            intimacy_points = rarity_points.get(gift.rarity, 5)
+            
+            # Create gift transaction
+            transaction = GiftTransaction.objects.create(
+                gift=gift,
+                sender=sender,
+                receiver=recipient,
+                room=room,
+                message=message,
+                intimacy_gained=intimacy_points
+            )
+            
+            # Add intimacy between users (returns the new total)
+            total_intimacy = Intimacy.add_intimacy(sender, recipient, intimacy_points)
         
-        # Broadcast gift animation to all users in the room
+        # Broadcast gift animation to the room and intimacy updates to both users (via the outbox dispatcher)
         try:
-            channel_layer = get_channel_layer()
-            room_group = f'chat_{room_name}'
-            
             sender_display_name = f"{sender.first_name} {sender.last_name}".strip() or sender.username
             recipient_display_name = f"{recipient.first_name} {recipient.last_name}".strip() or recipient.username
             
-            async_to_sync(channel_layer.group_send)(
-                room_group,
-                {
-                    'type': 'gift_animation',
-                    'sender_username': sender.username,
-                    'sender_display': sender_display_name,
-                    'recipient_username': recipient.username,
-                    'recipient_display': recipient_display_name,
-                    'gift_name': gift.name,
-                    'gift_emoji': gift.emoji,
-                    'animation': gift.animation,
-                    'intimacy_gained': intimacy_points,
-                    'intimacy_total': total_intimacy
-                }
-            )
+            gift_event = room_events.record(room_name, {
+                'type': 'gift_animation',
+                'sender_username': sender.username,
+                'sender_display': sender_display_name,
+                'recipient_username': recipient.username,
+                'recipient_display': recipient_display_name,
+                'gift_name': gift.name,
+                'gift_emoji': gift.emoji,
+                'animation': gift.animation,
+                'intimacy_gained': intimacy_points,
+                'intimacy_total': total_intimacy
+            })
             
-            # Send intimacy updates to both sender and recipient via their notification channels
-            from django.utils import timezone
             timestamp = timezone.now().isoformat()
-            
-            # Update sender's intimacy display for this recipient
-            async_to_sync(channel_layer.group_send)(
-                f'notifications_{sender.username}',
-                {
+            notification_outbox.enqueue(events=[
+                (f'chat_{room_name}', gift_event),
+                # Update sender's intimacy display for this recipient
+                (f'notifications_{sender.username}', {
                     'type': 'intimacy_update',
                     'username': recipient.username,
                     'intimacy': total_intimacy,
                     'timestamp': timestamp
-                }
-            )
-            
-            # Update recipient's intimacy display for the sender
-            async_to_sync(channel_layer.group_send)(
-                f'notifications_{recipient.username}',
-                {
+                }),
+                # Update recipient's intimacy display for the sender
+                (f'notifications_{recipient.username}', {
                     'type': 'intimacy_update',
                     'username': sender.username,
                     'intimacy': total_intimacy,
                     'timestamp': timestamp
-                }
-            )
+                }),
+            ])
         except Exception as e:
             print(f"[GIFT BROADCAST ERROR] {str(e)}")
         
@@ -2365,7 +2344,7 @@ def send_gift_new(request, room_name):
             'success': True,
             'message': f'Gift sent! +{intimacy_points} Intimacy',
             'transaction_id': transaction.id,
-            'remaining_evercoin': sender_profile.evercoin,
+            'remaining_evercoin': payment.balance_after,
             'animation': gift.animation,
             'gift_emoji': gift.emoji,
             'gift_name': gift.name,
@@ -2418,20 +2397,13 @@ def get_user_intimacy(request):
 def get_leaderboard(request):
     """Get intimacy leaderboard"""
     try:
-        from .models import Intimacy
+        from .intimacy import intimacy
         
-        # Get all intimacy records and sort by points
-        leaderboard = Intimacy.objects.filter(
-            models.Q(user1=request.user) | models.Q(user2=request.user)
-        ).order_by('-points')[:20]
-        
-        data = []
-        for item in leaderboard:
-            other_user = item.user2 if item.user1 == request.user else item.user1
-            data.append({
-                'username': other_user.username,
-                'intimacy': item.points
-            })
+        # Materialized per-user ranking, highest first
+        data = [
+            {'username': other_user.username, 'intimacy': points}
+            for other_user, points in intimacy.leaderboard(request.user)
+        ]
         
         return JsonResponse({
             'success': True,
@@ -2448,29 +2420,9 @@ def get_leaderboard(request):
 def get_gifts(request):
     """Get list of available gifts for sending with costs"""
     try:
-        from .models import Gift, GiftTransaction, Intimacy
-        user_profile = request.user.profile
-        
-        gifts = Gift.objects.all().values('id', 'name', 'emoji', 'icon_url', 'rarity', 'description', 'cost', 'animation')
-        
-        # Group by rarity
-        grouped = {
-            'common': [],
-            'rare': [],
-            'epic': [],
-            'legendary': []
-        }
-        
-        for gift in gifts:
-            rarity = gift['rarity']
-            if rarity in grouped:
-                grouped[rarity].append(gift)
-        
-        return JsonResponse({
-            'success': True,
-            'gifts': grouped,
-            'user_evercoin': user_profile.evercoin
-        })
+        # Cached catalog snapshot (grouped by rarity) plus the user's balance; 304 when unchanged
+        snapshot = catalog.gifts().extend(user_evercoin=ledger.balance(request.user.id))
+        return catalog.respond(request, snapshot)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -2558,24 +2510,8 @@ def search_gifts(request):
 def get_gif_packs(request):
     """Get all active GIF packs"""
     try:
-        packs = GifPack.objects.filter(is_active=True).values(
-            'id', 'name', 'icon', 'order'
-        )
-        
-        packs_list = []
-        for pack in packs:
-            gif_count = GifFile.objects.filter(pack_id=pack['id'], is_active=True).count()
-            packs_list.append({
-                'id': pack['id'],
-                'name': pack['name'],
-                'icon': pack['icon'],
-                'gif_count': gif_count
-            })
-        
-        return JsonResponse({
-            'success': True,
-            'packs': packs_list
-        })
+        # Cached catalog snapshot; 304 when unchanged
+        return catalog.respond(request, catalog.gif_packs())
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -2588,41 +2524,8 @@ def get_gif_packs(request):
 def get_gifs_by_pack(request, pack_id):
     """Get GIFs from a specific pack"""
     try:
-        pack = GifPack.objects.get(id=pack_id, is_active=True)
-        page = request.GET.get('page', 1)
-        
-        gifs = GifFile.objects.filter(pack=pack, is_active=True).order_by('order')
-        
-        # Pagination
-        paginator = Paginator(gifs, 12)
-        page_obj = paginator.get_page(page)
-        
-        gifs_list = []
-        for gif in page_obj:
-            gifs_list.append({
-                'id': gif.id,
-                'title': gif.title,
-                'url': gif.get_url(),
-                'thumbnail': gif.thumbnail.url if gif.thumbnail else gif.get_url(),
-                'tags': gif.tags
-            })
-        
-        return JsonResponse({
-            'success': True,
-            'pack': {
-                'id': pack.id,
-                'name': pack.name,
-                'icon': pack.icon
-            },
-            'gifs': gifs_list,
-            'total_pages': paginator.num_pages,
-            'current_page': page_obj.number
-        })
-    except GifPack.DoesNotExist:
-        return JsonResponse({
-            'success': False,
-            'error': 'Pack not found'
-        }, status=404)
+        # Cached catalog snapshot of the page (404 for unknown packs); 304 when unchanged
+        return catalog.respond(request, catalog.gif_pack_page(pack_id, request.GET.get('page', 1)))
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -2633,7 +2536,7 @@ def get_gifs_by_pack(request, pack_id):
 @login_required
 @require_http_methods(["GET"])
 def search_gifs(request):
-    """Search GIFs by title or tags"""
+    """Search GIFs by title, tags and category (the last word may be partial, for typeahead)"""
     try:
         query = request.GET.get('q', '').strip()
         
@@ -2643,11 +2546,9 @@ def search_gifs(request):
                 'error': 'Search query too short'
             }, status=400)
         
-        gifs = GifFile.objects.filter(
-            models.Q(title__icontains=query) |
-            models.Q(tags__icontains=query),
-            is_active=True
-        ).order_by('-views')[:20]
+        # Ranked index search (the pack comes with each result). A trailing space
+        # means the last word is complete, so it is matched exactly, not as a prefix.
+        gifs = gif_search.search(request.GET.get('q', '').lstrip(), limit=20)
         
         gifs_list = []
         for gif in gifs:
@@ -2686,16 +2587,8 @@ def send_gif(request):
         gif = GifFile.objects.get(id=gif_id, is_active=True)
         room = Room.objects.get(name=room_name)
         
-        # Log usage
-        GifUsageLog.objects.create(
-            gif=gif,
-            user=request.user,
-            room=room,
-            message_text=message_text
-        )
-        
-        # Increment views
-        gif.increment_views()
+        # Log usage and count the view (buffered, written in batches)
+        gif_activity.record_send(gif, request.user, room, message_text)
         
         return JsonResponse({
             'success': True,
@@ -2722,9 +2615,9 @@ def send_gif(request):
 @login_required
 @require_http_methods(["GET"])
 def get_trending_gifs(request):
-    """Get trending GIFs by view count"""
+    """Get trending GIFs by recent (time-decayed) activity"""
     try:
-        gifs = GifFile.objects.filter(is_active=True).order_by('-views')[:10]
+        gifs = gif_activity.trending(limit=10)
         
         gifs_list = []
         for gif in gifs:
@@ -2734,7 +2627,8 @@ def get_trending_gifs(request):
                 'pack_name': gif.pack.name,
                 'url': gif.get_url(),
                 'thumbnail': gif.thumbnail.url if gif.thumbnail else gif.get_url(),
-                'views': gif.views
+                'views': gif.views,
+                'trending_score': round(gif.trending_score, 2)
             })
         
         return JsonResponse({
@@ -2756,9 +2650,8 @@ def get_gif_stats(request):
         total_gifs = GifFile.objects.filter(is_active=True).count()
         total_packs = GifPack.objects.filter(is_active=True).count()
         total_sent = GifUsageLog.objects.filter(user=request.user).count()
-        total_views = GifFile.objects.filter(is_active=True).aggregate(
-            total=models.Sum('views')
-        )['total'] or 0
+        # Read from the roll-up, which only has GIFs that were ever viewed
+        total_views = GifTrending.objects.filter(gif__is_active=True).aggregate(total=models.Sum('views'))['total'] or 0
         
         return JsonResponse({
             'success': True,
@@ -2819,6 +2712,7 @@ def game_memory(request):
 def submit_game_score(request):
     """Submit game score and award Evercoins with time validation"""
     try:
+        from django.db import transaction as db_transaction
         from .models import GameSession
         import json
         
@@ -2840,37 +2734,32 @@ def submit_game_score(request):
             # Cap reward at 200 Evercoins maximum
             reward = min(reward, 200)
         
-        # Create game session
-        session = GameSession.objects.create(
-            user=request.user,
-            game_type=game_type,
-            score=score,
-            evercoin_earned=reward,
-            completed=True
-        )
-        
-        # Award Evercoins only if reward > 0
-        if reward > 0:
-            # Get or create user profile
-            from .models import UserProfile
-            profile, created = UserProfile.objects.get_or_create(user=request.user)
-            
-            if created:
-                print(f'[GAME] Created profile for {request.user.username}')
-            
-            # Award coins
-            profile.evercoin += reward
-            profile.save()
+        # Award Evercoins (only if reward > 0) and record the session together, so a
+        # retried request with the same Idempotency-Key neither pays nor records twice
+        entry = None
+        with db_transaction.atomic():
+            if reward > 0:
+                entry = ledger.credit(
+                    request.user, reward, 'game_reward', REWARDS,
+                    reference=f'game:{game_type}',
+                    idempotency_key=request.headers.get('Idempotency-Key') or data.get('idempotency_key'),
+                )
             
-            print(f'[GAME] {request.user.username} earned {reward} coins. Total: {profile.evercoin}')
-        
-        # Get current evercoin balance
-        try:
-            from .models import UserProfile
-            profile = UserProfile.objects.get(user=request.user)
-            total_evercoin = profile.evercoin
-        except UserProfile.DoesNotExist:
-            total_evercoin = 0
+            if entry is None or not entry.replayed:
+                GameSession.objects.create(
+                    user=request.user,
+                    game_type=game_type,
+                    score=score,
+                    evercoin_earned=reward,
+                    completed=True
+                )
+        
+        if entry is not None:
+            total_evercoin = entry.balance_after
+            print(f'[GAME] {request.user.username} earned {reward} coins. Total: {total_evercoin}')
+        else:
+            # Get current evercoin balance
+            total_evercoin = ledger.balance(request.user.id)
         
         return JsonResponse({
             'success': True,
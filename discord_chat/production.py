@@ -54,6 +54,10 @@ if RENDER_DISK_MOUNT:
 else:
     MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Keep the chat message journal on the persistent disk so it survives redeploys
+if RENDER_DISK_MOUNT:
+    MESSAGE_PIPELINE = dict(MESSAGE_PIPELINE, JOURNAL_DIR=os.path.join(RENDER_DISK_MOUNT, 'journal'))
+
 # Ensure media root exists
 try:
     os.makedirs(MEDIA_ROOT, exist_ok=True)
@@ -94,6 +98,33 @@ if REDIS_URL:
             },
         },
     }
+
+    # CHANNEL_LAYER=streams switches to bounded per-group Redis Streams with
+    # backpressure and drop/lag metrics (see chat/streams_layer.py)
+    if config('CHANNEL_LAYER', default='redis') == 'streams':
+        CHANNEL_LAYERS = {
+            'default': {
+                'BACKEND': 'chat.streams_layer.RedisStreamsChannelLayer',
+                'CONFIG': {
+                    'hosts': [REDIS_URL],
+                    'capacity': 1500,
+                    'expiry': 60,
+                    'lag_limit': 5.0,
+                    'group_retention': {
+                        'chat_*': {'maxlen': 2000, 'expiry': 60},
+                        'notifications_*': {'maxlen': 200, 'expiry': 300},
+                        'game2048_*': {'maxlen': 500, 'expiry': 10},
+                    },
+                },
+            },
+        }
+
+    PRESENCE = {
+        'BACKEND': 'chat.presence.RedisPresenceBackend',
+        'LOCATION': REDIS_URL,
+        'TTL': 120,
+        'REAP_INTERVAL': 30,
+    }
 else:
     # Fallback to in-memory backends when Redis is not available
     print("WARNING: Redis not configured. Using fallback backends.")
@@ -182,6 +182,105 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Room presence (who is currently connected to each chat room)
+PRESENCE = {
+    'BACKEND': 'chat.presence.LocMemPresenceBackend',
+    'TTL': 120,  # Seconds without a heartbeat before a member is dropped
+    'REAP_INTERVAL': 30,  # Seconds between presence reaper passes
+}
+
+# Room chat messages are written behind the broadcast in batches
+MESSAGE_PIPELINE = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL_MS': 200,  # Longest a message waits before it is written
+    'MAX_BATCH': 100,  # Flush early once this many messages are queued
+    'JOURNAL_DIR': BASE_DIR / 'var' / 'journal',  # Local append-only journal, replayed on startup
+    'FSYNC': False,
+    # Claimed automatically (lock file per host, cache lease across hosts); set MESSAGE_WORKER_ID to pin one
+    'WORKER_ID': int(os.environ['MESSAGE_WORKER_ID']) if os.environ.get('MESSAGE_WORKER_ID') else None,
+    'WORKER_LEASE_SECONDS': 60,  # Cache lease on the worker ID, renewed by the writer thread
+}
+
+# Newest messages per room, kept in the cache so opening a room skips the Message query
+RECENT_MESSAGES = {
+    'SIZE': 50,  # Messages kept per room (also the first page shown)
+    'TIMEOUT': 3600,  # Seconds an idle room's buffer stays cached
+}
+
+# Sequenced chat events kept per room so reconnecting sockets can resume without a reload
+ROOM_EVENT_LOG = {
+    'SIZE': 200,  # Events kept per room; older gaps fall back to a snapshot
+    'TIMEOUT': 3600,  # Seconds an idle room's log stays cached
+}
+
+# Codec for pre-encoded room events: 'auto' (orjson if installed), 'orjson' or 'json'
+CHAT_JSON_CODEC = 'auto'
+
+# Outbox for notification rows and their WebSocket events, delivered off the request path
+NOTIFICATION_OUTBOX = {
+    'MODE': os.environ.get('NOTIFICATION_DISPATCH_MODE', 'thread'),  # 'worker': run manage.py dispatch_notifications
+    'BATCH_SIZE': 100,  # Outbox entries delivered per round
+    'POLL_INTERVAL_MS': 1000,  # Idle poll for retries and entries queued by other processes
+    'MAX_ATTEMPTS': 8,  # Send attempts before an entry is dropped
+    'RETRY_BACKOFF_MS': 500,  # First retry delay, doubled on every attempt
+    'LEASE_SECONDS': 30,  # How long a claimed entry is hidden from other dispatchers
+}
+
+# Cached unread counters for the notification badge and friends list
+UNREAD_COUNTS = {
+    'TIMEOUT': 900,  # Seconds before a counter is recounted from the database
+}
+
+# Profile picture / cover variants rendered off the request thread
+IMAGE_PIPELINE = {
+    'MODE': 'thread',  # 'inline' processes uploads synchronously
+    'WORKERS': 2,  # Worker threads rendering variants
+    'QUALITY': 85,  # JPEG and WebP encoder quality
+}
+
+# Cached per-user friend sets behind Friendship.are_friends
+FRIEND_GRAPH = {
+    'TIMEOUT': 3600,  # Seconds before an entry is rebuilt from the database
+}
+
+# Ranked, prefix-aware GIF search (rebuild with manage.py rebuild_gif_search)
+GIF_SEARCH = {
+    'FIELD_WEIGHTS': {'title': 2.0, 'tags': 3.0, 'category': 1.0},  # Term frequency weight per field
+    'POPULARITY_WEIGHT': 0.3,  # Added per unit of log(1 + views)
+    'PREFIX_EXPANSIONS': 8,  # Most common completions tried for a word being typed
+    'POSTINGS_PER_TERM': 200,  # Highest-impact GIFs read per term
+}
+
+# GIF sends/views buffered in memory and written in aggregate, with decayed trending scores
+GIF_ACTIVITY = {
+    'ENABLED': True,  # False writes each send/view immediately
+    'FLUSH_INTERVAL_MS': 2000,  # Longest a count waits before it is written
+    'MAX_BATCH': 500,  # Flush early once this many usage logs are queued
+    'HALF_LIFE_HOURS': 24,  # Trending activity loses half its weight per half-life
+}
+
+# Cached, ETag-versioned snapshots of the gift and GIF pack catalogs
+CATALOG = {
+    'TIMEOUT': 86400,  # Seconds a snapshot is kept (edits invalidate it sooner)
+    'MAX_AGE': 60,  # Seconds clients may reuse a response before revalidating
+}
+
+# /media/ serving in MediaFilesMiddleware (stat cache, ETag/304, ranges, hot small files)
+MEDIA_SERVING = {
+    'STAT_TTL': 2.0,  # Seconds a cached stat is trusted before the file is stat'ed again
+    'HOT_CACHE_BYTES': 32 * 1024 * 1024,  # Memory for small file bodies
+    'HOT_FILE_MAX_BYTES': 256 * 1024,  # Files up to this size are kept in memory
+    'MAX_AGE': 3600,  # Cache-Control max-age for media responses
+    'IMMUTABLE_MAX_AGE': 31536000,  # One year for content-addressed files (Cache-Control: immutable)
+    'OFFLOAD': os.environ.get('MEDIA_OFFLOAD') or None,  # 'x-accel-redirect' / 'x-sendfile' behind nginx / Apache, or 'auto'
+    'OFFLOAD_PREFIX': '/protected-media/',  # Internal nginx location aliased to MEDIA_ROOT
+}
+
+# Content-addressed uploads and garbage collection of unreferenced media (chat.media_store)
+MEDIA_STORE = {
+    'GRACE_HOURS': 24,  # gc_media keeps unreferenced files younger than this
+}
+
 # Authentication & Security Settings
 LOGIN_URL = '/auth/login/'
 LOGIN_REDIRECT_URL = '/chat/'
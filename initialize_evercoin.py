@@ -9,6 +9,7 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'discord_chat.settings')
 django.setup()
 
 from django.contrib.auth.models import User
+from chat.evercoin import ledger, GRANTS
 from chat.models import UserProfile
 
 # Starting balance
@@ -19,12 +20,14 @@ updated_count = 0
 for user in User.objects.all():
     profile, created = UserProfile.objects.get_or_create(user=user)
     
-    # Only set if not already set
+    # Only set if not already set (and never twice: the key makes a rerun a no-op)
+    entry = None
     if profile.evercoin == 0:
-        profile.evercoin = STARTING_EVERCOIN
-        profile.save()
+        entry = ledger.credit(user, STARTING_EVERCOIN, 'admin_grant', GRANTS,
+                              memo='Starting balance', idempotency_key='starting-balance')
+    if entry is not None and not entry.replayed:
         updated_count += 1
-        print(f"✅ {user.username}: +{STARTING_EVERCOIN} EC (total: {profile.evercoin})")
+        print(f"✅ {user.username}: +{STARTING_EVERCOIN} EC (total: {entry.balance_after})")
     else:
         print(f"⚠️  {user.username}: Already has {profile.evercoin} EC (skipped)")
 
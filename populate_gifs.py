@@ -12,6 +12,7 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'discord_chat.settings')
 django.setup()
 
 from chat.models import GifPack, GifFile
+from chat.media_store import media_store
 from django.core.files.base import ContentFile
 import requests
 from io import BytesIO
@@ -207,8 +208,11 @@ def populate_gifs():
                 gif_content = download_gif(gif_info['url'], gif_info['title'])
                 
                 if gif_content:
+                    # Stored under its content hash (re-imports reuse the same file)
+                    filename = f"{gif_info['title'].lower().replace(' ', '_')}.gif"
                     gif_file = GifFile.objects.create(
                         pack=pack,
+                        gif_file=media_store.save(gif_content, 'gifs', filename, default_ext='.gif'),
                         title=gif_info['title'],
                         description=f"{gif_info['title']} GIF in {pack_info['name']} pack",
                         tags=gif_info['tags'],
@@ -220,10 +224,7 @@ def populate_gifs():
                         duration=1.0,
                         is_animated=True,
                     )
-                    
-                    # Save the GIF file
-                    filename = f"{gif_info['title'].lower().replace(' ', '_')}.gif"
-                    gif_file.gif_file.save(filename, gif_content, save=True)
+
                     print(f"  ✅ Added GIF: {gif_info['title']}")
                     time.sleep(0.5)  # Be nice to the server
                 else: